@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) S. Merkel, Universite de Lille, France
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+"""
+Responsiveness benchmark for the maudESGEdit window
+
+Runs the real plotEsg window without a display (QT_QPA_PLATFORM=offscreen) on synthetic ESG files of increasing size,
+drives navigation, edits on one azimuth, edits on all azimuths, and undos, and records the latency of each action, from
+the call to the end of the redraw. Navigation redraws are delayed and merged in the window, their latency includes the
+delay. "key repeat" is the time from the last of a quick series of navigation steps to the plot of the last azimuth. Results are written in JSON, with percentiles for each action and each file size
+
+	python3 maudESGBenchmark.py --sizes 36x1000 360x10000 --output bench.json
+
+With --compare, median latencies are compared to those of an earlier run, and the script fails if an action got slower
+than the tolerance, so that regressions are caught before a new version is deployed.
+"""
+
+import os
+import sys
+import argparse
+import json
+import platform
+import tempfile
+import time
+
+# Must be set before Qt is loaded
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy
+import matplotlib
+import PyQt5.QtWidgets
+import PyQt5.QtCore
+
+from maudESGCore import EsgDataset, formatEsgBlock, writeEsgBlocks
+import maudESGEdit
+
+# Percentiles of the latencies saved for each action
+benchmarkPercentiles = [50, 90, 95, 99]
+
+#################################################################
+#
+# Synthetic data
+#
+#################################################################
+
+def syntheticEsgBlocks(nazimuths, npoints, seed=0):
+	"""
+	Generator, azimuths of a synthetic ESG file for a flat transmission detector at 200 mm, ready for writeEsgBlocks.
+	Each azimuth has npoints points with a smooth background, a few diffraction peaks, and counting noise
+	"""
+	rng = numpy.random.default_rng(seed)
+	distance = 200.
+	x = numpy.linspace(10., 120., npoints)
+	twotheta = numpy.degrees(numpy.arctan(x/distance))
+	peaks = numpy.linspace(twotheta[0], twotheta[-1], 12)[1:-1]
+	for i in range(0,nazimuths):
+		eta = 360. * i / nazimuths
+		intensity = 200. + 50.*numpy.cos(numpy.radians(twotheta))
+		for k, peak in enumerate(peaks):
+			height = 1000. * (1. + 0.5*numpy.cos(numpy.radians(2.*eta + 30.*k)))
+			intensity += height * numpy.exp(-0.5*((twotheta-peak)/0.05)**2)
+		intensity = rng.poisson(intensity).astype(float)
+		header = "_pd_block_id noTitle|#%d\n\n_diffrn_detector 2D\n_pd_instr_dist_spec/detc %.3f\n_pd_meas_angle_omega 0.0\n_pd_meas_angle_eta %.3f\n\nloop_\n_pd_meas_position_x\n_pd_meas_intensity_total\n" % (i, distance, eta)
+		yield formatEsgBlock(header, numpy.column_stack((twotheta, x, intensity)), "flatTransmission")
+
+def writeSyntheticEsg(filename, nazimuths, npoints, seed=0):
+	writeEsgBlocks(filename, syntheticEsgBlocks(nazimuths, npoints, seed), nblocks=nazimuths)
+
+#################################################################
+#
+# Driving the window
+#
+#################################################################
+
+def latencyStatistics(latencies):
+	"""
+	Summary of a list of latencies, in seconds
+	"""
+	latencies = numpy.asarray(latencies, dtype=float)
+	stats = {"count": len(latencies), "mean": float(latencies.mean()), "min": float(latencies.min()), "max": float(latencies.max())}
+	for p, value in zip(benchmarkPercentiles, numpy.percentile(latencies, benchmarkPercentiles)):
+		stats["p%d" % p] = float(value)
+	return stats
+
+class windowDriver():
+	"""
+	Calls actions of a plotEsg window as the user would, and records how long each of them takes, pending Qt events included
+	"""
+	def __init__(self, app, form):
+		self.app = app
+		self.form = form
+		self.latencies = {}
+
+	def timed(self, name, action, *args):
+		start = time.perf_counter()
+		action(*args)
+		self.wait_for_edits()
+		self.wait_for_draw()
+		self.app.processEvents()
+		self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+	def wait_for_edits(self):
+		"""
+		Edits on all azimuths run in a background thread, they are done once the window received the result
+		"""
+		while (self.form.editWorker != None):
+			self.app.processEvents()
+			time.sleep(0.0005)
+
+	def wait_for_draw(self):
+		"""
+		Navigation redraws are delayed and merged, they are done once the redraw timer fired
+		"""
+		while (self.form.drawTimer.isActive()):
+			self.app.processEvents()
+			time.sleep(0.0005)
+	
+	def key_repeat(self, n, interval=1./30.):
+		"""
+		Moves forward n times, one step every interval seconds as with key repeat, and records the time from the last
+		step to the plot of the last azimuth. Events are processed between steps, as they would be between key presses
+		"""
+		for k in range(0,n):
+			start = time.perf_counter()
+			self.form.handle_forward()
+			while (time.perf_counter() - start < interval):
+				self.app.processEvents()
+				time.sleep(0.0005)
+		start = time.perf_counter()
+		self.form.handle_forward()
+		self.wait_for_draw()
+		self.app.processEvents()
+		self.latencies.setdefault("key repeat", []).append(time.perf_counter() - start)
+	
+	def open_file(self, filename):
+		self.form.set_data(EsgDataset.fromFile(filename), filename)
+
+	def remove_points(self):
+		"""
+		Zoom on the middle of the 2theta range, as the user would, and remove the points in view
+		"""
+		data = self.form.esgData.data[self.form.etaToPlot]
+		center = numpy.median(data[:,0])
+		self.form.axes.set_xlim(center-0.05, center+0.05)
+		self.form.axes.set_ylim(data[:,2].min()-1., data[:,2].max()+1.)
+		self.form.remove_points()
+
+	def subtract_background(self):
+		data = self.form.esgData.data[self.form.etaToPlot]
+		self.form.xbg = [float(data[:,0].min()), float(data[:,0].max())]
+		self.form.ybg = [10., 20.]
+		self.form.subtract_background(None)
+
+	def bulk_edit(self, step, description):
+		self.form.start_edit_job(step, description)
+
+def benchmarkSize(app, filename, repeat):
+	"""
+	Runs all actions repeat times on one file, returns the latency statistics of each action
+	"""
+	# Edits are journaled as in normal use, in a folder of their own
+	form = maudESGEdit.plotEsg(journalDirectory=os.path.join(os.path.dirname(filename), "journals"))
+	driver = windowDriver(app, form)
+	for k in range(0,min(repeat,3)):
+		driver.timed("open", driver.open_file, filename)
+	data = form.esgData.data[0]
+	tmin, tmax = float(data[:,0].min()), float(data[:,0].max())
+	bulkEdits = [
+		("shift all", {"edit": "shift", "shift": 1., "eta": None}),
+		("set minimum", {"edit": "setMinimum", "minimum": 10.}),
+		("restrict 2theta range", {"edit": "crop", "min2theta": tmin+0.1*(tmax-tmin), "max2theta": tmax-0.1*(tmax-tmin)}),
+		("subtract baseline", {"edit": "subtractBaseline", "width": 0.5, "gap": 5., "eta": None}),
+		("rebin", {"edit": "rebin", "step": None, "maxpoints": max(1, len(data)//2), "aggregate": "mean"}),
+	]
+	for k in range(0,repeat):
+		driver.timed("forward", form.handle_forward)
+		driver.timed("backward", form.handle_backward)
+		driver.timed("forward", form.handle_forward)
+		driver.timed("remove points", driver.remove_points)
+		driver.timed("undo", form.cancel_last)
+		driver.timed("subtract background", driver.subtract_background)
+		driver.timed("undo", form.cancel_last)
+		driver.key_repeat(20)
+	for name, step in bulkEdits:
+		for k in range(0,repeat):
+			driver.timed(name, driver.bulk_edit, step, name)
+			driver.timed("undo all", form.cancel_last)
+	# Closing the window quits the program
+	form.end_journal()
+	form.hide()
+	form.deleteLater()
+	app.processEvents()
+	return dict((name, latencyStatistics(latencies)) for name, latencies in driver.latencies.items())
+
+#################################################################
+#
+# Comparison with an earlier run
+#
+#################################################################
+
+def compareBenchmarks(results, reference, tolerance):
+	"""
+	Median latencies of results against those of reference, for sizes and actions found in both.
+	Returns the list of (size, action, ratio) slower than tolerance
+	"""
+	old = dict((run["size"], run["actions"]) for run in reference["runs"])
+	slower = []
+	for run in results["runs"]:
+		if (run["size"] not in old):
+			continue
+		for name, stats in sorted(run["actions"].items()):
+			if (name not in old[run["size"]]):
+				continue
+			ratio = stats["p50"] / max(old[run["size"]][name]["p50"], 1.e-9)
+			print ("%-12s %-24s %8.1f ms %8.1f ms  x%.2f" % (run["size"], name, 1000.*old[run["size"]][name]["p50"], 1000.*stats["p50"], ratio))
+			if (ratio > tolerance):
+				slower.append((run["size"], name, ratio))
+	return slower
+
+def parseSize(text):
+	try:
+		nazimuths, npoints = [int(n) for n in text.lower().split("x")]
+	except ValueError:
+		raise argparse.ArgumentTypeError("sizes are given as AZIMUTHSxPOINTS, 36x1000 for instance")
+	if ((nazimuths < 2) or (npoints < 10)):
+		raise argparse.ArgumentTypeError("at least 2 azimuths and 10 points per azimuth are needed")
+	return (nazimuths, npoints)
+
+def main():
+	parser = argparse.ArgumentParser(description="Responsiveness benchmark of the maudESGEdit window, on synthetic ESG files, without a display.")
+	parser.add_argument("--sizes", nargs="+", type=parseSize, default=[(36,1000), (72,5000), (360,10000)], metavar="AZIMUTHSxPOINTS", help="Sizes of the synthetic files (default: 36x1000 72x5000 360x10000)")
+	parser.add_argument("--repeat", type=int, default=10, help="Number of times each action is repeated (default: 10)")
+	parser.add_argument("--output", default="maudESGBenchmark.json", help="JSON file for the results (default: maudESGBenchmark.json)")
+	parser.add_argument("--compare", metavar="JSONFILE", help="Results of an earlier run. Fails if an action is slower than --tolerance times its earlier median")
+	parser.add_argument("--tolerance", type=float, default=1.5, help="Accepted ratio of median latencies with --compare (default: 1.5)")
+	args = parser.parse_args()
+
+	app = PyQt5.QtWidgets.QApplication(sys.argv[:1])
+	results = {"format": "maudESGEdit benchmark", "version": "1.0", "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+		"platform": platform.platform(), "python": platform.python_version(), "numpy": numpy.__version__, "matplotlib": matplotlib.__version__,
+		"qt": PyQt5.QtCore.QT_VERSION_STR, "qpa": os.environ["QT_QPA_PLATFORM"], "repeat": args.repeat, "runs": []}
+	with tempfile.TemporaryDirectory() as tmpdir:
+		for nazimuths, npoints in args.sizes:
+			size = "%dx%d" % (nazimuths, npoints)
+			filename = os.path.join(tmpdir, "synthetic-%s.esg" % size)
+			writeSyntheticEsg(filename, nazimuths, npoints)
+			start = time.time()
+			actions = benchmarkSize(app, filename, args.repeat)
+			results["runs"].append({"size": size, "azimuths": nazimuths, "points": npoints, "bytes": os.path.getsize(filename), "actions": actions})
+			print ("%s: %d actions in %.1f s" % (size, sum(stats["count"] for stats in actions.values()), time.time()-start), flush=True)
+	f = open(args.output, 'w')
+	json.dump(results, f, indent=1)
+	f.write("\n")
+	f.close()
+	print ("Results saved in %s" % args.output)
+
+	if (args.compare != None):
+		f = open(args.compare, 'r')
+		reference = json.load(f)
+		f.close()
+		slower = compareBenchmarks(results, reference, args.tolerance)
+		if (len(slower) > 0):
+			for size, name, ratio in slower:
+				print ("Slower: %s at %s, x%.2f" % (name, size, ratio))
+			sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,2422 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) S. Merkel, Universite de Lille, France
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+"""
+Data core of maudESGEdit: reading, editing, and saving MAUD ESG files, and detector calibrations
+
+This module does not depend on Qt or matplotlib and can be used from scripts or notebooks, for instance
+
+	import maudESGCore
+	esg = maudESGCore.EsgDataset.fromFile("data.esg")
+	esg.applyMask(maudESGCore.loadMaskFromFile("cleanup.msk"))
+	esg.setMinimum(10.)
+	esg.save("data-clean.esg")
+
+Edits recorded in the graphical interface can be saved as recipes and replayed on other files
+
+	esg = maudESGCore.EsgDataset.fromFile("data-002.esg")
+	esg.applyRecipe(maudESGCore.loadRecipeFromFile("cleanup.json"))
+
+The graphical interface, in maudESGEdit.py, is built on top of it.
+"""
+
+# System functions
+import os.path
+import locale
+
+# Compressed file formats
+import gzip
+import bz2
+import lzma
+
+# Maths stuff
+import numpy
+import math
+
+# Columnar export
+import zipfile
+try:
+	import h5py # Optional, for export to HDF5
+except ImportError:
+	h5py = None
+try:
+	import scipy.optimize # Optional, for the refinement of detector angles
+except ImportError:
+	scipy = None
+
+# Image readers, optional, for the integration of TIFF and EDF images
+try:
+	import tifffile
+except ImportError:
+	tifffile = None
+try:
+	import fabio
+except ImportError:
+	fabio = None
+try:
+	import PIL.Image
+except ImportError:
+	PIL = None
+
+# Useful stuff
+import copy
+import collections
+import concurrent.futures
+import hashlib
+import json
+import re
+import threading
+import time
+
+#################################################################
+#
+# Save a read MAUD esg files, mask files
+#
+#################################################################
+
+# ESG files can be compressed. Compression is recognized from the file extension
+esgCompressionOpeners = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+def openEsgFile(filename, mode='r'):
+	"""
+	Opens an ESG file, in text mode unless mode includes 'b'. Files ending in .gz, .bz2, or .xz are compressed or decompressed on the fly
+	"""
+	ext = (os.path.splitext(filename)[1]).lower()
+	if (ext in esgCompressionOpeners):
+		return esgCompressionOpeners[ext](filename, mode if ('b' in mode) else mode+'t')
+	return open(filename, mode)
+
+# Encoding of ESG files opened in text mode, used to convert bytes copied from a file in binary mode
+esgEncoding = locale.getpreferredencoding(False)
+
+def isEsgFileName(filename):
+	"""
+	True if filename has the extension of an ESG file, compressed or not
+	"""
+	name = filename.lower()
+	for ext in [""] + list(esgCompressionOpeners.keys()):
+		if (name.endswith(".esg" + ext)):
+			return True
+	return False
+
+# Lines closing the header of an azimuth, data come next, and corresponding type of esg
+esgEndOfHeaders = {
+	"_pd_meas_intensity_total": "flatTransmission", # We are probably reading data for a flatTransmission detector
+	"_pd_calc_intensity_total": "flatTransmission", # Files created by fit2d2maud write it this way, assumes a flat transmission detector
+	"_pd_meas_position_x _pd_meas_position_y _pd_meas_intensity_total": "inclinedReflection", # We are probably reading data for a inclinedReflection detector
+}
+
+def readEsgBlocks(f, offsets=False):
+	"""
+	Reads an ESG file one azimuth at a time, from an open file f
+	
+	Generator, yields header (as a string), eta (as a string), type of esg, and data values as text (list of lists of strings) for each azimuth
+	Only the current azimuth is kept in memory
+	
+	If offsets is True, f must be opened in binary mode and a fifth item is yielded: the byte offsets of the start and end of the 
+	azimuth in the uncompressed file, and whether the azimuth is closed by a line without data (False at the end of the file)
+	"""
+	header = None
+	eta = None
+	position = 0
+	for txt in f:
+		if (offsets):
+			linestart = position
+			position += len(txt)
+			txt = txt.decode(esgEncoding)
+		txt = txt.strip()
+		if (header == None):
+			# Locating lines with new spectra. They start with _pd_block_id. We look for lines with this
+			if ("_pd_block_id" in txt):
+				header = ""
+				esgtype = None
+				values = []
+				if (offsets):
+					start = linestart
+		if (header == None):
+			continue
+		if (esgtype == None):
+			header = header + txt + "\n"
+			if (txt in esgEndOfHeaders):
+				esgtype = esgEndOfHeaders[txt] # We reached the end headers, data comes next
+			else:
+				# We search for information we need
+				a=txt.split()
+				if (len(a) > 0):
+					if (a[0] == "_pd_meas_angle_eta"):
+						eta = a[1]
+		else:
+			a=txt.split()
+			if (len(a) < 2):
+				if (offsets):
+					yield header, eta, esgtype, values, (start, position, True)
+				else:
+					yield header, eta, esgtype, values
+				header = None
+			elif (esgtype == "inclinedReflection"): # x, y, intensity (x and y are detector positions, in mm)
+				values.append(a[0:3])
+			else:
+				values.append(a[0:2])
+	if ((header != None) and (esgtype != None)):
+		if (offsets):
+			yield header, eta, esgtype, values, (start, position, False)
+		else:
+			yield header, eta, esgtype, values
+
+def headerValue(header, key):
+	"""
+	Returns the value for key in an azimuth header, or None if not found
+	"""
+	for txt in header.split("\n"):
+		a=txt.split()
+		if ((len(a) > 1) and (a[0] == key)):
+			return a[1]
+	return None
+
+def esgFileType(filename):
+	"""
+	Looks at the first azimuth of an ESG file and returns the type of esg and the detector distance (in mm, 200 if not found)
+	Type of esg can be 
+	- inclinedReflection if detector type is "inclined reflection image"
+	- flatTransmission if created by "Flat image transmission"
+	"""
+	f = openEsgFile(filename, 'r')
+	try:
+		header, eta, esgtype, values = next(readEsgBlocks(f))
+	except StopIteration:
+		raise ValueError("%s does not look like an ESG file" % filename)
+	finally:
+		f.close()
+	detdistance = 200.
+	if (headerValue(header, "_pd_instr_dist_spec/detc") != None):
+		detdistance = float(headerValue(header, "_pd_instr_dist_spec/detc"))
+	return esgtype, detdistance
+
+def esgBlockData(values, esgtype, detdistance, detector=None):
+	"""
+	Converts data values read in an ESG file to an array with one line per data point
+	- [2theta, x, intensity] for flatTransmission,
+	- [2theta, x, intensity, y] for inclinedReflection, detector is then an AngularInclinedFlatImageCalibration.
+	"""
+	if (esgtype == "inclinedReflection"):
+		values = numpy.array(values, dtype=float).reshape((-1,3))
+		twotetha = twoThetaCache.get(detector, values[:,0], values[:,1])
+		return numpy.column_stack((twotetha, values[:,0], values[:,2], values[:,1])) # PAY ATTENTION Inversion of items to 2 and 1 to have itensity at element 3 of the list! Most routines below assume intensity is on element 3 and do not need any adjustement
+	values = numpy.array(values, dtype=float).reshape((-1,2))
+	twotetha = numpy.degrees(numpy.arctan(values[:,0]/detdistance))
+	return numpy.column_stack((twotetha, values[:,0], values[:,1]))
+
+def formatEsgBlock(header, thisdata, esgtype):
+	"""
+	Formats one azimuth for an ESG file: header followed by data points. Points with NaN intensities are skipped
+	"""
+	string = header
+	thisdata = numpy.asarray(thisdata, dtype=float)
+	if (thisdata.size > 0):
+		thisdata = thisdata[numpy.logical_not(numpy.isnan(thisdata[:,2]))]
+		if (esgtype == "inclinedReflection"):
+			string += ("%.4f %.4f %.8f\n" * len(thisdata)) % tuple(thisdata[:,[1,3,2]].ravel().tolist())
+		else:
+			string += ("%.2f %.8f\n" * len(thisdata)) % tuple(thisdata[:,[1,2]].ravel().tolist())
+	string += "\n"
+	return string
+
+def copyEsgBlocks(f, offsets):
+	"""
+	Generator, yields azimuths of an ESG file exactly as they are in the file, as strings ready for writeEsgBlocks
+	- f: file opened in binary mode,
+	- offsets: list of offsets, as returned by readEsgBlocks, in increasing order so that compressed files are read only once
+	Azimuths at the end of the file are closed by an empty line, as in formatEsgBlock
+	"""
+	for start, end, closed in offsets:
+		f.seek(start)
+		string = f.read(end-start).decode(esgEncoding)
+		if (os.linesep != "\n"):
+			# Text mode will write line ends back as they were
+			string = string.replace(os.linesep, "\n")
+		if (not closed):
+			if (not string.endswith("\n")):
+				string += "\n"
+			string += "\n"
+		yield string
+
+def writeEsgBlocks(filename, blocks, progress=None, nblocks=None):
+	"""
+	Writes azimuths to an ESG file, from an iterable of strings prepared by formatEsgBlock
+	
+	The file is first written to a temporary file in the same directory and moved in place once complete, so that
+	an interrupted or cancelled save never leaves a half-written file behind. Files ending in .gz, .bz2, or .xz are compressed.
+	
+	progress is an optional function, called as progress(i,nblocks) after each azimuth is written. If it returns False,
+	saving is cancelled, the temporary file is removed, and the function returns False
+	"""
+	directory, name = os.path.split(os.path.abspath(filename))
+	# The temporary file keeps the extension of the final file, for compression
+	tmpname = os.path.join(directory, ".%s.%s" % (os.urandom(4).hex(), name))
+	f = openEsgFile(tmpname, 'x')
+	try:
+		i = 0
+		for string in blocks:
+			f.write(string)
+			i += 1
+			if ((progress != None) and (progress(i,nblocks) == False)):
+				# Saving cancelled, we clean up
+				f.close()
+				os.remove(tmpname)
+				return False
+		f.close()
+		# Ready to move the new file in place
+		os.replace(tmpname, filename)
+	except BaseException:
+		f.close()
+		if os.path.exists(tmpname):
+			os.remove(tmpname)
+		raise
+	return True
+
+#################################################################
+#
+# Edits on the data of a single azimuth
+#
+# Used by EsgDataset and by the streaming mode, so that both give the same results. 
+# Send data for one azimuth, as a list or array with one line per data point. A new array is returned.
+#
+#################################################################
+
+def removeRectangle(thisdata, min2theta, max2theta, minintensity, maxintensity):
+	"""
+	Remove data points with 2theta between min2theta and max2theta and intensity between minintensity and maxintensity
+	"""
+	thisdata = numpy.asarray(thisdata, dtype=float)
+	if (thisdata.size == 0):
+		return thisdata
+	inside = (thisdata[:,0] > min2theta) & (thisdata[:,0] < max2theta) & (thisdata[:,2] > minintensity) & (thisdata[:,2] < maxintensity)
+	return thisdata[numpy.logical_not(inside)]
+
+def removeTwoThetaRange(thisdata, min2theta, max2theta):
+	"""
+	Remove data points with 2theta between min2theta and max2theta
+	"""
+	thisdata = numpy.asarray(thisdata, dtype=float)
+	if (thisdata.size == 0):
+		return thisdata
+	keep = numpy.logical_not((thisdata[:,0] > min2theta) & (thisdata[:,0] < max2theta))
+	return thisdata[keep]
+
+def restrictTwoThetaRange(thisdata, min2theta, max2theta):
+	"""
+	Remove data points with 2theta outside min2theta and max2theta
+	"""
+	thisdata = numpy.asarray(thisdata, dtype=float)
+	if (thisdata.size == 0):
+		return thisdata
+	keep = numpy.logical_not((thisdata[:,0] > max2theta) | (thisdata[:,0] < min2theta))
+	return thisdata[keep]
+
+def shiftIntensity(thisdata, shift):
+	"""
+	Add shift to all intensities
+	"""
+	thisdata = numpy.array(thisdata, dtype=float)
+	if (thisdata.size > 0):
+		thisdata[:,2] += shift
+	return thisdata
+
+def setMinimumIntensity(thisdata, minval):
+	"""
+	Shift all intensities so that the minimum intensity is minval
+	"""
+	thisdata = numpy.array(thisdata, dtype=float)
+	if (thisdata.size > 0):
+		thisdata[:,2] += minval-thisdata[:,2].min()
+	return thisdata
+
+def subtractLinearBackground(thisdata, xbg, ybg):
+	"""
+	Subtract a background, linearly interpolated between points (xbg, ybg), from data points with 2theta within the range of xbg
+	"""
+	thisdata = numpy.array(thisdata, dtype=float)
+	if ((thisdata.size == 0) or (len(xbg) == 0)):
+		return thisdata
+	order = numpy.argsort(xbg)
+	xbg = numpy.asarray(xbg, dtype=float)[order]
+	ybg = numpy.asarray(ybg, dtype=float)[order]
+	inside = (thisdata[:,0] > xbg[0]) & (thisdata[:,0] < xbg[-1])
+	thisdata[inside,2] -= numpy.interp(thisdata[inside,0], xbg, ybg)
+	return thisdata
+
+def snipBaseline(intensity, niter):
+	"""
+	Baseline of evenly spaced intensities with the SNIP algorithm (statistics-sensitive non-linear iterative peak-clipping). 
+	At iteration k, each point is replaced by the mean of its neighbours at distance k if this mean is lower. niter should be 
+	about the half-width of the widest peaks, in number of points. Intensities are compressed with a log-log-square root 
+	transform while clipping, so that small and large peaks are clipped alike.
+	"""
+	y = numpy.asarray(intensity, dtype=float)
+	niter = min(int(niter), (len(y)-1)//2)
+	if (niter < 1):
+		return y.copy()
+	offset = y.min()
+	v = numpy.log(numpy.log(numpy.sqrt(y - offset + 1.) + 1.) + 1.)
+	for k in range(1,niter+1):
+		v[k:-k] = numpy.minimum(v[k:-k], 0.5*(v[:-2*k] + v[2*k:]))
+	return (numpy.exp(numpy.exp(v) - 1.) - 1.)**2 - 1. + offset
+
+def estimateBaseline(thisdata, width, gapfactor=5.):
+	"""
+	Baseline under the data of one azimuth, as an array of intensities in the order of the data points
+	- width: half-width of the widest peaks, in degrees 2theta
+	- gapfactor: data are split where the step in 2theta is larger than gapfactor times the median step, between detector
+	  chips for instance. Each piece gets its own baseline, so that steps in intensity between chips are followed
+	"""
+	thisdata = numpy.asarray(thisdata, dtype=float)
+	if (thisdata.size == 0):
+		return numpy.zeros(0)
+	order = numpy.argsort(thisdata[:,0], kind='stable')
+	twotheta = thisdata[order,0]
+	intensity = thisdata[order,2]
+	steps = numpy.diff(twotheta)
+	steps = steps[steps > 0]
+	if (steps.size == 0):
+		return thisdata[:,2].copy()
+	step = numpy.median(steps)
+	bounds = numpy.concatenate(([0], numpy.nonzero(numpy.diff(twotheta) > gapfactor*step)[0]+1, [len(twotheta)]))
+	baseline = numpy.empty(len(twotheta))
+	for start, end in zip(bounds[:-1], bounds[1:]):
+		baseline[start:end] = snipBaseline(intensity[start:end], round(width/step))
+	result = numpy.empty(len(twotheta))
+	result[order] = baseline
+	return result
+
+def subtractBaseline(thisdata, width, gapfactor=5.):
+	"""
+	Subtract the baseline calculated by estimateBaseline
+	"""
+	thisdata = numpy.array(thisdata, dtype=float)
+	if (thisdata.size > 0):
+		thisdata[:,2] -= estimateBaseline(thisdata, width, gapfactor)
+	return thisdata
+
+def rebinTwoTheta(thisdata, step=None, maxpoints=None, aggregate="mean"):
+	"""
+	Groups data points in bins of 2theta and replaces each bin by a single point
+	- step: width of the bins, in degrees 2theta. Bins are aligned on multiples of step, the same for all azimuths
+	- maxpoints: if step is None, the range of 2theta of the data is split in maxpoints bins of equal width
+	- aggregate: "mean" or "sum" of the intensities in each bin
+	For flat detectors, 2theta and x are the mean of the bin. For inclined detectors, the mean x and y of a bin would be off the
+	Debye ring, 2theta, x and y are those of the point of the bin closest to its mean 2theta. Empty bins are skipped
+	"""
+	thisdata = numpy.asarray(thisdata, dtype=float)
+	if (thisdata.size == 0):
+		return numpy.array(thisdata)
+	twotheta = thisdata[:,0]
+	if (step != None):
+		if (step <= 0.):
+			raise ValueError("Rebinning step must be positive")
+		bins = numpy.floor(twotheta / step).astype(int)
+	elif ((maxpoints != None) and (maxpoints > 0)):
+		tmin = twotheta.min()
+		width = (twotheta.max() - tmin) / maxpoints
+		if (width <= 0.):
+			bins = numpy.zeros(len(twotheta), dtype=int)
+		else:
+			bins = numpy.clip(numpy.floor((twotheta - tmin) / width).astype(int), 0, maxpoints-1)
+	else:
+		raise ValueError("Rebinning requires a step or a number of points")
+	if (aggregate not in ("mean", "sum")):
+		raise ValueError("Unknown aggregation for rebinning: %s" % aggregate)
+	used, bins = numpy.unique(bins, return_inverse=True)
+	bins = bins.ravel()
+	count = numpy.bincount(bins, minlength=len(used))
+	rebinned = numpy.empty((len(used), thisdata.shape[1]))
+	intensity = numpy.bincount(bins, weights=thisdata[:,2], minlength=len(used))
+	rebinned[:,2] = intensity / count if (aggregate == "mean") else intensity
+	meantwotheta = numpy.bincount(bins, weights=twotheta, minlength=len(used)) / count
+	if (thisdata.shape[1] > 3):
+		# Closest point to the mean 2theta of each bin: first point of each bin when sorted by bin then distance
+		order = numpy.lexsort((numpy.abs(twotheta - meantwotheta[bins]), bins))
+		first = order[numpy.searchsorted(bins[order], numpy.arange(len(used)))]
+		rebinned[:,0] = twotheta[first]
+		rebinned[:,1] = thisdata[first,1]
+		rebinned[:,3:] = thisdata[first,3:]
+	else:
+		rebinned[:,0] = meantwotheta
+		rebinned[:,1] = numpy.bincount(bins, weights=thisdata[:,1], minlength=len(used)) / count
+	return rebinned
+
+def recalibrateTwoTheta(thisdata, detparams):
+	"""
+	Recompute 2theta from the detector positions using detector parameters in the format of EsgDataset.fromFile, 
+	["flatTransmission", distance] or ["inclinedReflection", distance, 2theta, tilt, rotation, eta]
+	"""
+	thisdata = numpy.array(thisdata, dtype=float)
+	if (thisdata.size == 0):
+		return thisdata
+	if (detparams[0] == "inclinedReflection"):
+		detector = AngularInclinedFlatImageCalibration(detparams[1], 0., 0., detparams[2], detparams[3], detparams[4], detparams[5])
+		thisdata[:,0] = twoThetaCache.get(detector, thisdata[:,1], thisdata[:,3])
+	else:
+		thisdata[:,0] = numpy.degrees(numpy.arctan(thisdata[:,1]/detparams[1]))
+	return thisdata
+
+def applyRecipeToBlock(thisdata, i, steps, esgtype):
+	"""
+	Apply the steps of a recipe to the data of azimuth number i, see the section on edit recipes for the list of steps.
+	Steps for other azimuths are ignored. Returns a new array, or the original one if nothing was changed
+	"""
+	thisdata = numpy.asarray(thisdata, dtype=float)
+	for step in steps:
+		edit = step["edit"]
+		if (edit == "removePoints"):
+			if (step["eta"] == i):
+				thisdata = removeRectangle(thisdata, step["min2theta"], step["max2theta"], unbounded(step.get("minintensity"), -numpy.inf), unbounded(step.get("maxintensity"), numpy.inf))
+		elif (edit == "mask"):
+			for item in step["mask"]:
+				if (not item["set"]):
+					continue
+				if ("detector" in item):
+					thisdata = removeDetectorRegion(thisdata, item)
+				elif (item["eta"] == i):
+					thisdata = removeTwoThetaRange(thisdata, item["clear2thetamin"], item["clear2thetamax"])
+		elif (edit == "crop"):
+			thisdata = restrictTwoThetaRange(thisdata, step["min2theta"], step["max2theta"])
+		elif (edit == "shift"):
+			if (step.get("eta") in (None, i)):
+				thisdata = shiftIntensity(thisdata, step["shift"])
+		elif (edit == "setMinimum"):
+			thisdata = setMinimumIntensity(thisdata, step["minimum"])
+		elif (edit == "subtractBackground"):
+			if (step["eta"] == i):
+				thisdata = subtractLinearBackground(thisdata, step["x"], step["y"])
+		elif (edit == "subtractBaseline"):
+			if (step.get("eta") in (None, i)):
+				thisdata = subtractBaseline(thisdata, step["width"], step["gap"])
+		elif (edit == "rebin"):
+			thisdata = rebinTwoTheta(thisdata, step.get("step"), step.get("maxpoints"), step.get("aggregate", "mean"))
+		elif (edit == "recalibrate"):
+			thisdata = recalibrateTwoTheta(thisdata, step["detparams"])
+		elif (edit == "recipe"):
+			thisdata = applyRecipeToBlock(thisdata, i, step["steps"], esgtype)
+		else:
+			raise ValueError("Unknown edit: %s" % edit)
+	return thisdata
+
+def streamEsg(infilename, outfilename, steps, detparams=None, progress=None):
+	"""
+	Applies a recipe to an ESG file and saves the result, one azimuth at a time. Memory use is bounded by the largest
+	azimuth, not by the size of the file. See the section on edit recipes for the list of steps.
+	
+	detparams is required for inclined detectors: ["inclinedReflection", distance, 2theta, tilt, rotation, eta] as in EsgDataset.fromFile
+	progress is an optional function, see writeEsgBlocks. Returns the number of azimuths, or False if cancelled
+	
+	As in EsgDataset.save, azimuths not changed by any step are copied from the original file byte for byte
+	"""
+	if (recipeNeedsEtas(steps)):
+		# Masks are moved to the azimuths of this file, we need all eta angles first
+		steps = remapRecipe(steps, esgEtas(infilename))
+	f = openEsgFile(infilename, 'rb')
+	# Second handle to copy unchanged azimuths, always reading forward so that compressed files are read only once
+	source = openEsgFile(infilename, 'rb')
+	try:
+		state = {"detector": None, "detdistance": 200., "n": 0}
+		def blocks():
+			for header, eta, esgtype, values, offsets in readEsgBlocks(f, True):
+				if (state["n"] == 0):
+					if (headerValue(header, "_pd_instr_dist_spec/detc") != None):
+						state["detdistance"] = float(headerValue(header, "_pd_instr_dist_spec/detc"))
+					if (esgtype == "inclinedReflection"):
+						if ((detparams == None) or (detparams[0] != "inclinedReflection")):
+							raise ValueError("Detector angles are needed for data from an inclined reflection detector")
+						state["detdistance"] = detparams[1]
+						state["detector"] = AngularInclinedFlatImageCalibration(detparams[1], 0., 0., detparams[2], detparams[3], detparams[4], detparams[5])
+				original = esgBlockData(values, esgtype, state["detdistance"], state["detector"])
+				if (state["n"] == 0):
+					checkRecipe(steps, esgtype)
+				thisdata = applyRecipeToBlock(original, state["n"], steps, esgtype)
+				state["n"] += 1
+				if (thisdata is original):
+					yield from copyEsgBlocks(source, [offsets])
+				else:
+					yield formatEsgBlock(header, thisdata, esgtype)
+		if (not writeEsgBlocks(outfilename, blocks(), progress)):
+			return False
+	finally:
+		f.close()
+		source.close()
+	return state["n"]
+
+def saveMaskToFile(mask, filename):
+	string = "# Version: 1.2\n# Mask for maudESGEdit\n# Each line: azimuth number, 2theta range to remove, eta of the azimuth and width of its sector (? if unknown)\n# Regions in detector space, if any: shape and detector x y positions\n# Looks a bit like a cif file, but not a true CIF\n#\n"
+	string += "\nloop_\n_esg_azimuth_number _esg_2theta_delete_min _esg_2theta_delete_max _esg_azimuth_eta _esg_azimuth_eta_width\n"
+	items = []
+	regions = []
+	# Creation command was self.mask.append({"set":True, "eta": self.etaToPlot, "clear2thetamin": left, "clear2thetamax": right})
+	# Removing empty items, detector regions are saved in their own loop
+	for item in mask:
+		if (item["set"] and ("detector" in item)):
+			regions.append(item)
+		elif (item["set"]):
+			items.append(item)
+	# Sorting mask
+	items = sorted(items, key=lambda d: (d['eta'],d['clear2thetamin'])) 
+	# Adding to string
+	for item in items:
+		etaangle = "?" if (item.get("etaangle") == None) else "%f" % item["etaangle"]
+		etawidth = "?" if (item.get("etawidth") == None) else "%f" % item["etawidth"]
+		string += "%i %f %f %s %s\n" % (item["eta"], item["clear2thetamin"], item["clear2thetamax"], etaangle, etawidth)
+	string += "\n"
+	if (len(regions) > 0):
+		# Each line: shape and detector x y positions, two corners for a rectangle, the vertices of a polygon
+		string += "loop_\n_esg_detector_region _esg_detector_xy\n"
+		for item in regions:
+			string += item["detector"] + "".join(" %f %f" % xy for xy in zip(item["x"], item["y"])) + "\n"
+		string += "\n"
+	# Ready to save
+	f = open(filename, 'w')
+	f.write(string)
+	f.close()
+	return
+
+def loadMaskFromFile(filename):
+	mask = []
+	# Read the Mask file, Reads all the lines and saves it to the array "content"
+	f = open(filename, 'r')
+	logcontent = [line.strip() for line in f.readlines()]
+	f.close()
+	# Locating mask data. They start with _esg_azimuth_number. We look for lines with this
+	lookup = "_esg_azimuth_number"
+	linesdb = []
+	for num, line in enumerate(logcontent, 0):
+		if lookup in line:
+			linesdb.append(num)
+	for linestart in linesdb:
+		line = linestart + 1 # Starting 3 lines below marker
+		test = True
+		while test:
+			elts = (logcontent[line]).split()
+			if (len(elts) < 3):
+				test = False # We reached the end
+			else:
+				# We search for information we need
+				item = {"set":True, "eta": int(elts[0]), "clear2thetamin": float(elts[1]), "clear2thetamax": float(elts[2])}
+				if ((len(elts) > 3) and (elts[3] != "?")):
+					item["etaangle"] = float(elts[3])
+				if ((len(elts) > 4) and (elts[4] != "?")):
+					item["etawidth"] = float(elts[4])
+				mask.append(item)
+			line += 1
+	# Regions in detector space
+	for num, line in enumerate(logcontent, 0):
+		if ("_esg_detector_region" in line):
+			for txt in logcontent[num+1:]:
+				elts = txt.split()
+				if ((len(elts) < 5) or (elts[0] not in detectorRegionShapes)):
+					break
+				xy = [float(v) for v in elts[1:]]
+				mask.append(detectorRegion(elts[0], xy[0::2], xy[1::2]))
+	return mask
+
+#################################################################
+#
+# Masks in detector space, for inclined reflection detectors
+#
+# Detector gaps are at fixed x and y positions on the detector. Regions are saved in masks along with 2theta ranges,
+# as {"set": True, "detector": shape, "x": [..], "y": [..]}, and applied to all azimuths
+#   - shape "rectangle": x and y are the [min, max] of the rectangle
+#   - shape "polygon": x and y are the positions of the vertices, 3 or more
+#
+#################################################################
+
+detectorRegionShapes = ["rectangle", "polygon"]
+
+def detectorRegion(shape, x, y):
+	"""
+	Mask item for a region in detector space. Raises ValueError if the region is not valid
+	"""
+	if (shape not in detectorRegionShapes):
+		raise ValueError("Unknown detector region: %s" % shape)
+	if (len(x) != len(y)):
+		raise ValueError("Detector region needs as many x as y positions")
+	if ((shape == "rectangle") and (len(x) != 2)):
+		raise ValueError("Detector rectangle needs two corners")
+	if ((shape == "polygon") and (len(x) < 3)):
+		raise ValueError("Detector polygon needs at least 3 vertices")
+	x = [float(v) for v in x]
+	y = [float(v) for v in y]
+	if (shape == "rectangle"):
+		x = sorted(x)
+		y = sorted(y)
+	return {"set": True, "detector": shape, "x": x, "y": y}
+
+def pointsInPolygon(x, y, px, py):
+	"""
+	True for points (x, y) inside the polygon with vertices (px, py), even-odd rule. Vectorized over points, loops over edges
+	"""
+	x = numpy.asarray(x, dtype=float)
+	y = numpy.asarray(y, dtype=float)
+	inside = numpy.zeros(x.shape, dtype=bool)
+	n = len(px)
+	for k in range(0,n):
+		x1, y1 = px[k], py[k]
+		x2, y2 = px[(k+1) % n], py[(k+1) % n]
+		if (y1 == y2):
+			continue
+		crosses = (y1 > y) != (y2 > y)
+		inside ^= crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+	return inside
+
+def removeDetectorRegion(thisdata, item):
+	"""
+	Remove data points with detector positions within a region, see detectorRegion. Data need x and y positions
+	"""
+	thisdata = numpy.asarray(thisdata, dtype=float)
+	if (thisdata.size == 0):
+		return numpy.array(thisdata)
+	if (thisdata.shape[1] < 4):
+		raise ValueError("Masks in detector space require x and y positions, from an inclined reflection detector")
+	x = thisdata[:,1]
+	y = thisdata[:,3]
+	if (item["detector"] == "rectangle"):
+		inside = (x >= item["x"][0]) & (x <= item["x"][1]) & (y >= item["y"][0]) & (y <= item["y"][1])
+	else:
+		inside = pointsInPolygon(x, y, item["x"], item["y"])
+	return thisdata[numpy.logical_not(inside)]
+
+
+
+#################################################################
+#
+# Masks across files with different azimuths
+#
+# 2theta ranges of a mask are saved with the number of their azimuth, "eta", the eta angle of that azimuth, "etaangle", and
+# the width of its sector, "etawidth". The sector of an azimuth extends half-way to its neighbours, see etaSectors.
+# On a file with other azimuths, ranges are moved to the azimuths with matching eta angles
+#   - "index": same azimuth number, as in older versions
+#   - "nearest": each azimuth gets the ranges of the mask azimuth with the closest eta, if it falls within its sector
+#   - "overlap": each azimuth gets the ranges of all mask azimuths whose sectors overlap its own
+# Without sector width, the median spacing between the azimuths of the file is used.
+# Ranges without eta angle, from older masks, always stay on the same azimuth number.
+#
+#################################################################
+
+maskRemapModes = ["index", "nearest", "overlap"]
+
+def etaSectors(etas):
+	"""
+	Start and width, in degrees, of the sector covered by each azimuth. A sector extends half-way to the neighbouring azimuths,
+	but not across gaps larger than twice the median spacing between azimuths. A single azimuth covers the full circle
+	"""
+	etas = numpy.asarray(etas, dtype=float)
+	if (len(etas) < 2):
+		return etas - 180., numpy.full(len(etas), 360.)
+	order = numpy.argsort(etas % 360.)
+	sortedetas = etas[order] % 360.
+	gaps = numpy.diff(numpy.concatenate((sortedetas, [sortedetas[0]+360.])))
+	positive = gaps[gaps > 0.]
+	spacing = numpy.median(positive) if (positive.size > 0) else 360.
+	halfgaps = numpy.where(gaps <= 2.*spacing, gaps/2., spacing/2.)
+	below = numpy.roll(halfgaps, 1)	# Half-gap to the previous azimuth
+	start = numpy.empty(len(etas))
+	width = numpy.empty(len(etas))
+	start[order] = sortedetas - below
+	width[order] = below + halfgaps
+	return start, width
+
+def etaWidths(etas):
+	"""
+	Width of a sector centered on each azimuth, and within the sector returned by etaSectors
+	"""
+	start, width = etaSectors(etas)
+	below = numpy.asarray(etas, dtype=float) - start
+	return 2.*numpy.minimum(below, width-below)
+
+def etaLookup(maskSectors, etas, mode):
+	"""
+	For each distinct (eta angle, sector width) of a mask, the list of azimuths of a file, with eta angles etas, that receive
+	its ranges. Widths set to None are replaced by the median spacing between azimuths of the file
+	"""
+	maskSectors = sorted(set(maskSectors), key=lambda sector: (sector[0], -1. if (sector[1] == None) else sector[1]))
+	lookup = dict((sector, []) for sector in maskSectors)
+	etas = numpy.asarray(etas, dtype=float)
+	if ((len(maskSectors) == 0) or (len(etas) == 0)):
+		return lookup
+	maskEtas = numpy.array([sector[0] for sector in maskSectors], dtype=float)
+	maskWidths = numpy.array([numpy.nan if (sector[1] == None) else sector[1] for sector in maskSectors], dtype=float)
+	maskWidths[numpy.isnan(maskWidths)] = numpy.median(etaSectors(etas)[1])
+	eps = 1.e-9
+	if (mode == "nearest"):
+		distance = numpy.abs(wrapAngle(etas[:,None] - maskEtas[None,:]))
+		distance[distance > maskWidths[None,:]/2. + eps] = numpy.inf
+		nearest = numpy.argmin(distance, axis=1)
+		for i, k in enumerate(nearest):
+			if (numpy.isfinite(distance[i,k])):
+				lookup[maskSectors[k]].append(i)
+	elif (mode == "overlap"):
+		maskStart = maskEtas - maskWidths/2.
+		start, width = etaSectors(etas)
+		overlap = (((maskStart[None,:] - start[:,None]) % 360. < width[:,None] - eps) |
+			((start[:,None] - maskStart[None,:]) % 360. < maskWidths[None,:] - eps))
+		for i, k in zip(*numpy.nonzero(overlap)):
+			lookup[maskSectors[k]].append(int(i))
+	else:
+		raise ValueError("Unknown mask remapping: %s" % mode)
+	return lookup
+
+def maskItemHasEta(item):
+	"""
+	True for 2theta ranges saved with their eta angle, the only mask items that can be moved by eta
+	"""
+	return (("detector" not in item) and (item.get("etaangle") != None))
+
+def remapMask(mask, etas, mode="nearest"):
+	"""
+	Mask with 2theta ranges moved to the azimuths of a file with eta angles etas (numbers or strings), see above.
+	Detector regions apply to all azimuths and are kept as they are
+	"""
+	moved = [item for item in mask if maskItemHasEta(item)]
+	if ((mode == "index") or (len(moved) == 0)):
+		return list(mask)
+	if (any((e == None) for e in etas)):
+		raise ValueError("Azimuths without eta angle, masks can not be moved by eta")
+	etas = [float(e) for e in etas]
+	sector = lambda item: (float(item["etaangle"]), None if (item.get("etawidth") == None) else float(item["etawidth"]))
+	lookup = etaLookup([sector(item) for item in moved], etas, mode)
+	widths = etaWidths(etas)
+	remapped = []
+	for item in mask:
+		if (("detector" in item) or (item.get("etaangle") == None)):
+			remapped.append(item)
+			continue
+		for i in lookup[sector(item)]:
+			newitem = dict(item)
+			newitem["eta"] = i
+			newitem["etaangle"] = etas[i]
+			newitem["etawidth"] = float(widths[i])
+			remapped.append(newitem)
+	return remapped
+
+def remapRecipe(steps, etas):
+	"""
+	Recipe with mask steps remapped to the azimuths of a file with eta angles etas, see remapMask. Masks are remapped
+	according to the "remap" entry of their step, "index" if not set
+	"""
+	remapped = []
+	for step in steps:
+		if (step["edit"] == "recipe"):
+			step = {"edit": "recipe", "steps": remapRecipe(step["steps"], etas)}
+		elif ((step["edit"] == "mask") and (step.get("remap", "index") != "index")):
+			step = {"edit": "mask", "mask": remapMask(step["mask"], etas, step["remap"])}
+		remapped.append(step)
+	return remapped
+
+def recipeNeedsEtas(steps):
+	"""
+	True if masks in a recipe are remapped by eta angle and have ranges saved with their eta angle
+	"""
+	return any(((step["edit"] == "mask") and (step.get("remap", "index") != "index") and any(maskItemHasEta(item) for item in step["mask"])) for step in flattenRecipe(steps))
+
+def esgEtas(filename):
+	"""
+	Eta angles of all azimuths of an ESG file, as strings, reading one azimuth at a time
+	"""
+	f = openEsgFile(filename, 'r')
+	try:
+		return [eta for header, eta, esgtype, values in readEsgBlocks(f)]
+	finally:
+		f.close()
+
+
+#################################################################
+#
+# Edit recipes
+#
+# A recipe is a list of edits, saved with their parameters, that can be replayed on other files. Each step is a
+# dictionary with the name of the edit in "edit"
+#   {"edit": "removePoints", "eta": i, "min2theta": .., "max2theta": .., "minintensity": .., "maxintensity": ..}
+#   {"edit": "mask", "mask": [..], "remap": ..}, mask as returned by loadMaskFromFile, with 2theta ranges and regions in 
+#      detector space. remap is optional, see maskRemapModes
+#   {"edit": "crop", "min2theta": .., "max2theta": ..}
+#   {"edit": "shift", "shift": .., "eta": i}, eta is None to shift all azimuths
+#   {"edit": "setMinimum", "minimum": ..}
+#   {"edit": "subtractBackground", "eta": i, "x": [..], "y": [..]}
+#   {"edit": "subtractBaseline", "width": .., "gap": .., "eta": i}, see estimateBaseline, eta is None for all azimuths
+#   {"edit": "rebin", "step": .., "maxpoints": .., "aggregate": "mean" or "sum"}, see rebinTwoTheta, step or maxpoints is None
+#   {"edit": "recalibrate", "detparams": [..]}, detparams in the format of EsgDataset.fromFile
+#   {"edit": "recipe", "steps": [..]}, a recipe applied as a single step
+# Intensity bounds set to None are unbounded. Recipes are saved as JSON.
+#
+#################################################################
+
+recipeEdits = ["removePoints", "mask", "crop", "shift", "setMinimum", "subtractBackground", "subtractBaseline", "rebin", "recalibrate", "recipe"]
+
+def unbounded(value, default):
+	"""
+	Intensity bound of a recipe step, None means no bound
+	"""
+	if (value == None):
+		return default
+	return value
+
+def flattenRecipe(steps):
+	"""
+	Recipe with steps of type "recipe" replaced by their own steps
+	"""
+	flat = []
+	for step in steps:
+		if (step["edit"] == "recipe"):
+			flat.extend(flattenRecipe(step["steps"]))
+		else:
+			flat.append(step)
+	return flat
+
+def checkRecipe(steps, esgtype=None):
+	"""
+	Raises ValueError if a recipe has unknown edits or, if esgtype is given, calibrations for another type of detector
+	"""
+	for step in flattenRecipe(steps):
+		if (step.get("edit") not in recipeEdits):
+			raise ValueError("Unknown edit in recipe: %s" % step.get("edit"))
+		if ((esgtype != None) and (step["edit"] == "recalibrate") and (step["detparams"][0] != esgtype)):
+			raise ValueError("Recipe recalibrates a %s detector, data are from a %s detector" % (step["detparams"][0], esgtype))
+		if ((esgtype != None) and (esgtype != "inclinedReflection") and (step["edit"] == "mask") and any(("detector" in item) for item in step["mask"])):
+			raise ValueError("Masks in detector space require data from an inclined reflection detector")
+		if ((step["edit"] == "mask") and (step.get("remap", "index") not in maskRemapModes)):
+			raise ValueError("Unknown mask remapping in recipe: %s" % step.get("remap"))
+		if ((step["edit"] == "rebin") and (step.get("step") == None) and (step.get("maxpoints") == None)):
+			raise ValueError("Rebinning in recipe requires a step or a number of points")
+		if ((step["edit"] == "rebin") and (step.get("aggregate", "mean") not in ("mean", "sum"))):
+			raise ValueError("Unknown aggregation for rebinning in recipe: %s" % step.get("aggregate"))
+
+def maskFromRecipe(steps, etas=None):
+	"""
+	2theta ranges and detector regions removed by a recipe, in the format of loadMaskFromFile
+	If etas, the eta angles of the azimuths the recipe was applied to, are given, masks are remapped to these azimuths and
+	2theta ranges are saved with their eta angle and sector width
+	"""
+	if (etas != None):
+		steps = remapRecipe(steps, etas)
+		widths = etaWidths([0. if (e == None) else float(e) for e in etas])
+	mask = []
+	for step in flattenRecipe(steps):
+		if (step["edit"] == "removePoints"):
+			mask.append({"set":True, "eta": step["eta"], "clear2thetamin": step["min2theta"], "clear2thetamax": step["max2theta"]})
+		elif (step["edit"] == "mask"):
+			mask.extend(step["mask"])
+	if (etas != None):
+		mask = [item if (("detector" in item) or (item["eta"] >= len(etas)) or (etas[item["eta"]] == None)) else dict(item, etaangle=float(etas[item["eta"]]), etawidth=float(widths[item["eta"]])) for item in mask]
+	return mask
+
+def saveRecipeToFile(steps, filename):
+	recipe = {"format": "maudESGEdit recipe", "version": "1.0", "steps": flattenRecipe(steps)}
+	f = open(filename, 'w')
+	json.dump(recipe, f, indent=1)
+	f.write("\n")
+	f.close()
+	return
+
+def loadRecipeFromFile(filename):
+	f = open(filename, 'r')
+	try:
+		recipe = json.load(f)
+	finally:
+		f.close()
+	if ((not isinstance(recipe, dict)) or (recipe.get("format") != "maudESGEdit recipe")):
+		raise ValueError("%s is not a maudESGEdit recipe" % filename)
+	checkRecipe(recipe["steps"])
+	return recipe["steps"]
+
+
+#################################################################
+#
+# Journal of edits
+#
+# Each edit is appended to a journal file as soon as it is done, one JSON object per line, so that edits are not lost
+# if the program crashes before the data are saved. The first line describes the source file, the following lines are
+#   {"step": {..}}, a recipe step
+#   {"undo": true}, the last step was undone
+# Edits are recovered by applying the steps of the journal to the source file. Journals are removed when the session
+# ends normally.
+#
+#################################################################
+
+def journalDirectory():
+	return os.path.join(os.path.expanduser("~"), ".maudESGEdit", "journals")
+
+class EditJournal():
+	"""
+	Journal of the edits of one session on one ESG file. Lines are flushed to disk as they are written, a line
+	cut short by a crash is ignored when reading
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+		self.f = open(filename, 'a')
+	
+	@classmethod
+	def start(cls, esg, directory=None):
+		"""
+		New journal for the edits of esg, read from a file, in directory (journalDirectory by default)
+		"""
+		if (directory == None):
+			directory = journalDirectory()
+		os.makedirs(directory, exist_ok=True)
+		source = os.path.abspath(esg.filename)
+		stat = os.stat(source)
+		name = "%s-%s-%d.jsonl" % (os.path.basename(source), time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+		journal = cls(os.path.join(directory, name))
+		journal.write({"format": "maudESGEdit journal", "version": "1.0", "source": source, "size": stat.st_size, "mtime": stat.st_mtime,
+			"detparams": esg.detparams(), "date": time.strftime("%Y-%m-%d %H:%M:%S"), "pid": os.getpid()})
+		return journal
+	
+	def write(self, entry):
+		self.f.write(json.dumps(entry) + "\n")
+		self.f.flush()
+		os.fsync(self.f.fileno())
+	
+	def append(self, step):
+		self.write({"step": step})
+	
+	def undo(self):
+		self.write({"undo": True})
+	
+	def close(self, remove=True):
+		"""
+		Ends the journal. The file is removed unless remove is False
+		"""
+		self.f.close()
+		if (remove):
+			os.remove(self.filename)
+
+def readJournal(filename):
+	"""
+	Header and recipe steps of a journal, with undone steps removed. Raises ValueError if the file is not a journal
+	"""
+	f = open(filename, 'r')
+	try:
+		lines = f.read().split("\n")
+	finally:
+		f.close()
+	try:
+		header = json.loads(lines[0])
+	except ValueError:
+		header = None
+	if ((not isinstance(header, dict)) or (header.get("format") != "maudESGEdit journal")):
+		raise ValueError("%s is not a maudESGEdit journal" % filename)
+	steps = []
+	for line in lines[1:]:
+		try:
+			entry = json.loads(line)
+		except ValueError:
+			break	# End of file, or a line cut short by a crash
+		if (not isinstance(entry, dict)):
+			break
+		if ("step" in entry):
+			steps.append(entry["step"])
+		elif (entry.get("undo") and (len(steps) > 0)):
+			steps.pop()
+	return header, steps
+
+def processIsRunning(pid):
+	"""
+	True if a process with id pid is running. Also True when this can not be told, journals are then left alone
+	"""
+	if (pid == os.getpid()):
+		return True
+	if (os.name == "nt"):
+		# os.kill would terminate the process on Windows
+		import ctypes
+		kernel32 = ctypes.windll.kernel32
+		handle = kernel32.OpenProcess(0x1000, False, pid)	# PROCESS_QUERY_LIMITED_INFORMATION
+		if (not handle):
+			return (kernel32.GetLastError() == 5)	# Access denied, the process exists
+		code = ctypes.c_ulong()
+		ok = kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+		kernel32.CloseHandle(handle)
+		return ((not ok) or (code.value == 259))	# STILL_ACTIVE
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except OSError:
+		return True
+	return True
+
+def journalProcess(filename, header):
+	"""
+	Id of the process that wrote a journal, from its header or, for older journals, from its file name. None if unknown
+	"""
+	if (isinstance(header.get("pid"), int)):
+		return header["pid"]
+	match = re.search(r"-(\d+)\.jsonl$", filename)
+	return int(match.group(1)) if match else None
+
+def findJournals(directory=None):
+	"""
+	Journals left in directory (journalDirectory by default) by sessions that did not end normally, most recent first,
+	as a list of (filename, header, steps). Journals of sessions still running, in other windows, are skipped
+	"""
+	if (directory == None):
+		directory = journalDirectory()
+	if (not os.path.isdir(directory)):
+		return []
+	journals = []
+	for name in os.listdir(directory):
+		filename = os.path.join(directory, name)
+		if (not name.endswith(".jsonl")):
+			continue
+		try:
+			header, steps = readJournal(filename)
+		except (IOError, ValueError):
+			continue
+		pid = journalProcess(filename, header)
+		if ((pid != None) and processIsRunning(pid)):
+			continue
+		journals.append((os.path.getmtime(filename), filename, header, steps))
+	journals.sort(key=lambda j: j[0], reverse=True)
+	return [j[1:] for j in journals]
+
+def journalSourceIsUnchanged(header):
+	"""
+	True if the source file of a journal still exists, with the same size and modification time
+	"""
+	try:
+		stat = os.stat(header["source"])
+	except OSError:
+		return False
+	return ((stat.st_size == header["size"]) and (stat.st_mtime == header["mtime"]))
+
+#################################################################
+#
+# Columnar export, to NPZ or HDF5
+#
+# Data of all azimuths are concatenated in one array per column: twotheta, intensity, x, and y for inclined detectors. 
+# Data of azimuth i are in the range offsets[i]:offsets[i+1] of each column. Other entries are eta (as numbers), etastring,
+# headers, esgtype, and detparams (detector distance and angles). For instance
+#
+#	data = numpy.load("data.npz")
+#	o = data["offsets"]
+#	twotheta, intensity = data["twotheta"][o[i]:o[i+1]], data["intensity"][o[i]:o[i+1]]
+#
+# Columns are written one azimuth at a time, without building the concatenated arrays in memory.
+#
+#################################################################
+
+# Columns of the export, with their index in the data arrays of EsgDataset
+exportColumns = {"flatTransmission": [("twotheta", 0), ("intensity", 2), ("x", 1)], "inclinedReflection": [("twotheta", 0), ("intensity", 2), ("x", 1), ("y", 3)]}
+
+def exportMetadata(esg):
+	"""
+	Entries other than the data columns, as numpy arrays
+	"""
+	etas = []
+	for eta in esg.etas:
+		try:
+			etas.append(float(eta))
+		except (TypeError, ValueError):
+			etas.append(numpy.nan)
+	sizes = [len(thisdata) for thisdata in esg.data]
+	return {
+		"offsets": numpy.concatenate(([0], numpy.cumsum(sizes))).astype(numpy.int64),
+		"eta": numpy.array(etas, dtype=float),
+		"etastring": numpy.array([str(eta) for eta in esg.etas], dtype=str),
+		"headers": numpy.array(esg.headers, dtype=str),
+		"esgtype": numpy.array(esg.esgtype, dtype=str),
+		"detparams": numpy.array(esg.detparams()[1:], dtype=float),
+	}
+
+def exportNpzFile(esg, f, progress=None):
+	"""
+	Writes an EsgDataset to an open binary file in NPZ format. Returns False if cancelled by progress, see exportColumnar
+	"""
+	columns = exportColumns[esg.esgtype]
+	metadata = exportMetadata(esg)
+	npoints = int(metadata["offsets"][-1])
+	nsteps = len(columns) * len(esg.data)
+	step = 0
+	with zipfile.ZipFile(f, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+		for name, value in metadata.items():
+			with archive.open(name + ".npy", 'w', force_zip64=True) as entry:
+				numpy.lib.format.write_array(entry, value, allow_pickle=False)
+		for name, column in columns:
+			with archive.open(name + ".npy", 'w', force_zip64=True) as entry:
+				numpy.lib.format.write_array_header_1_0(entry, {"descr": numpy.lib.format.dtype_to_descr(numpy.dtype('<f8')), "fortran_order": False, "shape": (npoints,)})
+				for thisdata in esg.data:
+					if (len(thisdata) > 0):
+						entry.write(numpy.ascontiguousarray(thisdata[:,column], dtype='<f8').tobytes())
+					step += 1
+					if ((progress != None) and (progress(step,nsteps) == False)):
+						return False
+	return True
+
+def exportHdf5File(esg, filename, progress=None):
+	"""
+	Writes an EsgDataset to an HDF5 file, with chunked datasets. Requires h5py. Returns False if cancelled by progress, see exportColumnar
+	"""
+	columns = exportColumns[esg.esgtype]
+	metadata = exportMetadata(esg)
+	offsets = metadata["offsets"]
+	npoints = int(offsets[-1])
+	with h5py.File(filename, 'w') as f:
+		for name in ["offsets", "eta", "detparams"]:
+			f.create_dataset(name, data=metadata[name])
+		for name in ["etastring", "headers"]:
+			f.create_dataset(name, data=[str(value) for value in metadata[name]], dtype=h5py.string_dtype())
+		f.attrs["esgtype"] = esg.esgtype
+		chunks = (min(npoints,65536),) if (npoints > 0) else None
+		datasets = [(f.create_dataset(name, shape=(npoints,), dtype='<f8', chunks=chunks), column) for name, column in columns]
+		for i in range(0,len(esg.data)):
+			if (len(esg.data[i]) > 0):
+				for dataset, column in datasets:
+					dataset[offsets[i]:offsets[i+1]] = esg.data[i][:,column]
+			if ((progress != None) and (progress(i+1,len(esg.data)) == False)):
+				return False
+	return True
+
+def exportColumnar(esg, filename, progress=None):
+	"""
+	Exports an EsgDataset in columnar format, see above. Format is chosen from the extension: .npz, or .h5 and .hdf5 with h5py
+	
+	The file is first written to a temporary file in the same directory and moved in place once complete, as in writeEsgBlocks.
+	progress is an optional function, called as progress(i,n) as data are written. If it returns False, the export is 
+	cancelled and the function returns False
+	"""
+	ext = (os.path.splitext(filename)[1]).lower()
+	if (ext in [".h5", ".hdf5"]):
+		if (h5py == None):
+			raise ValueError("Export to HDF5 requires h5py, please install it or export to NPZ")
+	elif (ext != ".npz"):
+		raise ValueError("Unknown export format %s, use .npz, .h5, or .hdf5" % ext)
+	directory, name = os.path.split(os.path.abspath(filename))
+	tmpname = os.path.join(directory, ".%s.%s" % (os.urandom(4).hex(), name))
+	try:
+		if (ext == ".npz"):
+			f = open(tmpname, 'xb')
+			try:
+				ok = exportNpzFile(esg, f, progress)
+			finally:
+				f.close()
+		else:
+			ok = exportHdf5File(esg, tmpname, progress)
+		if (ok):
+			os.replace(tmpname, filename)
+	finally:
+		if os.path.exists(tmpname):
+			os.remove(tmpname)
+	return ok
+
+#################################################################
+#
+# Class dedicated to Inclined Reflection Image
+#  Build from the MAUD source code at https://github.com/luttero/maud/
+#      - maud/src/it/unitn/ing/rista/diffr/cal/AngularInclinedFlatImageCalibration.java
+#      - maud/src/it/unitn/ing/rista/util/ConvertImageToSpectra.java
+#
+#################################################################
+
+class  AngularInclinedFlatImageCalibration():
+	def __init__(self, detectorDistance, centerX, centerY, detector2Theta, detectorPhiDA, detectorOmegaDN, detectorEtaDA):
+		"""
+		Send
+		- detector distance, center X and Y (in mm), as in MAUD
+		- detector angles in degrees: detector2Theta, detectorPhiDA, detectorOmegaDN, detectorEtaDA
+		"""
+		self.detectorDistance = detectorDistance
+		self.centerX = centerX
+		self.centerY = centerY
+		self.detector2Theta = detector2Theta
+		self.detectorPhiDA = detectorPhiDA
+		self.detectorOmegaDN = detectorOmegaDN
+		self.detectorEtaDA = detectorEtaDA
+		# Built t-matrix (used for calculations of 2 theta)
+		self.builtTMatrix()
+		
+	def builtTMatrix(self):
+		"""
+		Builds a transformation matrix based on detector orientation 
+		Created based on getTransformationMatrixNew from maud/src/it/unitn/ing/rista/util/ConvertImageToSpectra.java
+		"""
+		omegaDN = numpy.radians(self.detectorOmegaDN)
+		phiDA = numpy.radians(self.detectorPhiDA)
+		etaDA = numpy.radians(self.detectorEtaDA)
+		theta2DET = numpy.radians(self.detector2Theta)
+		# omega = 0.0 # Additional corrections from tilting angle I think. Leave it for now. Not even used in MAUD
+		cosOmegaDN = math.cos(omegaDN);
+		sinOmegaDN = math.sin(omegaDN);
+		cosPhiDA = math.cos(phiDA);
+		sinPhiDA = math.sin(phiDA);
+		cosTheta2DET = math.cos(theta2DET);
+		sinTheta2DET = math.sin(theta2DET);
+		cosEtaDA = math.cos(etaDA);
+		sinEtaDA = math.sin(etaDA);
+		a = numpy.array([[0.,0.,-1], [sinOmegaDN, cosOmegaDN, 0], [cosOmegaDN,  -sinOmegaDN, 0]])
+		# print("Omega detector rotation: ", a)
+		b = numpy.array([[cosPhiDA, sinPhiDA, 0], [-sinPhiDA, cosPhiDA, 0], [0, 0, 1]])
+		# print("Phi detector rotation: ", b)
+		tmat = numpy.dot(b,a)
+		a = numpy.array([[cosTheta2DET, 0, sinTheta2DET], [0, 1, 0], [-sinTheta2DET, 0, cosTheta2DET]])
+		# print("Two theta detector rotation: ", a)
+		b =  numpy.dot(a,tmat)
+		a = numpy.array([[1,0,0],[0, cosEtaDA, sinEtaDA], [0, -sinEtaDA, cosEtaDA]])
+		# print("Eta detector rotation: ", a)
+		self.tmat = numpy.dot(a,b)
+		# print("Full rotation", self.tmat)
+	
+	def get2ThetaFromXf(self,xf):
+		"""
+		Calculate 2theta from the coordinates for a detector position, after calibration
+		Build according maud/src/it/unitn/ing/rista/util/ConvertImageToSpectra.java
+  		Calculation of eta in addition to 2theta could be extracted from line 793 in https://github.com/luttero/maud/blob/version2/src/it/unitn/ing/rista/util/ConvertImageToSpectra.java
+		"""
+		z2 = xf[2,0]*xf[2,0]
+		y2 = xf[1,0]*xf[1,0]
+		x2 = xf[0,0]*xf[0,0]
+		a = math.sqrt(z2+y2)
+		if (abs(a) < 1.E-18):
+			return 0.
+		b = math.sqrt(x2+y2+z2)
+		twotetha = math.asin(a/b)
+		if (xf[0,0] > 0.):
+			twotetha = math.pi - twotetha
+		return twotetha
+	
+	def twoThetaFromXY(self,x,y):
+		# Convert x and y to position in real space, using detector calibration
+		xf = numpy.array([[x-self.centerX],[y-self.centerY],[self.detectorDistance]])
+		xf = numpy.dot(self.tmat,xf)
+		# Get 2 theta from xf
+		twothetadegrees = numpy.degrees(self.get2ThetaFromXf(xf))
+		return twothetadegrees
+	
+	def transformXYArray(self,x,y):
+		"""
+		Converts numpy arrays of x and y positions to positions in real space, using detector calibration. Returns a 3xN array
+		"""
+		x = numpy.asarray(x, dtype=float)
+		y = numpy.asarray(y, dtype=float)
+		xf = numpy.vstack((x-self.centerX, y-self.centerY, numpy.full(x.shape, self.detectorDistance)))
+		return numpy.dot(self.tmat,xf)
+	
+	def twoThetaFromXYArray(self,x,y):
+		"""
+		Same as twoThetaFromXY, for numpy arrays of x and y positions. Returns an array of 2theta values, in degrees
+		"""
+		xf = self.transformXYArray(x,y)
+		a = numpy.sqrt(xf[2]*xf[2]+xf[1]*xf[1])
+		b = numpy.sqrt(xf[0]*xf[0]+xf[1]*xf[1]+xf[2]*xf[2])
+		twotetha = numpy.arcsin(a/b)
+		twotetha = numpy.where(xf[0] > 0., math.pi - twotetha, twotetha)
+		twotetha[numpy.abs(a) < 1.E-18] = 0.
+		return numpy.degrees(twotetha)
+	
+	def twoThetaEtaFromXYArray(self,x,y):
+		"""
+		Same as twoThetaFromXYArray, but also returns eta, the azimuth around the incident beam, calculated from the same transformed vector
+		Eta is in degrees, between -180 and 180, measured from the detector horizontal axis. Its origin and direction may differ from the
+		convention used in the ESG file, see etaConventionFromBlocks
+		"""
+		xf = self.transformXYArray(x,y)
+		a = numpy.sqrt(xf[2]*xf[2]+xf[1]*xf[1])
+		b = numpy.sqrt(xf[0]*xf[0]+xf[1]*xf[1]+xf[2]*xf[2])
+		twotetha = numpy.arcsin(a/b)
+		twotetha = numpy.where(xf[0] > 0., math.pi - twotetha, twotetha)
+		twotetha[numpy.abs(a) < 1.E-18] = 0.
+		eta = numpy.arctan2(xf[1], xf[2])
+		return numpy.degrees(twotetha), numpy.degrees(eta)
+	
+	def getParameters(self):
+		"""
+		Returns all calibration parameters, as a tuple
+		"""
+		return (self.detectorDistance, self.centerX, self.centerY, self.detector2Theta, self.detectorPhiDA, self.detectorOmegaDN, self.detectorEtaDA)
+
+
+#################################################################
+#
+# Cache for 2theta values on inclined detectors
+#
+# Files collected with the same detector setup share the same grids of x and y positions. 2theta values are saved 
+# for each calibration and grid of x and y positions, so that they are not calculated again.
+#
+#################################################################
+
+class TwoThetaCache():
+	def __init__(self, maxpoints=5000000):
+		"""
+		Send the maximum number of 2theta values to keep in memory. Oldest items are discarded first
+		"""
+		self.maxpoints = maxpoints
+		self.npoints = 0
+		self.items = collections.OrderedDict()
+		self.lock = threading.Lock()
+	
+	def get(self, detector, x, y):
+		"""
+		Returns 2theta (in degrees, as a read-only array) for arrays of x and y positions on a detector of class AngularInclinedFlatImageCalibration
+		"""
+		x = numpy.ascontiguousarray(x, dtype=float)
+		y = numpy.ascontiguousarray(y, dtype=float)
+		key = (detector.getParameters(), x.size, hashlib.sha1(x.tobytes()).digest(), hashlib.sha1(y.tobytes()).digest())
+		with self.lock:
+			twotheta = self.items.get(key)
+			if (twotheta is not None):
+				self.items.move_to_end(key)
+				return twotheta
+		twotheta = detector.twoThetaFromXYArray(x,y)
+		twotheta.setflags(write=False)
+		with self.lock:
+			if (key not in self.items):
+				self.items[key] = twotheta
+				self.npoints += twotheta.size
+			while ((self.npoints > self.maxpoints) and (len(self.items) > 1)):
+				oldkey, old = self.items.popitem(last=False)
+				self.npoints -= old.size
+		return twotheta
+	
+	def clear(self):
+		with self.lock:
+			self.items.clear()
+			self.npoints = 0
+
+twoThetaCache = TwoThetaCache()
+
+#################################################################
+#
+# Refinement of detector angles for inclined detectors
+#
+# Data points of a diffraction peak are at fixed x and y positions on the detector. With the right detector geometry,
+# the peak is at the same 2theta at all azimuths: Debye rings are straight in a plot of 2theta against azimuth. 
+# Points of each peak are selected within a 2theta range, and the position of the peak at each azimuth is the
+# intensity-weighted mean 2theta of its points. The geometry is refined to minimize the scatter of these positions
+# around their mean, or around a known 2theta if one is given. Points are selected again with the refined geometry, 
+# and the refinement repeated, until the scatter does not improve, so that peaks cut by the ranges at first are recovered.
+#
+#################################################################
+
+# Detector parameters that can be refined, in the order of detparams, after the detector type
+calibrationParameters = ["distance", "2theta", "tilt", "rotation", "eta"]
+# Parameters that the straightness of the rings does not pin down, they need at least one peak with a known 2theta
+absoluteCalibrationParameters = ["distance", "2theta"]
+
+class DebyeRingFit():
+	"""
+	Send the data of all azimuths, detparams ["inclinedReflection", distance, 2theta, tilt, rotation, eta] used to
+	select the points of each peak, and peaks as a list of (min2theta, max2theta, known2theta), known2theta is None if unknown
+	"""
+	def __init__(self, data, detparams, peaks):
+		self.detparams = list(detparams)
+		detector = AngularInclinedFlatImageCalibration(detparams[1], 0., 0., *detparams[2:6])
+		x = []
+		y = []
+		weights = []
+		groups = []
+		self.peakOfGroup = []
+		self.known = []
+		for k, (min2theta, max2theta, known) in enumerate(peaks):
+			self.known.append(known)
+			for thisdata in data:
+				if (thisdata.size == 0):
+					continue
+				twotheta = detector.twoThetaFromXYArray(thisdata[:,1], thisdata[:,3])
+				points = thisdata[(twotheta >= min2theta) & (twotheta <= max2theta)]
+				# Peak intensity above the lowest point of the window
+				w = points[:,2] - points[:,2].min() if (len(points) > 0) else points[:,2]
+				if ((len(points) < 3) or (w.sum() <= 0.)):
+					continue
+				x.append(points[:,1])
+				y.append(points[:,3])
+				weights.append(w)
+				groups.append(numpy.full(len(points), len(self.peakOfGroup)))
+				self.peakOfGroup.append(k)
+		if (len(groups) == 0):
+			raise ValueError("No peak found in the 2theta ranges")
+		self.x = numpy.concatenate(x)
+		self.y = numpy.concatenate(y)
+		self.weights = numpy.concatenate(weights)
+		self.groups = numpy.concatenate(groups)
+		self.peakOfGroup = numpy.asarray(self.peakOfGroup)
+		self.sumWeights = numpy.bincount(self.groups, weights=self.weights)
+		self.npeaks = len(peaks)
+	
+	def positions(self, detparams):
+		"""
+		Position of each peak at each azimuth, in degrees 2theta, for a detector geometry
+		"""
+		detector = AngularInclinedFlatImageCalibration(detparams[1], 0., 0., *detparams[2:6])
+		twotheta = detector.twoThetaFromXYArray(self.x, self.y)
+		return numpy.bincount(self.groups, weights=twotheta*self.weights) / self.sumWeights
+	
+	def residuals(self, detparams):
+		"""
+		Distance of each peak position to the known 2theta of the peak, or to the mean position of the peak at all azimuths
+		"""
+		positions = self.positions(detparams)
+		residuals = numpy.empty(len(positions))
+		for k in range(0,self.npeaks):
+			inpeak = (self.peakOfGroup == k)
+			reference = self.known[k] if (self.known[k] != None) else numpy.mean(positions[inpeak])
+			residuals[inpeak] = positions[inpeak] - reference
+		return residuals
+	
+	def scatter(self, detparams):
+		"""
+		Root mean square of the residuals, in degrees 2theta
+		"""
+		return math.sqrt(numpy.mean(self.residuals(detparams)**2))
+	
+	def refine(self, free):
+		"""
+		Refines the parameters listed in free, names from calibrationParameters, with the others fixed.
+		Returns the refined detparams
+		"""
+		if (scipy == None):
+			raise ValueError("Refining the detector geometry requires scipy")
+		indices = [1+calibrationParameters.index(name) for name in free]
+		if (len(indices) == 0):
+			raise ValueError("No parameter to refine")
+		detparams = list(self.detparams)
+		def residuals(values):
+			for i, value in zip(indices, values):
+				detparams[i] = value
+			return self.residuals(detparams)
+		result = scipy.optimize.least_squares(residuals, [self.detparams[i] for i in indices], x_scale=1., method='trf')
+		residuals(result.x)
+		return ["inclinedReflection"] + [float(v) for v in detparams[1:]]
+
+#################################################################
+#
+# Azimuthal re-sectoring for inclined detectors
+#
+#################################################################
+
+def circularMean(angles, weights=None):
+	"""
+	Mean of angles in degrees, taking care of the wrap at 360 degrees
+	"""
+	angles = numpy.radians(numpy.asarray(angles, dtype=float))
+	return math.degrees(math.atan2(numpy.average(numpy.sin(angles), weights=weights), numpy.average(numpy.cos(angles), weights=weights)))
+
+def wrapAngle(angles, center=0.):
+	"""
+	Brings angles in degrees within [center-180, center+180[
+	"""
+	return (numpy.asarray(angles, dtype=float) - center + 180.) % 360. - 180. + center
+
+def etaConventionFromBlocks(blocketas, fileetas):
+	"""
+	Eta calculated from the detector calibration and eta as written in the ESG file can have different origins and directions.
+	Send the average calculated eta for each azimuth and the corresponding eta in the file. Returns sign and offset such that
+	file eta = sign * calculated eta + offset
+	"""
+	blocketas = numpy.asarray(blocketas, dtype=float)
+	fileetas = numpy.asarray(fileetas, dtype=float)
+	best = (1., 0., numpy.inf)
+	signs = [1., -1.] if (len(blocketas) > 1) else [1.]
+	for sign in signs:
+		diff = fileetas - sign*blocketas
+		offset = circularMean(diff)
+		residual = numpy.mean(numpy.abs(wrapAngle(diff-offset)))
+		if (residual < best[2]):
+			best = (sign, offset, residual)
+	return best[0], best[1]
+
+def esgHeaderWithEta(header, etastring, index):
+	"""
+	Copy of an azimuth header with a new eta (as a string) and a new block number
+	"""
+	newheader = ""
+	for txt in header.split("\n")[:-1]:
+		a = txt.split()
+		if ((len(a) > 0) and (a[0] == "_pd_meas_angle_eta") and (etastring != None)):
+			txt = "_pd_meas_angle_eta " + etastring
+		elif ((len(a) > 0) and (a[0] == "_pd_block_id")):
+			txt = re.sub(r"#\d+$", "#%d" % index, txt)
+		newheader += txt + "\n"
+	return newheader
+
+#################################################################
+#
+# Merging of adjacent azimuths
+#
+#################################################################
+
+def adjacentAzimuthGroups(nazimuths, size):
+	"""
+	Groups of size adjacent azimuths covering nazimuths azimuths. The last group can be smaller
+	"""
+	if (size < 1):
+		raise ValueError("Groups must contain at least one azimuth")
+	return [list(range(k, min(k+size, nazimuths))) for k in range(0, nazimuths, size)]
+
+def parseAzimuthGroups(text, nazimuths):
+	"""
+	Groups of azimuths from a text such as "0-3, 4-7, 8 9 10". Groups are separated by commas, each group is a list
+	of azimuth numbers or ranges separated by spaces. A single number alone, "4" for instance, means groups of 4 adjacent azimuths.
+	"""
+	text = text.strip()
+	if (re.fullmatch(r"\d+", text)):
+		return adjacentAzimuthGroups(nazimuths, int(text))
+	groups = []
+	for grouptext in text.split(","):
+		group = []
+		for item in grouptext.split():
+			match = re.fullmatch(r"(\d+)(?:-(\d+))?", item)
+			if (match == None):
+				raise ValueError("Can not understand %s in the groups of azimuths" % item)
+			first = int(match.group(1))
+			last = first if (match.group(2) == None) else int(match.group(2))
+			if ((last < first) or (last >= nazimuths)):
+				raise ValueError("Azimuths %s are not within 0-%d" % (item, nazimuths-1))
+			group += range(first, last+1)
+		if (len(group) > 0):
+			groups.append(group)
+	if (len(groups) == 0):
+		raise ValueError("No azimuths to merge")
+	return groups
+
+def mergeAzimuthData(blocks, reference, gapfactor=5.):
+	"""
+	Average of the intensities of several azimuths on the 2theta grid of the reference azimuth
+
+	Intensities of each azimuth are interpolated at the 2theta values of the reference azimuth. Each azimuth only contributes within
+	its own 2theta range, and not across gaps wider than gapfactor times its median 2theta step (removed points). Points of the grid
+	with no contribution are dropped. x (and y) positions are those of the reference azimuth, so that MAUD finds the same 2theta.
+	"""
+	refdata = blocks[reference]
+	order = numpy.argsort(refdata[:,0], kind='stable')
+	refdata = refdata[order]
+	grid = refdata[:,0]
+	total = numpy.zeros(len(grid))
+	count = numpy.zeros(len(grid))
+	for thisdata in blocks:
+		if (len(thisdata) < 2):
+			continue
+		order = numpy.argsort(thisdata[:,0], kind='stable')
+		twotheta = thisdata[order,0]
+		intensity = thisdata[order,2]
+		steps = numpy.diff(twotheta)
+		pos = numpy.clip(numpy.searchsorted(twotheta, grid, 'right'), 1, len(twotheta)-1)
+		exact = (twotheta[pos-1] == grid) | (twotheta[pos] == grid)
+		valid = (grid >= twotheta[0]) & (grid <= twotheta[-1]) & (exact | (steps[pos-1] <= gapfactor*numpy.median(steps)))
+		total[valid] += numpy.interp(grid[valid], twotheta, intensity)
+		count[valid] += 1.
+	keep = count > 0
+	merged = refdata[keep]
+	merged[:,2] = total[keep] / count[keep]
+	return merged
+
+#################################################################
+#
+# Azimuthal integration of 2D detector images
+#
+# Images are integrated into ESG data for inclined reflection detectors. Pixels are grouped in azimuthal sectors of equal
+# width and in 2theta bins. Each bin becomes one data point, with the mean intensity of its pixels at the mean detector
+# x and y positions of its pixels, so that MAUD and EsgDataset find the 2theta of the bin from these positions.
+#
+# The bin of each pixel only depends on the detector geometry. It is calculated once by ImageIntegrator, each image
+# of a series then costs a single histogram of its intensities.
+#
+# Images are read from NumPy (.npy), TIFF (requires tifffile, fabio, or Pillow), or EDF (requires fabio) files
+#
+#################################################################
+
+# Image formats, by file extension
+imageFileTypes = {".npy": "NumPy", ".tif": "TIFF", ".tiff": "TIFF", ".edf": "EDF"}
+
+def isImageFileName(filename):
+	return (os.path.splitext(filename)[1].lower() in imageFileTypes)
+
+def readImage(filename):
+	"""
+	Reads a 2D detector image, returns an array of floats with one line per row of the detector
+	"""
+	extension = os.path.splitext(filename)[1].lower()
+	if (extension == ".npy"):
+		image = numpy.load(filename)
+	elif ((extension in (".tif", ".tiff")) and (tifffile != None)):
+		image = tifffile.imread(filename)
+	elif ((extension in (".tif", ".tiff", ".edf")) and (fabio != None)):
+		image = fabio.open(filename).data
+	elif ((extension in (".tif", ".tiff")) and (PIL != None)):
+		image = PIL.Image.open(filename)
+	elif (extension in imageFileTypes):
+		raise ValueError("Reading %s images requires %s" % (imageFileTypes[extension], "fabio" if (extension == ".edf") else "tifffile, fabio, or Pillow"))
+	else:
+		raise ValueError("%s: unknown image format, use one of %s" % (filename, ", ".join(sorted(imageFileTypes))))
+	image = numpy.asarray(image, dtype=float)
+	if (image.ndim != 2):
+		raise ValueError("%s is not a 2D image" % filename)
+	return image
+
+# Header of integrated azimuths, with block name, block number, detector distance, and eta
+integratedEsgHeader = "_pd_block_id %s|#%d\n\n_diffrn_detector 2D\n_diffrn_detector_type Image Plate\n_pd_instr_dist_spec/detc %.3f\n_pd_meas_angle_omega 0.0\n_pd_meas_angle_chi 0.0\n_pd_meas_angle_phi 0.0\n_pd_meas_angle_eta %s\n\nloop_\n_pd_meas_position_x _pd_meas_position_y _pd_meas_intensity_total\n"
+
+class ImageIntegrator():
+	"""
+	Integration of images from one detector, see above. Build it once and call integrate or toEsg for each image
+	"""
+	def __init__(self, shape, detparams, pixelsize, center, nsectors=72, step=None, mask=None, chunk=1000000):
+		"""
+		Send
+		- shape: number of rows and columns of the images,
+		- detparams: ["inclinedReflection", distance, 2theta, tilt, rotation, eta], as in EsgDataset.fromFile,
+		- pixelsize: size of the pixels along x (columns) and y (rows), in mm,
+		- center: x and y positions of the beam center, in mm from the first pixel. Detector positions in the ESG are relative to it,
+		- nsectors: number of azimuthal sectors, of equal width, covering the azimuths of the image,
+		- step: width of the 2theta bins, in degrees. Defaults to the angle of one pixel at the detector distance,
+		- mask: optional boolean array with the shape of the images, True for pixels to ignore.
+		Pixel positions are calculated chunk pixels at a time, to limit memory use on large detectors
+		"""
+		if ((detparams == None) or (detparams[0] != "inclinedReflection")):
+			raise ValueError("Integration of images requires the geometry of an inclined reflection detector")
+		nrows, ncols = self.shape = tuple(int(n) for n in shape)
+		self.detparams = list(detparams)
+		detector = AngularInclinedFlatImageCalibration(detparams[1], 0., 0., *detparams[2:6])
+		if (step == None):
+			step = math.degrees(min(pixelsize) / detparams[1])
+		if ((step <= 0.) or (nsectors < 1)):
+			raise ValueError("Integration needs a positive 2theta step and at least one sector")
+		# 2theta and eta of each pixel
+		npixels = nrows * ncols
+		twotheta = numpy.empty(npixels)
+		eta = numpy.empty(npixels)
+		rowsPerChunk = max(1, chunk // max(ncols, 1))
+		for start in range(0, nrows, rowsPerChunk):
+			rows = numpy.arange(start, min(start+rowsPerChunk, nrows))
+			x = numpy.tile(numpy.arange(ncols) * pixelsize[0] - center[0], len(rows))
+			y = numpy.repeat(rows * pixelsize[1] - center[1], ncols)
+			twotheta[start*ncols:(rows[-1]+1)*ncols], eta[start*ncols:(rows[-1]+1)*ncols] = detector.twoThetaEtaFromXYArray(x, y)
+		valid = numpy.ones(npixels, dtype=bool) if (mask is None) else numpy.logical_not(numpy.asarray(mask, dtype=bool).ravel())
+		if (valid.size != npixels):
+			raise ValueError("The mask does not have the shape of the images")
+		if (not valid.any()):
+			raise ValueError("All pixels are masked")
+		# Sectors cover the azimuths of the image, eta within 180 degrees of their mean
+		eta = wrapAngle(eta, circularMean(eta[valid]))
+		etamin = eta[valid].min()
+		width = (eta[valid].max() - etamin) / nsectors
+		sector = numpy.zeros(npixels, dtype=numpy.intp)
+		if (width > 0.):
+			sector = numpy.clip(numpy.floor((eta - etamin) / width).astype(numpy.intp), 0, nsectors-1)
+		twothetamin = twotheta[valid].min()
+		nbins = int((twotheta[valid].max() - twothetamin) // step) + 1
+		# Bin of each pixel, masked pixels go to an extra bin that is never used
+		self.nbins = nsectors * nbins
+		self.bins = numpy.full(npixels, self.nbins, dtype=numpy.intp)
+		self.bins[valid] = sector[valid] * nbins + numpy.minimum(((twotheta[valid] - twothetamin) // step).astype(numpy.intp), nbins-1)
+		del twotheta, eta, sector
+		# Bins with pixels, their pixel count and mean detector positions
+		counts = numpy.bincount(self.bins, minlength=self.nbins+1)[:self.nbins]
+		self.filled = numpy.nonzero(counts)[0]
+		self.counts = counts[self.filled]
+		columns = numpy.tile(numpy.arange(ncols, dtype=float), nrows)
+		x = numpy.bincount(self.bins, weights=columns, minlength=self.nbins+1)[self.filled] / self.counts * pixelsize[0] - center[0]
+		columns = numpy.repeat(numpy.arange(nrows, dtype=float), ncols)
+		y = numpy.bincount(self.bins, weights=columns, minlength=self.nbins+1)[self.filled] / self.counts * pixelsize[1] - center[1]
+		del columns
+		# Data points of each sector, sorted by 2theta, intensities are set for each image
+		binsector = self.filled // nbins
+		self.points = numpy.column_stack((detector.twoThetaFromXYArray(x, y), x, numpy.zeros(len(x)), y))
+		self.order = numpy.lexsort((self.points[:,0], binsector))
+		self.points = self.points[self.order]
+		self.bounds = numpy.searchsorted(binsector[self.order], numpy.arange(0,nsectors+1))
+		self.etas = ["%.3f" % (etamin + (k + 0.5) * width) for k in range(0,nsectors)]
+	
+	def integrate(self, image):
+		"""
+		Integrates one image. Returns the list of data arrays of each sector, [2theta, x, intensity, y], as in EsgDataset
+		Pixels with NaN or infinite intensities are ignored
+		"""
+		values = numpy.asarray(image, dtype=float)
+		if (values.shape != self.shape):
+			raise ValueError("Image of shape %s, the integration was prepared for images of shape %s" % (values.shape, self.shape))
+		values = values.ravel()
+		finite = numpy.isfinite(values)
+		if (finite.all()):
+			counts = self.counts
+			sums = numpy.bincount(self.bins, weights=values, minlength=self.nbins+1)[self.filled]
+		else:
+			bins = self.bins[finite]
+			counts = numpy.bincount(bins, minlength=self.nbins+1)[self.filled]
+			sums = numpy.bincount(bins, weights=values[finite], minlength=self.nbins+1)[self.filled]
+		points = self.points.copy()
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			points[:,2] = (sums / counts)[self.order]
+		data = [points[self.bounds[k]:self.bounds[k+1]] for k in range(0,len(self.etas))]
+		if (not finite.all()):
+			data = [thisdata[counts[self.order][self.bounds[k]:self.bounds[k+1]] > 0] for k, thisdata in enumerate(data)]
+		return data
+	
+	def toEsg(self, image, title="noTitle"):
+		"""
+		Integrates one image, returns an EsgDataset. Sectors without data are skipped
+		"""
+		title = re.sub(r"\s+", "_", title)
+		headers = []
+		data = []
+		etas = []
+		for thisdata, etastring in zip(self.integrate(image), self.etas):
+			if (len(thisdata) == 0):
+				continue
+			headers.append(integratedEsgHeader % (title, len(headers), self.detparams[1], etastring))
+			etas.append(etastring)
+			data.append(thisdata)
+		return EsgDataset(headers, etas, data, "inclinedReflection", *self.detparams[1:6])
+
+def integrateImageFiles(filenames, outdir, detparams, pixelsize, center, nsectors=72, step=None, mask=None, steps=None):
+	"""
+	Integrates a series of images into ESG files in outdir, with the same name as each image and the .esg extension
+	
+	The integration is prepared once for all images of the same shape, see ImageIntegrator. If steps, a recipe, is given,
+	it is applied to the data before saving. Generator, yields the name of each ESG file and its number of azimuths
+	"""
+	if (steps != None):
+		checkRecipe(steps, "inclinedReflection")
+	integrators = {}
+	for filename in filenames:
+		image = readImage(filename)
+		if (image.shape not in integrators):
+			integrators[image.shape] = ImageIntegrator(image.shape, detparams, pixelsize, center, nsectors, step, mask)
+		name = os.path.splitext(os.path.basename(filename))[0]
+		esg = integrators[image.shape].toEsg(image, name)
+		if (steps != None):
+			esg.applyRecipe(steps)
+		outname = os.path.join(outdir, name + ".esg")
+		esg.save(outname)
+		yield outname, esg.nEta()
+
+#################################################################
+#
+# Index of data points sorted by 2theta, to find the data point closest to a position in a plot
+#
+#################################################################
+
+class TwoThetaIndex():
+	"""
+	Built once for the data of one azimuth. Lookups search only the points within a 2theta window, found by bisection.
+	"""
+	def __init__(self, thisdata):
+		self.data = numpy.asarray(thisdata, dtype=float)
+		if (self.data.size == 0):
+			self.order = numpy.zeros(0, dtype=int)
+			self.twotheta = numpy.zeros(0)
+			self.intensity = numpy.zeros(0)
+		else:
+			self.order = numpy.argsort(self.data[:,0], kind='stable')
+			self.twotheta = self.data[self.order,0]
+			self.intensity = self.data[self.order,2]
+	
+	def nearest(self, twotheta, intensity, xscale=1., yscale=1., radius=numpy.inf):
+		"""
+		Index, in the data, of the point closest to (twotheta, intensity), or None if there is no point within radius
+		
+		Distances are calculated after scaling 2theta by xscale and intensities by yscale, pixels per unit in a plot for instance,
+		radius is in the same scaled units.
+		"""
+		if (numpy.isinf(radius)):
+			lo, hi = 0, len(self.twotheta)
+		else:
+			lo = numpy.searchsorted(self.twotheta, twotheta - radius/xscale, 'left')
+			hi = numpy.searchsorted(self.twotheta, twotheta + radius/xscale, 'right')
+		if (hi <= lo):
+			return None
+		distance = ((self.twotheta[lo:hi]-twotheta)*xscale)**2 + ((self.intensity[lo:hi]-intensity)*yscale)**2
+		k = numpy.argmin(distance)
+		if (distance[k] > radius**2):
+			return None
+		return self.order[lo+k]
+
+#################################################################
+#
+# Statistics on the data of each azimuth
+#
+#################################################################
+
+# Columns of the statistics returned by azimuthStatistics and EsgDataset.statistics
+statisticsColumns = ["points", "min", "max", "median", "nonpositive", "min2theta", "max2theta", "maxgap"]
+
+def azimuthStatistics(thisdata):
+	"""
+	Statistics on the data of one azimuth, as an array in the order of statisticsColumns: number of points, minimum, maximum and 
+	median intensity, number of points with intensity <= 0, 2theta range, and largest 2theta step in units of the median step.
+	Intensities and 2theta are NaN if there is no data, the largest step is 0 with less than 3 points
+	"""
+	thisdata = numpy.asarray(thisdata, dtype=float)
+	if (thisdata.size == 0):
+		return numpy.array([0., numpy.nan, numpy.nan, numpy.nan, 0., numpy.nan, numpy.nan, 0.])
+	intensity = thisdata[:,2]
+	twotheta = thisdata[:,0]
+	steps = numpy.diff(numpy.sort(twotheta))
+	steps = steps[steps > 0.]
+	maxgap = (steps.max() / numpy.median(steps)) if (len(steps) > 1) else 0.
+	return numpy.array([len(intensity), intensity.min(), intensity.max(), numpy.median(intensity), numpy.count_nonzero(intensity <= 0.), twotheta.min(), twotheta.max(), maxgap])
+
+#################################################################
+#
+# Triage of azimuths that need attention
+#
+# Azimuths are flagged from their statistics, see azimuthStatistics
+#   - "nonpositive": intensities of 0 or less, MAUD does not accept them
+#   - "empty": no data
+#   - "gaps": a 2theta step larger than gapfactor times the median step of the azimuth
+#   - "outliers": number of points, median or maximum intensity far from those of other azimuths. Distances are counted
+#     in median absolute deviations, scaled to match standard deviations for normal distributions
+#   - "unedited": azimuths not modified since the file was read
+#
+#################################################################
+
+triageCriteria = ["nonpositive", "empty", "gaps", "outliers", "unedited"]
+
+def robustOutliers(values, threshold):
+	"""
+	True for values further than threshold scaled median absolute deviations from the median. NaN values are not outliers
+	"""
+	values = numpy.asarray(values, dtype=float)
+	finite = numpy.isfinite(values)
+	outliers = numpy.zeros(len(values), dtype=bool)
+	if (numpy.count_nonzero(finite) < 3):
+		return outliers
+	median = numpy.median(values[finite])
+	deviation = 1.4826 * numpy.median(numpy.abs(values[finite] - median))
+	if (deviation <= 0.):
+		outliers[finite] = (values[finite] != median)
+	else:
+		outliers[finite] = (numpy.abs(values[finite] - median) > threshold * deviation)
+	return outliers
+
+def triageAzimuths(esg, criteria, gapfactor=5., threshold=3.5):
+	"""
+	Azimuths of esg, an EsgDataset, that match any of criteria, see triageCriteria. Returns a dictionary with the matching
+	azimuths, in increasing order, and the list of criteria that each of them matches
+	"""
+	for name in criteria:
+		if (name not in triageCriteria):
+			raise ValueError("Unknown triage criterion: %s" % name)
+	stats = esg.statistics()
+	n = len(stats)
+	flags = {}
+	if ("nonpositive" in criteria):
+		flags["nonpositive"] = stats[:,4] > 0
+	if ("empty" in criteria):
+		flags["empty"] = stats[:,0] == 0
+	if ("gaps" in criteria):
+		flags["gaps"] = stats[:,7] > gapfactor
+	if ("outliers" in criteria):
+		flags["outliers"] = robustOutliers(stats[:,0], threshold) | robustOutliers(stats[:,3], threshold) | robustOutliers(stats[:,2], threshold)
+	if ("unedited" in criteria):
+		flags["unedited"] = numpy.array([not esg.isModified(i) for i in range(0,n)], dtype=bool)
+	triage = {}
+	for i in range(0,n):
+		reasons = [name for name in triageCriteria if ((name in flags) and flags[name][i])]
+		if (len(reasons) > 0):
+			triage[i] = reasons
+	return triage
+
+#################################################################
+#
+# Thread pool for calculations on all azimuths
+#
+# numpy releases the GIL on large arrays, azimuths are processed in parallel
+#
+#################################################################
+
+threadPoolLock = threading.Lock()
+threadPoolExecutor = None
+
+def threadPool():
+	"""
+	Thread pool shared by all datasets, created on first use
+	"""
+	global threadPoolExecutor
+	with threadPoolLock:
+		if (threadPoolExecutor == None):
+			threadPoolExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+		return threadPoolExecutor
+
+#################################################################
+#
+# ESG dataset
+#
+#################################################################
+
+class EsgDataset():
+	"""
+	Data from an ESG file
+	
+	Attributes
+	- headers: header of each azimuth, as a string
+	- etas: eta of each azimuth, as a string
+	- data: data of each azimuth, as numpy arrays with one line per data point, [2theta, x, intensity] for flat transmission
+	  detectors and [2theta, x, intensity, y] for inclined reflection detectors
+	- esgtype: flatTransmission or inclinedReflection
+	- detdistance: detector distance, in mm
+	- detTTheta, detTilt, detRotation, detEta: detector angles in degrees, for inclined reflection detectors
+	
+	Edits never change the array of an azimuth in place, they replace it. A shallow copy of data is enough to keep 
+	a version of the data, for undos or to save in the background. It also tells which azimuths were modified since the
+	file was read: their arrays are not the ones that were read. Azimuths that were not modified are copied from the 
+	original file when saving, byte for byte.
+	"""
+	def __init__(self, headers, etas, data, esgtype, detdistance, detTTheta=0., detTilt=0., detRotation=0., detEta=0.):
+		self.headers = headers
+		self.etas = etas
+		self.data = data
+		self.esgtype = esgtype
+		self.detdistance = detdistance
+		self.detTTheta = detTTheta
+		self.detTilt = detTilt
+		self.detRotation = detRotation
+		self.detEta = detEta
+		self.filename = None
+		self.source = None		# Original file, see fromFile
+		self.statisticsCache = {}	# Statistics of each azimuth, by id of the data arrays, see statistics
+	
+	@classmethod
+	def fromFile(cls, filename, detparams=None):
+		"""
+		Reads an ESG file
+		
+		Detector angles are not in ESG files. For inclined reflection detectors, send them in detparams as 
+		["inclinedReflection", distance, 2theta, tilt, rotation, eta]. Raises ValueError if they are missing.
+		"""
+		esgtype, detdistance = esgFileType(filename)
+		detector = None
+		angles = []
+		if (esgtype == "inclinedReflection"):
+			if ((detparams == None) or (detparams[0] != "inclinedReflection")):
+				raise ValueError("Detector angles are needed for data from an inclined reflection detector")
+			detdistance = detparams[1]
+			angles = detparams[2:6]
+			# Prepare a detector to convert pixel positions in X and Y to 2theta
+			# X and Y centers are already corrected in this file (according to what was entered when they were created)
+			detector = AngularInclinedFlatImageCalibration(detdistance, 0., 0., *angles)
+		# For each spectrum, save header, etaangle, data, and position in the file
+		headers = []
+		data = []
+		etas = []
+		offsets = []
+		stat = os.stat(filename)
+		f = openEsgFile(filename, 'rb')
+		try:
+			for header, eta, blocktype, values, offset in readEsgBlocks(f, True):
+				headers.append(header)
+				etas.append(eta)
+				data.append(esgBlockData(values, esgtype, detdistance, detector))
+				offsets.append(offset)
+		finally:
+			f.close()
+		esg = cls(headers, etas, data, esgtype, detdistance, *angles)
+		esg.filename = filename
+		# Original file, arrays, and headers, to find azimuths that were not modified and copy them when saving
+		esg.source = {"filename": filename, "size": stat.st_size, "mtime": stat.st_mtime, "offsets": offsets, "data": list(data), "headers": list(headers)}
+		return esg
+	
+	def nEta(self):
+		return len(self.data)
+	
+	def copy(self):
+		"""
+		Shallow copy, enough to keep the current version of the data (see above)
+		"""
+		esg = copy.copy(self)
+		esg.headers = list(self.headers)
+		esg.etas = list(self.etas)
+		esg.data = list(self.data)
+		esg.statisticsCache = dict(self.statisticsCache)
+		return esg
+	
+	def detparams(self):
+		"""
+		Detector parameters, in the format used by fromFile
+		"""
+		if (self.esgtype == "inclinedReflection"):
+			return ["inclinedReflection", self.detdistance, self.detTTheta, self.detTilt, self.detRotation, self.detEta]
+		return ["flatTransmission", self.detdistance]
+	
+	def setDetparams(self, detparams):
+		"""
+		Sets detector distance and angles from detparams, in the format of fromFile, without calculating 2theta again.
+		Used to go back to data saved with their geometry, for undos
+		"""
+		self.detdistance = float(detparams[1])
+		if (self.esgtype == "inclinedReflection"):
+			self.detTTheta, self.detTilt, self.detRotation, self.detEta = [float(v) for v in detparams[2:6]]
+	
+	def detector(self):
+		"""
+		AngularInclinedFlatImageCalibration for inclined reflection detectors, None otherwise
+		"""
+		if (self.esgtype != "inclinedReflection"):
+			return None
+		return AngularInclinedFlatImageCalibration(self.detdistance, 0., 0., self.detTTheta, self.detTilt, self.detRotation, self.detEta)
+	
+	def statistics(self):
+		"""
+		Statistics of all azimuths, as an array with one line per azimuth and columns listed in statisticsColumns
+		
+		Statistics are kept as long as the array of an azimuth does not change, only edited azimuths are calculated again
+		"""
+		cache = {}
+		missing = []
+		for thisdata in self.data:
+			cached = self.statisticsCache.get(id(thisdata))
+			if ((cached != None) and (cached[0] is thisdata)):
+				cache[id(thisdata)] = cached
+			else:
+				missing.append(thisdata)
+		for thisdata, stats in zip(missing, threadPool().map(azimuthStatistics, missing)):
+			cache[id(thisdata)] = (thisdata, stats)
+		self.statisticsCache = cache
+		if (len(self.data) == 0):
+			return numpy.zeros((0,len(statisticsColumns)))
+		return numpy.array([cache[id(thisdata)][1] for thisdata in self.data])
+	
+	def triage(self, criteria, gapfactor=5., threshold=3.5):
+		"""
+		Azimuths that need attention, with the criteria they match, see triageAzimuths
+		"""
+		return triageAzimuths(self, criteria, gapfactor, threshold)
+	
+	def export(self, filename, progress=None):
+		"""
+		Exports data in columnar format, to NPZ or HDF5, see exportColumnar
+		"""
+		return exportColumnar(self, filename, progress)
+	
+	def isModified(self, i):
+		"""
+		True if azimuth i was modified since the file was read, or if there is no original file to copy it from
+		"""
+		if ((self.source == None) or (i >= len(self.source["data"]))):
+			return True
+		return ((self.data[i] is not self.source["data"][i]) or (self.headers[i] is not self.source["headers"][i]))
+	
+	def modifiedAzimuths(self):
+		"""
+		Azimuths modified since the file was read
+		"""
+		return [i for i in range(0,len(self.data)) if self.isModified(i)]
+	
+	def sourceIsUnchanged(self):
+		"""
+		True if the original file is still on disk as it was read
+		"""
+		try:
+			stat = os.stat(self.source["filename"])
+		except OSError:
+			return False
+		return ((stat.st_size == self.source["size"]) and (stat.st_mtime == self.source["mtime"]))
+	
+	def save(self, filename, progress=None, differential=True):
+		"""
+		Saves data to an ESG file, see writeEsgBlocks for progress and handling of compressed files
+		
+		If differential is True and the original file did not change on disk, azimuths that were not modified are copied
+		from it byte for byte, and only modified azimuths are formatted again
+		"""
+		if ((not differential) or (self.source == None) or (not self.sourceIsUnchanged())):
+			blocks = (formatEsgBlock(self.headers[i], self.data[i], self.esgtype) for i in range(0,len(self.headers)))
+			return writeEsgBlocks(filename, blocks, progress, len(self.headers))
+		f = openEsgFile(self.source["filename"], 'rb')
+		try:
+			return writeEsgBlocks(filename, self.differentialBlocks(f), progress, len(self.headers))
+		finally:
+			f.close()
+	
+	def differentialBlocks(self, f):
+		"""
+		Generator used by save, formatted or copied azimuths
+		"""
+		for i in range(0,len(self.headers)):
+			if (self.isModified(i)):
+				yield formatEsgBlock(self.headers[i], self.data[i], self.esgtype)
+			else:
+				yield from copyEsgBlocks(f, [self.source["offsets"][i]])
+	
+	def applyRecipe(self, steps, progress=None):
+		"""
+		Apply a recipe, see the section on edit recipes. All steps are applied to one azimuth before moving to the next,
+		azimuths are processed in parallel. Arrays of azimuths that are not affected are kept as they are.
+		
+		progress is an optional function, called as progress(i,nEta) as azimuths are done. If it returns False, the recipe 
+		is cancelled, the data are not changed, and the function returns False.
+		"""
+		data = self.recipeData(steps, progress)
+		if (data == None):
+			return False
+		self.commitRecipe(steps, data)
+		return True
+	
+	def recipeData(self, steps, progress=None):
+		"""
+		Data after applying a recipe, as a list of arrays, without changing the dataset. Can run in another thread, the result 
+		is then set with commitRecipe. Returns None if cancelled, see applyRecipe for progress
+		"""
+		checkRecipe(steps, self.esgtype)
+		steps = remapRecipe(steps, self.etas)
+		data = list(self.data)
+		futures = [threadPool().submit(applyRecipeToBlock, data[i], i, steps, self.esgtype) for i in range(0,len(data))]
+		try:
+			for i in range(0,len(futures)):
+				data[i] = futures[i].result()
+				if ((progress != None) and (progress(i+1,len(futures)) == False)):
+					return None
+		finally:
+			for future in futures:
+				future.cancel()
+		return data
+	
+	def commitRecipe(self, steps, data):
+		"""
+		Sets data calculated by recipeData and the detector geometry from the recipe
+		"""
+		self.data = data
+		# Keep the last detector geometry
+		for step in flattenRecipe(steps):
+			if (step["edit"] == "recalibrate"):
+				self.detdistance = step["detparams"][1]
+				if (self.esgtype == "inclinedReflection"):
+					self.detTTheta, self.detTilt, self.detRotation, self.detEta = step["detparams"][2:6]
+	
+	def applyStep(self, step):
+		"""
+		Apply a single recipe step
+		"""
+		self.applyRecipe([step])
+	
+	def removePoints(self, i, min2theta, max2theta, minintensity=-numpy.inf, maxintensity=numpy.inf):
+		"""
+		Remove data points at azimuth i within a 2theta and intensity range. Returns the recipe step
+		"""
+		step = {"edit": "removePoints", "eta": i, "min2theta": float(min2theta), "max2theta": float(max2theta), 
+			"minintensity": None if numpy.isinf(minintensity) else float(minintensity), "maxintensity": None if numpy.isinf(maxintensity) else float(maxintensity)}
+		self.applyStep(step)
+		return step
+	
+	def applyMask(self, mask, remap="index"):
+		"""
+		Remove 2theta ranges and detector regions listed in a mask, as returned by loadMaskFromFile. 2theta ranges are moved to
+		azimuths with matching eta angles according to remap, see maskRemapModes. Returns the recipe step
+		"""
+		step = {"edit": "mask", "mask": mask, "remap": remap}
+		self.applyStep(step)
+		return step
+	
+	def crop(self, min2theta, max2theta):
+		"""
+		Remove data points outside a 2theta range, at all azimuths. Returns the recipe step
+		"""
+		step = {"edit": "crop", "min2theta": float(min2theta), "max2theta": float(max2theta)}
+		self.applyStep(step)
+		return step
+	
+	def shift(self, shift, i=None):
+		"""
+		Add a fixed value to all intensities at azimuth i, or at all azimuths if i is None. Returns the recipe step
+		"""
+		step = {"edit": "shift", "shift": float(shift), "eta": i}
+		self.applyStep(step)
+		return step
+	
+	def setMinimum(self, minval):
+		"""
+		For each azimuth, shift intensities so that the minimum intensity is minval. Returns the recipe step
+		"""
+		step = {"edit": "setMinimum", "minimum": float(minval)}
+		self.applyStep(step)
+		return step
+	
+	def subtractBackground(self, i, xbg, ybg):
+		"""
+		Subtract a linear background, interpolated between points (xbg, ybg), at azimuth i. Returns the recipe step
+		"""
+		step = {"edit": "subtractBackground", "eta": i, "x": [float(x) for x in xbg], "y": [float(y) for y in ybg]}
+		self.applyStep(step)
+		return step
+	
+	def baselines(self, width, gapfactor=5., progress=None):
+		"""
+		Baselines at all azimuths, see estimateBaseline, calculated in parallel. Does not change the data and can run in 
+		another thread. Returns None if cancelled, see applyRecipe for progress
+		"""
+		futures = [threadPool().submit(estimateBaseline, thisdata, width, gapfactor) for thisdata in self.data]
+		baselines = []
+		try:
+			for i in range(0,len(futures)):
+				baselines.append(futures[i].result())
+				if ((progress != None) and (progress(i+1,len(futures)) == False)):
+					return None
+		finally:
+			for future in futures:
+				future.cancel()
+		return baselines
+	
+	def subtractBaseline(self, width, gapfactor=5., i=None):
+		"""
+		Subtract the baseline calculated by estimateBaseline at azimuth i, or at all azimuths if i is None. Returns the recipe step
+		"""
+		step = {"edit": "subtractBaseline", "width": float(width), "gap": float(gapfactor), "eta": i}
+		self.applyStep(step)
+		return step
+	
+	def rebin(self, step=None, maxpoints=None, aggregate="mean"):
+		"""
+		Rebins all azimuths on a 2theta step, or to at most maxpoints points, see rebinTwoTheta. Returns the recipe step
+		"""
+		step = {"edit": "rebin", "step": None if (step == None) else float(step), "maxpoints": None if (maxpoints == None) else int(maxpoints), "aggregate": aggregate}
+		self.applyStep(step)
+		return step
+	
+	def recalibrate(self, detdistance, detTTheta=0., detTilt=0., detRotation=0., detEta=0.):
+		"""
+		Recomputes 2theta for all azimuths using a new detector distance (in mm) and, for inclined detectors, new detector angles (in degrees).
+		Returns the recipe step
+		"""
+		if (self.esgtype == "inclinedReflection"):
+			detparams = ["inclinedReflection", float(detdistance), float(detTTheta), float(detTilt), float(detRotation), float(detEta)]
+		else:
+			detparams = ["flatTransmission", float(detdistance)]
+		step = {"edit": "recalibrate", "detparams": detparams}
+		self.applyStep(step)
+		return step
+	
+	def refineDetector(self, peaks, free=("tilt", "rotation"), maxiterations=5):
+		"""
+		Refines the detector parameters listed in free (see calibrationParameters) so that peaks are at the same 2theta at
+		all azimuths, see DebyeRingFit. Peaks are (min2theta, max2theta, known2theta) in the current 2theta, known2theta can be None.
+		Does not change the data, returns the new detparams and the scatter of peak positions before and after, in degrees 2theta
+		"""
+		if (self.esgtype != "inclinedReflection"):
+			raise ValueError("Refining the detector geometry requires data from an inclined reflection detector")
+		if (any((name in absoluteCalibrationParameters) for name in free) and all((peak[2] == None) for peak in peaks)):
+			raise ValueError("Refining the detector %s requires at least one peak with a known 2theta" % " or ".join(absoluteCalibrationParameters))
+		detparams = self.detparams()
+		first = DebyeRingFit(self.data, detparams, peaks)
+		fit = first
+		for iteration in range(0,maxiterations):
+			# Points are selected again with the new geometry, both geometries are compared on the same points
+			refined = fit.refine(free)
+			if (fit.scatter(refined) >= fit.scatter(detparams)):
+				break
+			detparams = refined
+			if (iteration < maxiterations-1):
+				fit = DebyeRingFit(self.data, detparams, peaks)
+		# Before and after are given for the points selected with the original geometry
+		return detparams, first.scatter(self.detparams()), first.scatter(detparams)
+	
+	def resector(self, nsectors):
+		"""
+		Pools all data points of an inclined detector ESG and distributes them in nsectors azimuthal sectors of equal width,
+		covering the azimuthal range of the data
+		
+		Eta is calculated for each point from its x and y positions, and converted to the convention of the file using
+		the original azimuths. Headers are copied from the original azimuth closest to each sector, with new eta and block number.
+		Sectors without data are skipped. Returns a new EsgDataset
+		"""
+		if (self.esgtype != "inclinedReflection"):
+			raise ValueError("Re-sectoring requires data from an inclined reflection detector")
+		if (any((eta == None) for eta in self.etas)):
+			raise ValueError("Re-sectoring requires the eta angle of each azimuth")
+		# Pool all points
+		blocks = []
+		fileetas = []
+		for i in range(0,len(self.data)):
+			if (self.data[i].size > 0):
+				blocks.append(self.data[i])
+				fileetas.append(float(self.etas[i]))
+		if (len(blocks) == 0):
+			raise ValueError("No data to re-sector")
+		sizes = [len(block) for block in blocks]
+		points = numpy.concatenate(blocks)
+		twotheta, eta = self.detector().twoThetaEtaFromXYArray(points[:,1], points[:,3])
+		# Eta in the convention of the file, within 180 degrees of the center of the original azimuths
+		owner = numpy.repeat(numpy.arange(len(blocks)), sizes)
+		blocketas = [circularMean(eta[owner == k]) for k in range(0,len(blocks))]
+		sign, offset = etaConventionFromBlocks(blocketas, fileetas)
+		eta = wrapAngle(sign*eta + offset, circularMean(fileetas))
+		# Distribute points in sectors, sorted by 2theta within each sector
+		etamin = eta.min()
+		etamax = eta.max()
+		width = (etamax - etamin) / nsectors
+		if (width > 0.):
+			sector = numpy.clip(numpy.floor((eta - etamin) / width).astype(int), 0, nsectors-1)
+		else:
+			sector = numpy.zeros(len(eta), dtype=int)
+		order = numpy.lexsort((twotheta, sector))
+		points = points[order]
+		points[:,0] = twotheta[order]
+		sector = sector[order]
+		bounds = numpy.searchsorted(sector, numpy.arange(0,nsectors+1))
+		# Build the new azimuths
+		fileetas = numpy.asarray([float(e) for e in self.etas])
+		headers = []
+		data = []
+		etas = []
+		for k in range(0,nsectors):
+			if (bounds[k+1] == bounds[k]):
+				continue
+			center = etamin + (k + 0.5) * width
+			template = numpy.argmin(numpy.abs(wrapAngle(fileetas - center)))
+			etastring = "%.3f" % center
+			headers.append(esgHeaderWithEta(self.headers[template], etastring, len(headers)))
+			etas.append(etastring)
+			data.append(points[bounds[k]:bounds[k+1]])
+		esg = self.copy()
+		esg.headers = headers
+		esg.etas = etas
+		esg.data = data
+		esg.filename = None
+		esg.source = None
+		return esg
+	
+	def merge(self, groups, gapfactor=5.):
+		"""
+		Merges each group of azimuths, a list of azimuth numbers, into a single azimuth. Returns a new EsgDataset
+		
+		Intensities are averaged on the 2theta grid of the central azimuth of the group, using mergeAzimuthData. Eta is
+		the mean eta of the group, within 180 degrees of the eta of the central azimuth so that the file keeps its eta convention.
+		If an azimuth of the group has no eta, the eta of the central azimuth is kept. The header is copied from the central
+		azimuth, with new eta and block number. Azimuths without data are ignored, groups without data are skipped.
+		"""
+		headers = []
+		data = []
+		etas = []
+		for group in groups:
+			group = [i for i in group if (self.data[i].size > 0)]
+			if (len(group) == 0):
+				continue
+			center = len(group) // 2
+			blocks = [self.data[i] for i in group]
+			if (any((self.etas[i] == None) for i in group)):
+				etastring = self.etas[group[center]]
+			else:
+				groupetas = [float(self.etas[i]) for i in group]
+				etastring = "%.3f" % wrapAngle(circularMean(groupetas), groupetas[center])
+			headers.append(esgHeaderWithEta(self.headers[group[center]], etastring, len(headers)))
+			etas.append(etastring)
+			data.append(mergeAzimuthData(blocks, center, gapfactor))
+		if (len(data) == 0):
+			raise ValueError("No data to merge")
+		esg = self.copy()
+		esg.headers = headers
+		esg.etas = etas
+		esg.data = data
+		esg.filename = None
+		esg.source = None
+		return esg
@@ -64,6 +64,8 @@ How to subtract background?
  * Right click to generate background points (background interpolation is linear),
  * Select *Subtract background* when you have enough points.
 
+Automatic baselines: *Background -> Estimate automatic baseline...* calculates a baseline at all azimuths with an iterative peak-clipping algorithm (SNIP) and shows it in green, without changing the data. Set the half-width of the widest peaks, in degrees 2theta. Data are split where there is a gap in 2theta, between detector chips for instance, and each piece gets its own baseline so that steps in intensity between chips are followed. Select *Background -> Subtract automatic baseline* to subtract it at all azimuths. This counts as a single edit and can be undone.
+
 ### Baseline intensity
 
 MAUD will fail with negative or zero intensity points. It actually is a feature, but can really throw you off with some datas. Your refinement will diverge. To fix this, You can
@@ -71,11 +73,39 @@ MAUD will fail with negative or zero intensity points. It actually is a feature,
  * Add a fixed intensity to the data at all azimuth by selecting *Shift all datasets...*,
  * Set the minimum intensity at all azimuth by selecting *Set value for minimum intensity...*. For each azimuth, the program will evaluate the current intensity minimum and add the necessary shift to bring the minimum intensity to the value decided by the user. This operation is typically performed at the end, once you have edited data for all azimuth.
 
+### Detector geometry
+
+2theta values are calculated from the detector positions in the ESG file and the detector geometry. For inclined detectors, you are asked for the detector angles when opening the file. If the geometry was wrong, use *Edit data -> Detector geometry...* to change the detector distance or angles. 2theta is recalculated for all azimuths at once, without reloading the file.
+
+A wrong detector geometry shows up as peaks that drift in 2theta from one azimuth to the next. For inclined detectors, *Edit data -> Refine detector geometry...* fits the detector parameters so that peaks are at the same 2theta at all azimuths. Enter the 2theta range of one or more isolated peaks, separated by commas, such as `5.2 5.8, 7.4 8.0`. The range of the current plot is proposed by default. If you know the true 2theta of a peak, from a calibrant for instance, add it after the range, as in `5.2 5.8 5.512`: the peak is then fitted to this value, which also constrains the detector distance. Distance and detector 2theta can only be refined with at least one such peak. Select the parameters to refine, tilt and rotation by default. The program reports how much peak positions scatter before and after the refinement, and recalculates 2theta with the new geometry if you agree. Refining many parameters at once from few peaks can give several equally good solutions: start with tilt and rotation.
+
+For inclined detectors, *Edit data -> Re-sector azimuths...* pools all data points, recalculates their azimuth from the detector positions, and regroups them in the number of azimuthal sectors of your choice. The result is saved in a new ESG file. Fewer sectors means faster refinements in MAUD, at the cost of azimuthal resolution.
+
+*Edit data -> Merge azimuths...* averages groups of azimuths into single azimuths and saves the result in a new ESG file. Enter a number to merge that many adjacent azimuths, or list the groups yourself, separated by commas, as in `0-3, 4-7, 8 9`. Intensities are averaged on the 2theta grid of the central azimuth of each group, and eta is set to the mean eta of the group. Regions removed in some of the azimuths of a group are filled from the others. This works for all detectors, and can cut refinement time in MAUD several-fold.
+
+*Edit data -> Rebin 2theta...* groups the data points of every azimuth in bins of 2theta, with a fixed 2theta step or a maximum number of points per azimuth, and replaces each bin by a single point with the mean or the sum of its intensities. Removed points are not included. For flat detectors, 2theta and x are the mean of each bin. For inclined detectors, 2theta, x and y are those of the point closest to the mean 2theta of the bin, so that MAUD finds the same 2theta from the detector positions. Inclined detectors record far more points than MAUD needs: rebinning makes files faster to load, save, and refine.
+
 ### Navigation and file management
 
-You can navigate between spectra using the *Previous* or *Next* buttons or by using the *left* and *right* keyboard keys.
+You can navigate between spectra using the *Previous* or *Next* buttons or by using the *left* and *right* keyboard keys. If you hold a key down, the spectrum number follows the keyboard and only the last spectrum is plotted.
+
+Move the mouse over the plot to see the data point closest to the cursor in the status bar: 2theta, intensity, and position on the detector (x, and y for inclined detectors).
 
-When you are done, save your new data in a new ESG file.
+The panel at the bottom of the window lists statistics for each azimuth: number of points, minimum, maximum and median intensity, number of points with an intensity of 0 or less, 2theta range, and largest step in 2theta, in units of the median step. Azimuths with intensities of 0 or less, which make MAUD fail, are shown in red. Double-click on a line to plot that azimuth. Show or hide the panel with *View -> Statistics for each azimuth*.
+
+On large files, use *View -> Triage azimuths...* (*Ctrl-Shift-t*) to choose which azimuths need attention: intensities of 0 or less, no data, gaps in 2theta larger than a number of times the median step, outlier number of points or intensities compared to the other azimuths, or azimuths not edited yet. The *Next problem* and *Previous problem* buttons (*Ctrl-Shift-n* and *Ctrl-Shift-p*) then jump between these azimuths only, and the status bar tells why each of them was selected. The list is updated as you edit, azimuths you fixed drop out of it.
+
+*View -> Waterfall of neighbouring azimuths* opens a second window with the azimuths around the current one, stacked vertically, to check that neighbouring spectra are consistent. The current azimuth is in red. The waterfall follows the main window, and you can scroll on it to move between azimuths.
+
+When you are done, save your new data in a new ESG file. Saving runs in the background: you can keep working while the file is written, and stop it with the *Cancel save* button in the status bar. A cancelled save never leaves a partial file behind. Azimuths you did not modify are copied from the original file exactly as they were, only modified azimuths are written again, which makes saving large files much faster.
+
+Edits on all azimuths (masks, 2theta range, rebinning, shifts, minimum intensity, automatic baseline, recipes, detector geometry) also run in the background, with a progress bar in the status bar. Other edits are locked until they are done, but you can still look at the data. Stop them with the *Cancel edit* button: data are only changed once an edit is complete.
+
+Each edit is written to a journal on disk as soon as it is done, in *.maudESGEdit/journals* in your home folder. If the program stops before you could save your data, it offers, on the next start, to open the original file again and recover your edits. Journals are removed when you quit normally.
+
+ESG files can be compressed. Files ending in *.esg.gz*, *.esg.bz2*, or *.esg.xz* are read and written directly, compression is based on the file name.
+
+*File -> Integrate images...* builds ESG files from 2D detector images, NumPy (*.npy*), TIFF (requires tifffile, fabio, or Pillow), or EDF (requires fabio), for an inclined reflection detector. Give the detector distance and angles, the pixel size, the beam center in mm from the first pixel, the number of azimuthal sectors, and the width of 2theta bins (one pixel by default). Each 2theta bin of each sector becomes one data point, with the mean intensity of its pixels. Select several images to integrate a whole series: the 2theta and eta of each pixel are calculated once, and each further image only takes a fraction of a second. ESG files are saved in the folder of your choice, with the names of the images, and the first one is opened.
 
 ### Masks
 
@@ -83,6 +113,14 @@ As you remove rubbish data points, we record 2theta ranges along with the corres
 
 If you want to remove the same data ranges as in a previous processing, use the *Mask -> Load and apply mask*menu item.
 
+For inclined detectors, gaps between detector chips are at fixed positions on the detector, but at different 2theta for each azimuth. Use *Mask -> Mask detector region...* to remove all data points within a rectangle (two corners) or a polygon (its vertices) in detector x and y positions, at all azimuths at once. Detector positions of the data point under the mouse are shown in the status bar. Detector regions are saved in the mask file along with 2theta ranges, so that one mask cleans a whole series of files collected with the same detector.
+
+Masks also save the eta angle of each azimuth and the width of its sector. When a mask is applied to a file with other azimuths, after a different azimuthal integration for instance, *Load and apply mask* asks where its 2theta ranges should go: to the azimuth with the *nearest* eta, to all azimuths whose sector *overlaps* that of the masked azimuth, or to the azimuth with the same number (*index*), as in older versions. Masks saved by older versions have no eta angle and always use the azimuth number.
+
+### Recipes
+
+Every edit is recorded, with its parameters, in a recipe: removed data points, 2theta range, rebinning, background points, intensity shifts, minimum intensity, detector geometry, and masks. Use *Recipe -> Save recipe...* to save it in a file, and *Recipe -> Load and apply recipe...* to replay it on another ESG file. One file cleaned by hand can then drive the cleanup of a whole series. A recipe applied from a file counts as a single edit and can be undone.
+
 ### Final note
 
 Is this data manipulation? If you use this sotware to remove actual data, it is. If you use this software to clean up spectra (due to gaps in your detectors, for instance), it is not.
@@ -95,12 +133,17 @@ import sys
 import argparse
 from argparse import RawTextHelpFormatter
 import os.path
+import time
+
+# Data core: reading, editing, and saving ESG files. Does not depend on Qt
+from maudESGCore import EsgDataset, TwoThetaIndex, statisticsColumns, esgFileType, isEsgFileName, loadMaskFromFile, saveMaskToFile, streamEsg, parseAzimuthGroups, maskFromRecipe, saveRecipeToFile, loadRecipeFromFile, checkRecipe, detectorRegion, detectorRegionShapes, EditJournal, findJournals, journalSourceIsUnchanged, calibrationParameters, absoluteCalibrationParameters, maskRemapModes, readImage, integrateImageFiles, imageFileTypes, triageCriteria
 
 # Plotting routines
 import matplotlib
 matplotlib.use("Qt5Agg")
 from matplotlib.figure import Figure
 from matplotlib.backend_bases import key_press_handler, Event
+from matplotlib.collections import LineCollection
 from matplotlib.backends.backend_qt5agg import (
     FigureCanvasQTAgg as FigureCanvas,
     NavigationToolbar2QT as NavigationToolbar)
@@ -116,311 +159,17 @@ from pkg_resources import parse_version
 
 # Maths stuff
 import numpy
-import math
 import scipy
-from scipy import interpolate
 
 # Baseline removal tools. Removed it. Does not work with our drops in intensity
+# Automatic baselines are now calculated in maudESGCore, piece by piece between detector gaps
 #from skued import baseline_dt
 
-# Useful stuff
-import copy
-
 #def RunningMedian(x,N):
     #idx = numpy.arange(N) + numpy.arange(len(x)-N+1)[:,None]
     #b = [row[row>0] for row in x[idx]]
     #return numpy.array(map(numpy.median,b))
 
-#################################################################
-#
-# Save a read MAUD esg files, mask files
-#
-#################################################################
-
-
-def parseESG(qtParent,filename, detparams=None):
-	# Which type of esg? Can be 
-	# - inclinedReflection if detector type is "inclined reflection image"
-	# - flatTransmission if created by "Flat image transmission"
-	esgtype = "flatTransmission"
-	# detector distance (in mm)
-	detdistance = 200.
-	# Reads number of spectra found
-	text = open(filename).read()
-	nspectra = int(text.count('loop_'))
-	# print ("Looking at file %s I found %d spectra." % (filename, nspectra))
-	# Read the ESG file, Reads all the lines and saves it to the array "content"
-	f = open(filename, 'r')
-	logcontent = [line.strip() for line in f.readlines()]
-	f.close()
-	# Locating lines with new spectra. They start with _pd_block_id. We look for lines with this
-	lookup = "_pd_block_id"
-	linesdb = []
-	for num, line in enumerate(logcontent, 0):
-		if lookup in line:
-			linesdb.append(num)
-			
-	# First, evaluate the type of data (normalImage or flatImage) and detect or ask for the required parameters
-	line = linesdb[0]
-	test1 = 0
-	test2 = 0
-	while (test1*test2 == 0):
-		txt = logcontent[line]
-		line += 1
-		if (txt == "_pd_meas_intensity_total"): # We are probably reading data for a flatTransmission detector
-			esgtype = "flatTransmission"
-			endofheader = "_pd_meas_intensity_total"
-			test1 = 1
-		elif (txt == "_pd_calc_intensity_total"): # Files created by fit2d2maud write it this way, assumes a flat transmission detector
-			esgtype = "flatTransmission"
-			endofheader = "_pd_calc_intensity_total"
-			test1 = 1
-		elif (txt == "_pd_meas_position_x _pd_meas_position_y _pd_meas_intensity_total"): # We are probably reading data for a inclinedReflection detector
-			esgtype = "inclinedReflection"
-			endofheader = "_pd_meas_position_x _pd_meas_position_y _pd_meas_intensity_total"
-			test1 = 1
-		else:
-			# We search for information we need
-			a=txt.split()
-			if (len(a) > 0):
-				if (a[0] == "_pd_instr_dist_spec/detc"):
-					detdistance = float(a[1])
-					test2 = 1
-	if (esgtype == "inclinedReflection"):
-		# We would need the detector angles to recompute 2theta from the information in the file. We need to ask for it to the users
-		if (detparams != None):
-			if (detparams[0] == "inclinedReflection"): # If detector parameters have been set in a previous load, we re-use them
-				dialog = inclinedDetectorDialog(qtParent,detparams[1], detparams[2], detparams[3], detparams[4], detparams[5])
-				# param = ["inclinedReflection", self.esgData["detdistance"] , self.esgData["detTTheta"],  self.esgData["detTilt"],  self.esgData["detRotation"] , self.esgData["etEta"] ]
-			else:
-				dialog = inclinedDetectorDialog(qtParent,detdistance)
-		else:
-			dialog = inclinedDetectorDialog(qtParent,detdistance)
-		result = dialog.exec_()
-		if (dialog.isOk()):
-			detdistance,detTTheta,detTilt,detRotation,detEta = dialog.getInputs()
-			# Prepare a detector to convert pixel positions in X and Y to 2theta
-			# X and Y centers are already corrected in this file (according to what was entered when they were created)
-			detector = AngularInclinedFlatImageCalibration(detdistance, 0., 0., detTTheta, detTilt, detRotation, detEta)
-		else:
-			return False
-	# For each spectrum, save header, etaangle, and data
-	headers = []
-	data = []
-	etas = []
-	i = 0
-	for linestart in linesdb:
-		header = ""
-		line = linestart
-		test = True
-		while test:
-			txt = logcontent[line]
-			header = header + txt + "\n"
-			if (txt == endofheader):
-				test = False # We reached the end headers, data comes next
-			else:
-				# We search for information we need
-				a=txt.split()
-				if (len(a) > 0):
-					if (a[0] == "_pd_meas_angle_eta"):
-						eta = a[1]
-			line += 1
-		headers.append(header)
-		etas.append(eta)
-		# Done with header for this spectrum, now look at data
-		test = True
-		thisdata = []
-		while test:
-			txt = logcontent[line]
-			a=txt.split()
-			if (len(a) < 2):
-				test = False
-			else:
-				if (esgtype == "inclinedReflection"): # x, y, intensity (x and y are detector positions, in mm)
-					x = float(a[0])
-					y = float(a[1])
-					twotetha = detector.twoThetaFromXY(x,y)
-					intensity = float(a[2])
-					thisdata.append([twotetha, float(a[0]), float(a[2]), float(a[1])]) # PAY ATTENTION Inversion of items to 2 and 1 to have itensity at element 3 of the list! Most routines below assume intensity is on element 3 and do not need any adjustement
-				else: # 
-					twotetha = math.degrees(math.atan(float(a[0])/detdistance))
-					thisdata.append([twotetha, float(a[0]), float(a[1])])
-			line += 1
-		#print ("Read data %d, found %d lines with intensities" % (i, len(thisdata)))
-		i += 1
-		data.append(thisdata)
-	toreturn = {}
-	toreturn["headers"] = headers
-	toreturn["data"] = data
-	toreturn["etas"] = etas
-	toreturn["detdistance"] = detdistance
-	toreturn["esgtype"] = esgtype
-	if (esgtype == "inclinedReflection"):
-		toreturn["detTTheta"] = detTTheta
-		toreturn["detTilt"] = detTilt
-		toreturn["detRotation"] = detRotation
-		toreturn["detEta"] = detEta
-	return toreturn
-
-def saveEsgToFile(esgData,filename):
-	headers = esgData["headers"]
-	data = esgData["data"]
-	neta = len(headers)
-	esgtype = esgData["esgtype"]
-	string = ""
-	if (esgtype == "inclinedReflection"):
-		for i in range(0,neta):
-			string += headers[i]
-			thisdata = data[i]
-			for j in range(0,len(thisdata)):
-				if (not(numpy.isnan(thisdata[j][2]))):
-					string += "%.4f %.4f %.8f\n" % (thisdata[j][1], thisdata[j][3], thisdata[j][2])
-			string += "\n"
-	else:
-		for i in range(0,neta):
-			string += headers[i]
-			thisdata = data[i]
-			for j in range(0,len(thisdata)):
-				if (not(numpy.isnan(thisdata[j][2]))):
-					string += "%.2f %.8f\n" % (thisdata[j][1], thisdata[j][2])
-			string += "\n"
-	# Ready to save
-	f = open(filename, 'w')
-	f.write(string)
-	f.close()
-	return
-
-def saveMaskToFile(mask, filename):
-	string = "# Version: 1.0\n# Mask for maudESGEdit\n# Each line: azimuth number, 2theta range to remove\n# Looks a bit like a cif file, but not a true CIF\n#\n"
-	string += "\nloop_\n_esg_azimuth_number _esg_2theta_delete_min _esg_2theta_delete_max\n"
-	items = []
-	# Creation command was self.mask.append({"set":True, "eta": self.etaToPlot, "clear2thetamin": left, "clear2thetamax": right})
-	# Removing empty items
-	for item in mask:
-		if (item["set"]):
-			items.append(item)
-	# Sorting mask
-	items = sorted(items, key=lambda d: (d['eta'],d['clear2thetamin'])) 
-	# Adding to string
-	for item in items:
-		string += "%i %f %f\n" % (item["eta"], item["clear2thetamin"], item["clear2thetamax"])
-	string += "\n"
-	# Ready to save
-	f = open(filename, 'w')
-	f.write(string)
-	f.close()
-	return
-
-def loadMaskFromFile(filename):
-	mask = []
-	# Read the Mask file, Reads all the lines and saves it to the array "content"
-	f = open(filename, 'r')
-	logcontent = [line.strip() for line in f.readlines()]
-	f.close()
-	# Locating mask data. They start with _esg_azimuth_number. We look for lines with this
-	lookup = "_esg_azimuth_number"
-	linesdb = []
-	for num, line in enumerate(logcontent, 0):
-		if lookup in line:
-			linesdb.append(num)
-	for linestart in linesdb:
-		line = linestart + 1 # Starting 3 lines below marker
-		test = True
-		while test:
-			elts = (logcontent[line]).split()
-			if (len(elts) < 3):
-				test = False # We reached the end
-			else:
-				# We search for information we need
-				mask.append({"set":True, "eta": int(elts[0]), "clear2thetamin": float(elts[1]), "clear2thetamax": float(elts[2])})
-			line += 1
-	return mask
-
-
-
-#################################################################
-#
-# Class dedicated to Inclined Reflection Image
-#  Build from the MAUD source code at https://github.com/luttero/maud/
-#      - maud/src/it/unitn/ing/rista/diffr/cal/AngularInclinedFlatImageCalibration.java
-#      - maud/src/it/unitn/ing/rista/util/ConvertImageToSpectra.java
-#
-#################################################################
-
-class  AngularInclinedFlatImageCalibration():
-	def __init__(self, detectorDistance, centerX, centerY, detector2Theta, detectorPhiDA, detectorOmegaDN, detectorEtaDA):
-		"""
-		Send
-		- detector distance, center X and Y (in mm), as in MAUD
-		- detector angles in degrees: detector2Theta, detectorPhiDA, detectorOmegaDN, detectorEtaDA
-		"""
-		self.detectorDistance = detectorDistance
-		self.centerX = centerX
-		self.centerY = centerY
-		self.detector2Theta = detector2Theta
-		self.detectorPhiDA = detectorPhiDA
-		self.detectorOmegaDN = detectorOmegaDN
-		self.detectorEtaDA = detectorEtaDA
-		# Built t-matrix (used for calculations of 2 theta)
-		self.builtTMatrix()
-		
-	def builtTMatrix(self):
-		"""
-		Builds a transformation matrix based on detector orientation 
-		Created based on getTransformationMatrixNew from maud/src/it/unitn/ing/rista/util/ConvertImageToSpectra.java
-		"""
-		omegaDN = numpy.radians(self.detectorOmegaDN)
-		phiDA = numpy.radians(self.detectorPhiDA)
-		etaDA = numpy.radians(self.detectorEtaDA)
-		theta2DET = numpy.radians(self.detector2Theta)
-		# omega = 0.0 # Additional corrections from tilting angle I think. Leave it for now. Not even used in MAUD
-		cosOmegaDN = math.cos(omegaDN);
-		sinOmegaDN = math.sin(omegaDN);
-		cosPhiDA = math.cos(phiDA);
-		sinPhiDA = math.sin(phiDA);
-		cosTheta2DET = math.cos(theta2DET);
-		sinTheta2DET = math.sin(theta2DET);
-		cosEtaDA = math.cos(etaDA);
-		sinEtaDA = math.sin(etaDA);
-		a = numpy.array([[0.,0.,-1], [sinOmegaDN, cosOmegaDN, 0], [cosOmegaDN,  -sinOmegaDN, 0]])
-		# print("Omega detector rotation: ", a)
-		b = numpy.array([[cosPhiDA, sinPhiDA, 0], [-sinPhiDA, cosPhiDA, 0], [0, 0, 1]])
-		# print("Phi detector rotation: ", b)
-		tmat = numpy.dot(b,a)
-		a = numpy.array([[cosTheta2DET, 0, sinTheta2DET], [0, 1, 0], [-sinTheta2DET, 0, cosTheta2DET]])
-		# print("Two theta detector rotation: ", a)
-		b =  numpy.dot(a,tmat)
-		a = numpy.array([[1,0,0],[0, cosEtaDA, sinEtaDA], [0, -sinEtaDA, cosEtaDA]])
-		# print("Eta detector rotation: ", a)
-		self.tmat = numpy.dot(a,b)
-		# print("Full rotation", self.tmat)
-	
-	def get2ThetaFromXf(self,xf):
-		"""
-		Calculate 2theta from the coordinates for a detector position, after calibration
-		Build according maud/src/it/unitn/ing/rista/util/ConvertImageToSpectra.java
-  		Calculation of eta in addition to 2theta could be extracted from line 793 in https://github.com/luttero/maud/blob/version2/src/it/unitn/ing/rista/util/ConvertImageToSpectra.java
-		"""
-		z2 = xf[2,0]*xf[2,0]
-		y2 = xf[1,0]*xf[1,0]
-		x2 = xf[0,0]*xf[0,0]
-		a = math.sqrt(z2+y2)
-		if (abs(a) < 1.E-18):
-			return 0.
-		b = math.sqrt(x2+y2+z2)
-		twotetha = math.asin(a/b)
-		if (xf[0,0] > 0.):
-			twotetha = math.pi - twotetha
-		return twotetha
-	
-	def twoThetaFromXY(self,x,y):
-		# Convert x and y to position in real space, using detector calibration
-		xf = numpy.array([[x-self.centerX],[y-self.centerY],[self.detectorDistance]])
-		xf = numpy.dot(self.tmat,xf)
-		# Get 2 theta from xf
-		twothetadegrees = numpy.degrees(self.get2ThetaFromXf(xf))
-		return twothetadegrees
-
 #################################################################
 #
 # Simple text window
@@ -487,14 +236,14 @@ class inclinedDetectorDialog(PyQt5.QtWidgets.QDialog):
 		self.detDistance = PyQt5.QtWidgets.QLineEdit(self)
 		self.detDistance.setText("%.3f" % detDistance)
 		self.detTTheta = PyQt5.QtWidgets.QLineEdit(self)
-		self.detTTheta.setText("%.0f" % detTTheta)
+		self.detTTheta.setText("%g" % detTTheta)
 		# self.start.setValidator(PyQt5.QtGui.QDoubleValidator()) getting lost between French and English, let's stick to English numbers
 		self.detTilt = PyQt5.QtWidgets.QLineEdit(self)
-		self.detTilt.setText("%.0f" % detTilt)
+		self.detTilt.setText("%g" % detTilt)
 		self.detRotation = PyQt5.QtWidgets.QLineEdit(self)
-		self.detRotation.setText("%.0f" % detRotation)
+		self.detRotation.setText("%g" % detRotation)
 		self.detEta = PyQt5.QtWidgets.QLineEdit(self)
-		self.detEta.setText("%.0f" % detEta)
+		self.detEta.setText("%g" % detEta)
 		buttonBox = PyQt5.QtWidgets.QDialogButtonBox(PyQt5.QtWidgets.QDialogButtonBox.Ok | PyQt5.QtWidgets.QDialogButtonBox.Cancel, self);
 
 		layout = PyQt5.QtWidgets.QFormLayout(self)
@@ -530,6 +279,40 @@ class inclinedDetectorDialog(PyQt5.QtWidgets.QDialog):
 		return self.ok
 
 
+#################################################################
+#
+# Reading ESG files, asking for the detector geometry if needed
+#
+#################################################################
+
+esgFileFilter = "Esg Files (*.esg *.esg.gz *.esg.bz2 *.esg.xz);;All Files (*)"
+
+def parseESG(qtParent,filename, detparams=None):
+	"""
+	Reads an ESG file and returns an EsgDataset, or False if the user cancelled
+	Detector angles of inclined detectors are asked to the user. detparams, from a previous load, are used as default values
+	"""
+	try:
+		esgtype, detdistance = esgFileType(filename)
+	except (IOError, ValueError) as e:
+		PyQt5.QtWidgets.QMessageBox.critical(qtParent, "Error", "Could not read %s: %s" % (filename, e))
+		return False
+	if (esgtype == "inclinedReflection"):
+		# We would need the detector angles to recompute 2theta from the information in the file. We need to ask for it to the users
+		if ((detparams != None) and (detparams[0] == "inclinedReflection")): # If detector parameters have been set in a previous load, we re-use them
+			dialog = inclinedDetectorDialog(qtParent,detparams[1], detparams[2], detparams[3], detparams[4], detparams[5])
+		else:
+			dialog = inclinedDetectorDialog(qtParent,detdistance)
+		result = dialog.exec_()
+		if (not dialog.isOk()):
+			return False
+		detparams = ["inclinedReflection"] + list(dialog.getInputs())
+	try:
+		return EsgDataset.fromFile(filename, detparams)
+	except (IOError, ValueError) as e:
+		PyQt5.QtWidgets.QMessageBox.critical(qtParent, "Error", "Could not read %s: %s" % (filename, e))
+		return False
+
 #################################################################
 #
 # Special dialog to input a twotetha range
@@ -583,121 +366,778 @@ class TThethaRangeDialog(PyQt5.QtWidgets.QDialog):
 
 #################################################################
 #
-# Class to build the Graphical User Interface
+# Special dialog to input parameters for automatic baselines
 #
 #################################################################
 
-# Various matplotlib tricks to adapt the GUI to what we want
-#
-# Access the forward and backward keys in mathplotlib and use them to move between datasets
-# Inspired from 
-# - https://stackoverflow.com/questions/14896580/matplotlib-hooking-in-to-home-back-forward-button-events
-# - https://stackoverflow.com/questions/37506260/adding-an-item-in-matplotlib%C2%B4s-toolbar
+class baselineDialog(PyQt5.QtWidgets.QDialog):
+	def __init__(self, parent=None, width=0.5, gapfactor=5.):
+		super(baselineDialog, self).__init__(parent)
+		self.setWindowTitle("Automatic baseline")
+		
+		self.ok = False
+
+		self.widthEdit = PyQt5.QtWidgets.QLineEdit("%g" % width, self)
+		self.gap = PyQt5.QtWidgets.QLineEdit("%g" % gapfactor, self)
+		buttonBox = PyQt5.QtWidgets.QDialogButtonBox(PyQt5.QtWidgets.QDialogButtonBox.Ok | PyQt5.QtWidgets.QDialogButtonBox.Cancel, self);
+
+		layout = PyQt5.QtWidgets.QFormLayout(self)
+		layout.addRow("Half-width of the widest peaks (degrees 2theta)", self.widthEdit)
+		layout.addRow("Split data at 2theta gaps larger than (x median step)", self.gap)
+		layout.addWidget(buttonBox)
+
+		buttonBox.accepted.connect(self.accept)
+		buttonBox.rejected.connect(self.reject)
+		self.show()
+
+	def accept(self):
+		try:
+			width = float(self.widthEdit.text())
+		except Exception:
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Peak width is not a number')
+			return
+		try:
+			gap = float(self.gap.text())
+		except Exception:
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Gap factor is not a number')
+			return
+		if ((width <= 0.) or (gap <= 1.)):
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Peak width should be positive and gap factor larger than 1')
+			return
+		self.ok = True
+		self.close()
+
+	def getInputs(self):
+		return (float(self.widthEdit.text()), float(self.gap.text()))
+	
+	def isOk(self):
+		return self.ok
+
+#################################################################
 #
-# Not used after all (forgot why). The gui is working ok without it.
+# Special dialog to input peaks and free parameters for the refinement of detector angles
 #
+#################################################################
 
-#def new_forward(self, *args, **kwargs):
-	#s = 'forward_event'
-	#event = Event(s, self)
-	#event.foo = 100
-	#self.canvas.callbacks.process(s, event)
-	## forward(self, *args, **kwargs) # If you wanted to still call the old forward event
+class detectorRefinementDialog(PyQt5.QtWidgets.QDialog):
+	def __init__(self, parent=None, peaks=""):
+		super(detectorRefinementDialog, self).__init__(parent)
+		self.setWindowTitle("Refine detector geometry")
+		
+		self.ok = False
+		self.peaks = []
 
-#def new_backward(self, *args, **kwargs):
-	#s = 'backward_event'
-	#event = Event(s, self)
-	#event.foo = 100
-	#self.canvas.callbacks.process(s, event)
-	## backward(self, *args, **kwargs) # If you wanted to still call the old backward event
+		self.peaksEdit = PyQt5.QtWidgets.QLineEdit(peaks, self)
+		self.peaksEdit.setPlaceholderText("min max [2theta], min max [2theta], ...")
+		self.free = {}
+		buttonBox = PyQt5.QtWidgets.QDialogButtonBox(PyQt5.QtWidgets.QDialogButtonBox.Ok | PyQt5.QtWidgets.QDialogButtonBox.Cancel, self);
 
-# def new_home(self, *args, **kwargs):
-#    s = 'home_event'
-#    event = Event(s, self)
-#    event.foo = 100
-#    self.canvas.callbacks.process(s, event)
-#     home(self, *args, **kwargs)
+		layout = PyQt5.QtWidgets.QFormLayout(self)
+		layout.addRow("2theta range of each peak, with its known 2theta if any", self.peaksEdit)
+		for name in calibrationParameters:
+			self.free[name] = PyQt5.QtWidgets.QCheckBox(self)
+			self.free[name].setChecked(name in ("tilt", "rotation"))
+			layout.addRow("Refine detector %s" % name, self.free[name])
+		layout.addWidget(buttonBox)
 
-NavigationToolbar.toolitems = (
-	('Home', 'Reset original view', 'home', 'home'), 
-	#('Back', 'Previous spectrum', 'back', 'back'), 
-	#('Forward', 'Next spectrum', 'forward', 'forward'), 
-	#(None, None, None, None), 
-	('Pan', 'Pan axes with left mouse, zoom with right', 'move', 'pan'), 
-	('Zoom', 'Zoom to rectangle', 'zoom_to_rect', 'zoom'), 
-	#(None, None, None, None), 
-	('Save', 'Save the figure', 'filesave', 'save_figure'))
-	#(None, None, None, None))
+		buttonBox.accepted.connect(self.accept)
+		buttonBox.rejected.connect(self.reject)
+		self.show()
 
-# NavigationToolbar.home = new_home
+	def accept(self):
+		self.peaks = []
+		for text in self.peaksEdit.text().split(","):
+			try:
+				values = [float(v) for v in text.split()]
+			except Exception:
+				PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Peak ranges are not numbers')
+				return
+			if ((len(values) not in (2, 3)) or (values[1] <= values[0])):
+				PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Each peak needs a 2theta range, min and max, and optionally its known 2theta')
+				return
+			self.peaks.append((values[0], values[1], values[2] if (len(values) == 3) else None))
+		if (not any(box.isChecked() for box in self.free.values())):
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Select at least one parameter to refine')
+			return
+		if (any(self.free[name].isChecked() for name in absoluteCalibrationParameters) and all((peak[2] == None) for peak in self.peaks)):
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Refining the detector %s requires at least one peak with a known 2theta' % " or ".join(absoluteCalibrationParameters))
+			return
+		self.ok = True
+		self.close()
 
-class plotEsg(PyQt5.QtWidgets.QMainWindow):
-	
-	"""
-	Constructor
-	
-	Parmeters:
+	def getInputs(self):
+		"""
+		Peaks, as (min2theta, max2theta, known2theta), and names of the parameters to refine, see DebyeRingFit
+		"""
+		return (self.peaks, [name for name in calibrationParameters if self.free[name].isChecked()])
 	
-	"""
+	def isOk(self):
+		return self.ok
+
+#################################################################
+#
+# Special dialog to input a region in detector space
+#
+#################################################################
+
+class detectorRegionDialog(PyQt5.QtWidgets.QDialog):
 	def __init__(self, parent=None):
-		# Prepare the main window
-		PyQt5.QtWidgets.QMainWindow.__init__(self, parent)
-		pm = PyQt5.QtGui.QPixmap()
-		pm.loadFromData(base64.b64decode(iconXPMbase64))
-		i = PyQt5.QtGui.QIcon()
-		i.addPixmap(pm)
-		self.setWindowIcon(PyQt5.QtGui.QIcon(i))
-		# Setting starting variables
-		self.nEta = 0				# Number of azimuths
-		self.title = "MAUD ESG edit" # Window title
-		self.etaToPlot = 0			# Which azimuth are we looking at
-		self.needToSave = False		# Set True when something has been changed in the data
-		self.olddata = []			# For cancel actions, so we can go back
-		self.oldetaToPlot = []		# For cancel actions, so we can go back
-		self.mask = []				# Saving mask, 2 theta ranges and azimuth at which to remove data
-		self.fileSaveHint = None	# Hint for file saving
-		self.xbg = []				# Used for creating background
-		self.ybg = []				# Used for creating background
-		self.dounzoom = True		# Unzoom when replotting default)
-		self.nautobg = 5			# Number of points for auto-background
-		self.doautobg = False		# Shall we do autobg?
-		self.pathtomask = None		# Path no mask file
-		# Done setting variables, preparing the gui
-		self.create_main_frame()
-		self.on_draw()
-		self.show()
-	"""
-	Builds up the GUI
-	"""
-	def create_main_frame(self):
-		
-		# Preparing a frame
-		self.main_frame = PyQt5.QtWidgets.QWidget()
-		self.setWindowTitle(self.title)
-		
-		# Building a menu bar
+		super(detectorRegionDialog, self).__init__(parent)
+		self.setWindowTitle("Mask detector region")
 		
-		mainMenu = self.menuBar()
-		fileMenu = mainMenu.addMenu('File')
-		editMenu = mainMenu.addMenu('Edit data')
-		bgMenu = mainMenu.addMenu('Background')
-		maskMenu = mainMenu.addMenu('Mask')
-		helpMenu = mainMenu.addMenu('Help')
+		self.ok = False
+		self.region = None
+
+		self.shape = PyQt5.QtWidgets.QComboBox(self)
+		self.shape.addItems(detectorRegionShapes)
+		self.positions = PyQt5.QtWidgets.QLineEdit(self)
+		self.positions.setPlaceholderText("x1 y1, x2 y2, ...")
+		buttonBox = PyQt5.QtWidgets.QDialogButtonBox(PyQt5.QtWidgets.QDialogButtonBox.Ok | PyQt5.QtWidgets.QDialogButtonBox.Cancel, self);
+
+		layout = PyQt5.QtWidgets.QFormLayout(self)
+		layout.addRow("Shape", self.shape)
+		layout.addRow("Detector positions x y (two corners of a rectangle, vertices of a polygon)", self.positions)
+		layout.addWidget(buttonBox)
+
+		buttonBox.accepted.connect(self.accept)
+		buttonBox.rejected.connect(self.reject)
+		self.show()
+
+	def accept(self):
+		try:
+			xy = [float(v) for v in self.positions.text().replace(",", " ").split()]
+		except Exception:
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Detector positions are not numbers')
+			return
+		if (len(xy) % 2 != 0):
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Detector positions come in x y pairs')
+			return
+		try:
+			self.region = detectorRegion(self.shape.currentText(), xy[0::2], xy[1::2])
+		except ValueError as e:
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error', str(e))
+			return
+		self.ok = True
+		self.close()
+
+	def getInputs(self):
+		"""
+		Mask item for the region, see detectorRegion
+		"""
+		return self.region
+	
+	def isOk(self):
+		return self.ok
+
+#################################################################
+#
+# Special dialog to input parameters for the integration of detector images
+#
+#################################################################
+
+class imageIntegrationDialog(PyQt5.QtWidgets.QDialog):
+	def __init__(self, parent=None, detparams=None):
+		"""
+		detparams, from data already loaded, are used as default values for the detector geometry
+		"""
+		super(imageIntegrationDialog, self).__init__(parent)
+		self.setWindowTitle("Integrate detector images")
 		
-		openButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("document-open"), 'Open ESG...', self)
-		openButton.setShortcut('Ctrl+O')
-		openButton.setStatusTip('Open MAUD ESG file...')
+		self.ok = False
+		if ((detparams == None) or (detparams[0] != "inclinedReflection")):
+			detparams = ["inclinedReflection", 200., 0., 0., 0., 0.]
+
+		self.geometry = PyQt5.QtWidgets.QLineEdit("%g %g %g %g %g" % tuple(detparams[1:6]), self)
+		self.pixelSize = PyQt5.QtWidgets.QLineEdit("0.1 0.1", self)
+		self.center = PyQt5.QtWidgets.QLineEdit(self)
+		self.center.setPlaceholderText("x y")
+		self.sectors = PyQt5.QtWidgets.QLineEdit("72", self)
+		self.step = PyQt5.QtWidgets.QLineEdit(self)
+		self.step.setPlaceholderText("one pixel")
+		buttonBox = PyQt5.QtWidgets.QDialogButtonBox(PyQt5.QtWidgets.QDialogButtonBox.Ok | PyQt5.QtWidgets.QDialogButtonBox.Cancel, self);
+
+		layout = PyQt5.QtWidgets.QFormLayout(self)
+		layout.addRow("Detector distance (mm), 2theta, tilt, rotation, eta (degrees)", self.geometry)
+		layout.addRow("Pixel size x y (mm)", self.pixelSize)
+		layout.addRow("Beam center x y (mm from the first pixel)", self.center)
+		layout.addRow("Number of azimuthal sectors", self.sectors)
+		layout.addRow("Width of 2theta bins (degrees)", self.step)
+		layout.addWidget(buttonBox)
+
+		buttonBox.accepted.connect(self.accept)
+		buttonBox.rejected.connect(self.reject)
+		self.show()
+
+	def accept(self):
+		# Before we accept to close the window, we make sure all that should be numbers actually are numbers
+		listToTest = [(self.geometry, 5, "Detector geometry needs 5 numbers"), (self.pixelSize, 2, "Pixel size needs 2 numbers"), (self.center, 2, "Beam center needs 2 numbers")]
+		for edit, n, message in listToTest:
+			try:
+				values = [float(v) for v in edit.text().split()]
+			except Exception:
+				values = []
+			if (len(values) != n):
+				PyQt5.QtWidgets.QMessageBox.critical(self, 'Error', message)
+				return
+		try:
+			nsectors = int(self.sectors.text())
+			step = None if (self.step.text().strip() == "") else float(self.step.text())
+		except Exception:
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error', "Number of sectors or 2theta step is not a number")
+			return
+		if ((nsectors < 1) or ((step != None) and (step <= 0.)) or (min(float(v) for v in self.pixelSize.text().split()) <= 0.)):
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error', "Number of sectors, 2theta step, and pixel size must be positive")
+			return
+		self.ok = True
+		self.close()
+
+	def getInputs(self):
+		"""
+		detparams, pixel size, beam center, number of sectors, and 2theta step (None for the default), see ImageIntegrator
+		"""
+		detparams = ["inclinedReflection"] + [float(v) for v in self.geometry.text().split()]
+		pixelsize = [float(v) for v in self.pixelSize.text().split()]
+		center = [float(v) for v in self.center.text().split()]
+		step = None if (self.step.text().strip() == "") else float(self.step.text())
+		return (detparams, pixelsize, center, int(self.sectors.text()), step)
+	
+	def isOk(self):
+		return self.ok
+
+#################################################################
+#
+# Special dialog to choose criteria for the triage of azimuths
+#
+#################################################################
+
+# Labels of triage criteria, see triageAzimuths
+triageLabels = {"nonpositive": "Intensities of 0 or less", "empty": "No data", "gaps": "Large gaps in 2theta", "outliers": "Outlier number of points or intensities", "unedited": "Not edited yet"}
+
+class triageDialog(PyQt5.QtWidgets.QDialog):
+	def __init__(self, parent=None, criteria=("nonpositive", "empty"), gapfactor=5., threshold=3.5):
+		super(triageDialog, self).__init__(parent)
+		self.setWindowTitle("Triage azimuths")
+		
+		self.ok = False
+
+		self.boxes = {}
+		layout = PyQt5.QtWidgets.QFormLayout(self)
+		layout.addRow(PyQt5.QtWidgets.QLabel("Next and previous problem move between azimuths with", self))
+		for name in triageCriteria:
+			self.boxes[name] = PyQt5.QtWidgets.QCheckBox(triageLabels[name], self)
+			self.boxes[name].setChecked(name in criteria)
+			layout.addRow(self.boxes[name])
+		self.gapfactor = PyQt5.QtWidgets.QLineEdit("%g" % gapfactor, self)
+		self.threshold = PyQt5.QtWidgets.QLineEdit("%g" % threshold, self)
+		layout.addRow("Gaps larger than (times the median 2theta step)", self.gapfactor)
+		layout.addRow("Outliers further than (median absolute deviations)", self.threshold)
+		buttonBox = PyQt5.QtWidgets.QDialogButtonBox(PyQt5.QtWidgets.QDialogButtonBox.Ok | PyQt5.QtWidgets.QDialogButtonBox.Cancel, self);
+		layout.addWidget(buttonBox)
+
+		buttonBox.accepted.connect(self.accept)
+		buttonBox.rejected.connect(self.reject)
+		self.show()
+
+	def accept(self):
+		try:
+			gapfactor = float(self.gapfactor.text())
+			threshold = float(self.threshold.text())
+		except Exception:
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Gap factor and outlier threshold must be numbers')
+			return
+		if ((gapfactor <= 1.) or (threshold <= 0.)):
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Gap factor must be larger than 1 and outlier threshold positive')
+			return
+		if (not any(box.isChecked() for box in self.boxes.values())):
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Select at least one criterion')
+			return
+		self.ok = True
+		self.close()
+
+	def getInputs(self):
+		"""
+		Criteria, gap factor, and outlier threshold, see triageAzimuths
+		"""
+		return ([name for name in triageCriteria if self.boxes[name].isChecked()], float(self.gapfactor.text()), float(self.threshold.text()))
+	
+	def isOk(self):
+		return self.ok
+
+#################################################################
+#
+# Special dialog to input parameters for 2theta rebinning
+#
+#################################################################
+
+class rebinDialog(PyQt5.QtWidgets.QDialog):
+	def __init__(self, parent=None):
+		super(rebinDialog, self).__init__(parent)
+		self.setWindowTitle("Rebin 2theta")
+		
+		self.ok = False
+
+		self.mode = PyQt5.QtWidgets.QComboBox(self)
+		self.mode.addItems(["2theta step (degrees)", "Maximum number of points per azimuth"])
+		self.value = PyQt5.QtWidgets.QLineEdit("0.02", self)
+		self.aggregate = PyQt5.QtWidgets.QComboBox(self)
+		self.aggregate.addItems(["mean", "sum"])
+		buttonBox = PyQt5.QtWidgets.QDialogButtonBox(PyQt5.QtWidgets.QDialogButtonBox.Ok | PyQt5.QtWidgets.QDialogButtonBox.Cancel, self);
+
+		layout = PyQt5.QtWidgets.QFormLayout(self)
+		layout.addRow("Bins", self.mode)
+		layout.addRow("Value", self.value)
+		layout.addRow("Intensity in each bin", self.aggregate)
+		layout.addWidget(buttonBox)
+
+		buttonBox.accepted.connect(self.accept)
+		buttonBox.rejected.connect(self.reject)
+		self.show()
+
+	def accept(self):
+		try:
+			value = float(self.value.text())
+		except Exception:
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Value is not a number')
+			return
+		if ((value <= 0.) or ((self.mode.currentIndex() == 1) and (value < 1.))):
+			PyQt5.QtWidgets.QMessageBox.critical(self, 'Error','Step should be positive and number of points at least 1')
+			return
+		self.ok = True
+		self.close()
+
+	def getInputs(self):
+		"""
+		Recipe step for the rebinning, see rebinTwoTheta
+		"""
+		value = float(self.value.text())
+		if (self.mode.currentIndex() == 0):
+			return {"edit": "rebin", "step": value, "maxpoints": None, "aggregate": self.aggregate.currentText()}
+		return {"edit": "rebin", "step": None, "maxpoints": int(value), "aggregate": self.aggregate.currentText()}
+	
+	def isOk(self):
+		return self.ok
+
+
+#################################################################
+#
+# Waterfall of neighbouring azimuths
+#
+# All spectra are drawn as a single LineCollection. Spectra are decimated to the width of the plot in pixels, keeping 
+# the lowest and highest intensity in each pixel so that peaks and dips stay visible, and decimated spectra are kept
+# as long as the data of an azimuth do not change.
+#
+#################################################################
+
+def decimateSpectrum(thisdata, nbins):
+	"""
+	Returns 2theta and intensities with at most 2*nbins points, the lowest and highest intensity in each of nbins 2theta bins
+	"""
+	if (thisdata.size == 0):
+		return numpy.zeros(0), numpy.zeros(0)
+	order = numpy.argsort(thisdata[:,0], kind='stable')
+	twotheta = thisdata[order,0]
+	intensity = thisdata[order,2]
+	lo = twotheta[0]
+	hi = twotheta[-1]
+	if ((len(twotheta) <= 2*nbins) or (hi <= lo)):
+		return twotheta, intensity
+	bins = numpy.minimum(((twotheta-lo)/(hi-lo)*nbins).astype(int), nbins-1)
+	starts = numpy.flatnonzero(numpy.concatenate(([True], numpy.diff(bins) != 0)))
+	ymin = numpy.minimum.reduceat(intensity, starts)
+	ymax = numpy.maximum.reduceat(intensity, starts)
+	x = lo + (bins[starts]+0.5)*(hi-lo)/nbins
+	return numpy.repeat(x, 2), numpy.column_stack((ymin, ymax)).ravel()
+
+class waterfallWindow(PyQt5.QtWidgets.QDialog):
+	def __init__(self, parent):
+		super(waterfallWindow, self).__init__(parent)
+		self.setWindowTitle("Waterfall of neighbouring azimuths")
+		self.decimated = {}		# Decimated spectra, by id of the data arrays
+		
+		# Fixed margins, tight_layout would take most of the time of each redraw
+		self.fig = Figure((6.0, 8.0), dpi=100,edgecolor='w',facecolor='w')
+		self.fig.subplots_adjust(left=0.1, right=0.97, bottom=0.07, top=0.98)
+		self.axes = self.fig.add_subplot(111)
+		self.axes.set_xlabel("2theta")
+		self.axes.set_ylabel("Azimuth")
+		self.lines = LineCollection([], linewidths=0.8)
+		self.axes.add_collection(self.lines)
+		self.canvas = FigureCanvas(self.fig)
+		self.canvas.setParent(self)
+		self.canvas.mpl_connect('scroll_event', self.on_scroll)
+		
+		self.nBox = PyQt5.QtWidgets.QSpinBox(self)
+		self.nBox.setRange(1, 999)
+		self.nBox.setValue(11)
+		self.nBox.valueChanged.connect(self.parent_changed)
+		self.spacingBox = PyQt5.QtWidgets.QDoubleSpinBox(self)
+		self.spacingBox.setRange(0., 100.)
+		self.spacingBox.setSingleStep(0.1)
+		self.spacingBox.setValue(1.)
+		self.spacingBox.valueChanged.connect(self.parent_changed)
+		hlay = PyQt5.QtWidgets.QHBoxLayout()
+		hlay.addWidget(PyQt5.QtWidgets.QLabel("Number of azimuths", self))
+		hlay.addWidget(self.nBox)
+		hlay.addWidget(PyQt5.QtWidgets.QLabel("Spacing", self))
+		hlay.addWidget(self.spacingBox)
+		hlay.addStretch(1)
+		
+		vbox = PyQt5.QtWidgets.QVBoxLayout()
+		vbox.addLayout(hlay)
+		vbox.addWidget(self.canvas)
+		vbox.addWidget(PyQt5.QtWidgets.QLabel("Current azimuth in red. Scroll on the plot to move between azimuths.", self))
+		self.setLayout(vbox)
+		self.setGeometry(350, 150, 600, 800)
+		self.show()
+	
+	def parent_changed(self, value=None):
+		if (self.parent().nEta > 0):
+			self.show_data(self.parent().esgData, self.parent().etaToPlot)
+	
+	def on_scroll(self, event):
+		if (event.button == 'up'):
+			self.parent().handle_backward()
+		else:
+			self.parent().handle_forward()
+	
+	def show_data(self, esgData, center):
+		"""
+		Shows the azimuths around center, stacked with increasing azimuth number upwards
+		"""
+		n = self.nBox.value()
+		first = max(0, min(center - n//2, esgData.nEta() - n))
+		indices = range(first, min(first + n, esgData.nEta()))
+		nbins = max(int(self.axes.bbox.width), 100)
+		# Decimated spectra, only new or edited azimuths are decimated again
+		decimated = {}
+		for i in indices:
+			data = esgData.data[i]
+			cached = self.decimated.get(id(data))
+			if ((cached == None) or (cached[0] is not data) or (cached[1] != nbins)):
+				cached = (data, nbins) + decimateSpectrum(data, nbins)
+			decimated[id(data)] = cached
+		self.decimated = decimated
+		spectra = [self.decimated[id(esgData.data[i])][2:] for i in indices]
+		# Offset between spectra, from the typical intensity range
+		ranges = [numpy.ptp(y) for x, y in spectra if (len(y) > 0)]
+		offset = self.spacingBox.value() * (numpy.median(ranges) if (len(ranges) > 0) else 1.)
+		if (offset <= 0.):
+			offset = 1.
+		segments = []
+		colors = []
+		for k, (x, y) in enumerate(spectra):
+			segments.append(numpy.column_stack((x, y + k*offset)))
+			colors.append('r' if (indices[k] == center) else 'k')
+		self.lines.set_segments(segments)
+		self.lines.set_color(colors)
+		# Limits and labels
+		points = [s for s in segments if (len(s) > 0)]
+		if (len(points) > 0):
+			points = numpy.concatenate(points)
+			xmin, ymin = points.min(axis=0)
+			xmax, ymax = points.max(axis=0)
+			self.axes.set_xlim(xmin, xmax if (xmax > xmin) else xmin+1.)
+			self.axes.set_ylim(ymin - 0.05*offset, ymax + 0.05*offset if (ymax > ymin) else ymin+1.)
+		baselines = [(numpy.min(y) if (len(y) > 0) else 0.) + k*offset for k, (x, y) in enumerate(spectra)]
+		self.axes.set_yticks(baselines)
+		self.axes.set_yticklabels(["%d" % i for i in indices])
+		self.canvas.draw_idle()
+
+
+#################################################################
+#
+# Table with statistics for each azimuth, in a dock panel
+#
+# Rows are updated only for azimuths whose data changed. Azimuths with intensities <= 0, which MAUD does not accept,
+# are shown in red.
+#
+#################################################################
+
+class statisticsDock(PyQt5.QtWidgets.QDockWidget):
+	def __init__(self, parent):
+		super(statisticsDock, self).__init__("Statistics for each azimuth", parent)
+		self.setObjectName("statisticsDock")
+		self.shown = []		# Data arrays shown in each row
+		self.table = PyQt5.QtWidgets.QTableWidget(0, 2+len(statisticsColumns), self)
+		self.table.setHorizontalHeaderLabels(["Id", "Eta", "Points", "Min", "Max", "Median", "I <= 0", "2theta min", "2theta max", "Largest gap"])
+		self.table.verticalHeader().setVisible(False)
+		self.table.setEditTriggers(PyQt5.QtWidgets.QAbstractItemView.NoEditTriggers)
+		self.table.setSelectionBehavior(PyQt5.QtWidgets.QAbstractItemView.SelectRows)
+		self.table.setSelectionMode(PyQt5.QtWidgets.QAbstractItemView.SingleSelection)
+		self.table.setToolTip("Double-click to plot an azimuth")
+		self.table.cellDoubleClicked.connect(self.on_double_click)
+		self.summary = PyQt5.QtWidgets.QLabel("", self)
+		vbox = PyQt5.QtWidgets.QVBoxLayout()
+		vbox.addWidget(self.summary)
+		vbox.addWidget(self.table)
+		widget = PyQt5.QtWidgets.QWidget(self)
+		widget.setLayout(vbox)
+		self.setWidget(widget)
+	
+	def on_double_click(self, row, column):
+		self.parent().etaNBox.setText("%d" % (row))
+		self.parent().new_eta()
+	
+	def show_data(self, esgData, current):
+		"""
+		Updates rows for azimuths that changed since the last call and selects the current azimuth
+		"""
+		if (len(self.shown) != esgData.nEta()):
+			self.table.setRowCount(esgData.nEta())
+			self.shown = [None] * esgData.nEta()
+		stats = esgData.statistics()
+		red = PyQt5.QtGui.QBrush(PyQt5.QtGui.QColor(255, 180, 180))
+		for i in range(0,esgData.nEta()):
+			if (self.shown[i] is esgData.data[i]):
+				continue
+			self.shown[i] = esgData.data[i]
+			values = ["%d" % i, esgData.etas[i], "%d" % stats[i,0]] + ["%.2f" % v for v in stats[i,1:4]] + ["%d" % stats[i,4]] + ["%.3f" % v for v in stats[i,5:7]] + ["%.1f" % stats[i,7]]
+			for j, value in enumerate(values):
+				item = PyQt5.QtWidgets.QTableWidgetItem(value)
+				if (stats[i,4] > 0):
+					item.setBackground(red)
+				self.table.setItem(i, j, item)
+		self.summary.setText("%d points, %d azimuths with intensities <= 0, %d empty azimuths" % (numpy.sum(stats[:,0]), numpy.count_nonzero(stats[:,4] > 0), numpy.count_nonzero(stats[:,0] == 0)))
+		self.table.selectRow(current)
+
+
+#################################################################
+#
+# Worker thread to save ESG files in the background
+#
+#################################################################
+
+class saveEsgWorker(PyQt5.QtCore.QThread):
+	progress = PyQt5.QtCore.pyqtSignal(int, int)
+	done = PyQt5.QtCore.pyqtSignal(bool, str)
+	
+	def __init__(self, esgData, filename, parent=None):
+		"""
+		Send a snapshot of the esg data (EsgDataset) and the name of the file to create. Files that are not ESG files
+		are exported to NPZ or HDF5
+		"""
+		super(saveEsgWorker, self).__init__(parent)
+		self.esgData = esgData
+		self.filename = filename
+		self.cancelled = False
+	
+	def run(self):
+		try:
+			if (isEsgFileName(self.filename)):
+				ok = self.esgData.save(self.filename, self.report)
+			else:
+				ok = self.esgData.export(self.filename, self.report)
+			self.done.emit(ok, "")
+		except Exception as e:
+			self.done.emit(False, str(e))
+	
+	def report(self, i, n):
+		self.progress.emit(i, n)
+		return (not self.cancelled)
+	
+	def cancel(self):
+		self.cancelled = True
+
+
+#################################################################
+#
+# Worker thread for edits on all azimuths
+#
+# The recipe step is applied to a snapshot of the data. The main window sets the result, and saves the undo information,
+# only when the job is finished, so that a cancelled job leaves the data unchanged.
+#
+#################################################################
+
+class editJobWorker(PyQt5.QtCore.QThread):
+	progress = PyQt5.QtCore.pyqtSignal(int, int)
+	done = PyQt5.QtCore.pyqtSignal(bool, str)
+	
+	def __init__(self, esgData, step, description, parent=None):
+		"""
+		Send a snapshot of the esg data (EsgDataset), the recipe step to apply, and a description for the status bar
+		The step can also be {"edit": "estimateBaseline", "width": ..., "gap": ...}, to calculate baselines without changing the data
+		"""
+		super(editJobWorker, self).__init__(parent)
+		self.esgData = esgData
+		self.step = step
+		self.description = description
+		self.result = None
+		self.cancelled = False
+		self.recoveredJournal = None	# Journal file of a crashed session, removed once its edits are applied
+	
+	def run(self):
+		try:
+			if (self.step["edit"] == "estimateBaseline"):
+				self.result = self.esgData.baselines(self.step["width"], self.step["gap"], self.report)
+			else:
+				self.result = self.esgData.recipeData([self.step], self.report)
+			self.done.emit(self.result != None, "")
+		except Exception as e:
+			self.done.emit(False, str(e))
+	
+	def report(self, i, n):
+		self.progress.emit(i, n)
+		return (not self.cancelled)
+	
+	def cancel(self):
+		self.cancelled = True
+
+
+#################################################################
+#
+# Class to build the Graphical User Interface
+#
+#################################################################
+
+# Various matplotlib tricks to adapt the GUI to what we want
+#
+# Access the forward and backward keys in mathplotlib and use them to move between datasets
+# Inspired from 
+# - https://stackoverflow.com/questions/14896580/matplotlib-hooking-in-to-home-back-forward-button-events
+# - https://stackoverflow.com/questions/37506260/adding-an-item-in-matplotlib%C2%B4s-toolbar
+#
+# Not used after all (forgot why). The gui is working ok without it.
+#
+
+#def new_forward(self, *args, **kwargs):
+	#s = 'forward_event'
+	#event = Event(s, self)
+	#event.foo = 100
+	#self.canvas.callbacks.process(s, event)
+	## forward(self, *args, **kwargs) # If you wanted to still call the old forward event
+
+#def new_backward(self, *args, **kwargs):
+	#s = 'backward_event'
+	#event = Event(s, self)
+	#event.foo = 100
+	#self.canvas.callbacks.process(s, event)
+	## backward(self, *args, **kwargs) # If you wanted to still call the old backward event
+
+# def new_home(self, *args, **kwargs):
+#    s = 'home_event'
+#    event = Event(s, self)
+#    event.foo = 100
+#    self.canvas.callbacks.process(s, event)
+#     home(self, *args, **kwargs)
+
+NavigationToolbar.toolitems = (
+	('Home', 'Reset original view', 'home', 'home'), 
+	#('Back', 'Previous spectrum', 'back', 'back'), 
+	#('Forward', 'Next spectrum', 'forward', 'forward'), 
+	#(None, None, None, None), 
+	('Pan', 'Pan axes with left mouse, zoom with right', 'move', 'pan'), 
+	('Zoom', 'Zoom to rectangle', 'zoom_to_rect', 'zoom'), 
+	#(None, None, None, None), 
+	('Save', 'Save the figure', 'filesave', 'save_figure'))
+	#(None, None, None, None))
+
+# NavigationToolbar.home = new_home
+
+# Delay before redrawing after navigation, in ms. Navigation events within this delay are drawn once
+navigationRedrawDelay = 30
+
+class plotEsg(PyQt5.QtWidgets.QMainWindow):
+	
+	"""
+	Constructor
+	
+	Parmeters:
+	
+	"""
+	def __init__(self, parent=None, journalDirectory=None):
+		# Prepare the main window
+		PyQt5.QtWidgets.QMainWindow.__init__(self, parent)
+		pm = PyQt5.QtGui.QPixmap()
+		pm.loadFromData(base64.b64decode(iconXPMbase64))
+		i = PyQt5.QtGui.QIcon()
+		i.addPixmap(pm)
+		self.setWindowIcon(PyQt5.QtGui.QIcon(i))
+		# Setting starting variables
+		self.nEta = 0				# Number of azimuths
+		self.title = "MAUD ESG edit" # Window title
+		self.etaToPlot = 0			# Which azimuth are we looking at
+		self.needToSave = False		# Set True when something has been changed in the data
+		self.olddata = []			# For cancel actions, so we can go back
+		self.oldetaToPlot = []		# For cancel actions, so we can go back
+		self.recipe = []			# Recipe: each edit, with its parameters, in parallel with the undo lists
+		self.fileSaveHint = None	# Hint for file saving
+		self.xbg = []				# Used for creating background
+		self.ybg = []				# Used for creating background
+		self.dounzoom = True		# Unzoom when replotting default)
+		self.nautobg = 5			# Number of points for auto-background
+		self.doautobg = False		# Shall we do autobg?
+		self.pathtomask = None		# Path no mask file
+		self.pathtorecipe = None	# Path to recipe files
+		self.saveWorker = None		# Background thread used when saving data
+		self.editWorker = None		# Background thread used for edits on all azimuths
+		self.baselinePreview = None	# Automatic baselines at all azimuths, before they are subtracted
+		self.hoverIndex = None		# Data points of the current azimuth sorted by 2theta, for the readout under the mouse
+		self.drawnData = None		# Data of the azimuth on the plot, navigation can be ahead of the last redraw
+		self.hoverShown = False		# Is the readout under the mouse displayed in the status bar?
+		self.waterfall = None		# Window with a waterfall of neighbouring azimuths
+		self.statsDock = None		# Dock panel with statistics for each azimuth
+		self.baselineWidth = 0.5	# Half-width of peaks for automatic baselines, in degrees
+		self.baselineGap = 5.		# Automatic baselines are split at gaps in 2theta larger than this times the median step
+		self.journal = None			# Journal of edits on disk, to recover them after a crash
+		self.triageCriteria = None	# Criteria, gap factor, and outlier threshold for next and previous problem, see triageAzimuths
+		# Navigation changes the azimuth right away but redraws through this timer, so that only the latest azimuth is drawn
+		# when navigation events come faster than redraws, with key repeat for instance
+		self.drawTimer = PyQt5.QtCore.QTimer(self)
+		self.drawTimer.setSingleShot(True)
+		self.drawTimer.setInterval(navigationRedrawDelay)
+		self.drawTimer.timeout.connect(self.on_draw)
+		self.journalDirectory = journalDirectory	# Folder for journals, None for the default
+		# Done setting variables, preparing the gui
+		self.create_main_frame()
+		self.on_draw()
+		self.show()
+		# Look for edits of a session that crashed, once the window is up
+		PyQt5.QtCore.QTimer.singleShot(0, self.recover_journal)
+	"""
+	Builds up the GUI
+	"""
+	def create_main_frame(self):
+		
+		# Preparing a frame
+		self.main_frame = PyQt5.QtWidgets.QWidget()
+		self.setWindowTitle(self.title)
+		
+		# Building a menu bar
+		
+		mainMenu = self.menuBar()
+		fileMenu = mainMenu.addMenu('File')
+		editMenu = mainMenu.addMenu('Edit data')
+		bgMenu = mainMenu.addMenu('Background')
+		maskMenu = mainMenu.addMenu('Mask')
+		recipeMenu = mainMenu.addMenu('Recipe')
+		self.editMenus = [editMenu, bgMenu, maskMenu, recipeMenu] # Locked during edits in the background
+		viewMenu = mainMenu.addMenu('View')
+		helpMenu = mainMenu.addMenu('Help')
+		
+		openButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("document-open"), 'Open ESG...', self)
+		openButton.setShortcut('Ctrl+O')
+		openButton.setStatusTip('Open MAUD ESG file...')
 		openButton.triggered.connect(self.open_esg)
 		fileMenu.addAction(openButton)
 		
-		saveButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("document-save-as"), 'Save new ESG...', self)
-		saveButton.setShortcut('Ctrl+S')
-		saveButton.setStatusTip('Save new data for processing in MAUD')
-		saveButton.triggered.connect(self.save_esg)
-		fileMenu.addAction(saveButton)
+		self.saveButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("document-save-as"), 'Save new ESG...', self)
+		self.saveButton.setShortcut('Ctrl+S')
+		self.saveButton.setStatusTip('Save new data for processing in MAUD')
+		self.saveButton.triggered.connect(self.save_esg)
+		fileMenu.addAction(self.saveButton)
+		
+		integrateButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("document-import"), 'Integrate images...', self)
+		integrateButton.setStatusTip('Integrate 2D detector images into ESG files, and open the first one')
+		integrateButton.triggered.connect(self.integrate_images)
+		fileMenu.addAction(integrateButton)
 		
 		fileMenu.addSeparator()
 		
+		self.exportButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("document-send"), 'Export to NPZ or HDF5...', self)
+		self.exportButton.setStatusTip('Export data in binary format, one array per column, for other programs')
+		self.exportButton.triggered.connect(self.export_data)
+		fileMenu.addAction(self.exportButton)
+		
 		exitButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("application-exit"), 'Exit', self)
 		exitButton.setShortcut('Ctrl+Q')
 		exitButton.setStatusTip('I am done!')
@@ -718,6 +1158,36 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 		self.tthetaButton.setDisabled(True)
 		editMenu.addAction(self.tthetaButton)
 		
+		self.rebinButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("view-sort-ascending"), 'Rebin 2theta...', self)
+		self.rebinButton.setStatusTip('Group data points in bins of 2theta at all azimuths, to reduce the number of points.')
+		self.rebinButton.triggered.connect(self.rebin_data)
+		self.rebinButton.setDisabled(True)
+		editMenu.addAction(self.rebinButton)
+		
+		self.calibButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("preferences-system"), 'Detector geometry...', self)
+		self.calibButton.setStatusTip('Change the detector distance or angles and recalculate 2theta for all azimuths.')
+		self.calibButton.triggered.connect(self.recalibrate)
+		self.calibButton.setDisabled(True)
+		editMenu.addAction(self.calibButton)
+		
+		self.refineCalibButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("preferences-system"), 'Refine detector geometry...', self)
+		self.refineCalibButton.setStatusTip('Refine detector angles so that diffraction peaks are at the same 2theta at all azimuths. Inclined detectors only.')
+		self.refineCalibButton.triggered.connect(self.refine_calibration)
+		self.refineCalibButton.setDisabled(True)
+		editMenu.addAction(self.refineCalibButton)
+		
+		self.resectorButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("view-refresh"), 'Re-sector azimuths...', self)
+		self.resectorButton.setStatusTip('Regroup all data points in a new number of azimuthal sectors and save them in a new ESG. Inclined detectors only.')
+		self.resectorButton.triggered.connect(self.resector)
+		self.resectorButton.setDisabled(True)
+		editMenu.addAction(self.resectorButton)
+		
+		self.mergeButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("view-refresh"), 'Merge azimuths...', self)
+		self.mergeButton.setStatusTip('Average groups of adjacent azimuths into single azimuths and save them in a new ESG.')
+		self.mergeButton.triggered.connect(self.merge)
+		self.mergeButton.setDisabled(True)
+		editMenu.addAction(self.mergeButton)
+		
 		self.cancelButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("edit-undo"), 'Undo', self)
 		self.cancelButton.setShortcut('Ctrl+Z')
 		self.cancelButton.setStatusTip('I screwed up!')
@@ -743,6 +1213,17 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 		self.subtractBgButton.setDisabled(True)
 		bgMenu.addAction(self.subtractBgButton)
 		
+		delButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("edit-find"), 'Estimate automatic baseline...', self)
+		delButton.setStatusTip('This will calculate a baseline at all azimuths and show it in green, without changing the data.')
+		delButton.triggered.connect(self.estimate_baseline)
+		bgMenu.addAction(delButton)
+		
+		self.subtractBaselineButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("edit-cut"), 'Subtract automatic baseline', self)
+		self.subtractBaselineButton.setStatusTip('This will subtract the automatic baseline in green from the data, at all azimuths.')
+		self.subtractBaselineButton.triggered.connect(self.subtract_baseline)
+		self.subtractBaselineButton.setDisabled(True)
+		bgMenu.addAction(self.subtractBaselineButton)
+		
 		delButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("go-up"), 'Shift dataset...', self)
 		delButton.setStatusTip('This will add a given value to all intensities for the current dataset.')
 		delButton.triggered.connect(self.shift_data)
@@ -769,6 +1250,58 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 		saveMaskButton.triggered.connect(self.save_mask)
 		maskMenu.addAction(saveMaskButton)
 		
+		maskMenu.addSeparator()
+		
+		self.detectorMaskButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("edit-cut"), 'Mask detector region...', self)
+		self.detectorMaskButton.setStatusTip('Remove data points within a rectangle or polygon in detector x,y positions, at all azimuths. Inclined detectors only.')
+		self.detectorMaskButton.triggered.connect(self.mask_detector_region)
+		self.detectorMaskButton.setDisabled(True)
+		maskMenu.addAction(self.detectorMaskButton)
+		
+		loadRecipeButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("document-open"), 'Load and apply recipe...', self)
+		loadRecipeButton.setStatusTip('Replay edits saved from another file')
+		loadRecipeButton.triggered.connect(self.load_and_apply_recipe)
+		recipeMenu.addAction(loadRecipeButton)
+		
+		saveRecipeButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("document-save-as"), 'Save recipe...', self)
+		saveRecipeButton.setStatusTip('Save all edits, with their parameters, to replay them on other files')
+		saveRecipeButton.triggered.connect(self.save_recipe)
+		recipeMenu.addAction(saveRecipeButton)
+		
+		# Statistics for each azimuth, in a dock panel at the bottom
+		self.statsDock = statisticsDock(self)
+		self.addDockWidget(PyQt5.QtCore.Qt.BottomDockWidgetArea, self.statsDock)
+		statsButton = self.statsDock.toggleViewAction()
+		statsButton.setText('Statistics for each azimuth')
+		statsButton.setStatusTip('Show or hide the table with statistics for each azimuth')
+		viewMenu.addAction(statsButton)
+		
+		waterfallButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("view-list-details"), 'Waterfall of neighbouring azimuths...', self)
+		waterfallButton.setShortcut('Ctrl+W')
+		waterfallButton.setStatusTip('Show the azimuths around the current one, stacked vertically')
+		waterfallButton.triggered.connect(self.show_waterfall)
+		viewMenu.addAction(waterfallButton)
+		
+		viewMenu.addSeparator()
+		
+		triageButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("dialog-warning"), 'Triage azimuths...', self)
+		triageButton.setShortcut('Ctrl+Shift+T')
+		triageButton.setStatusTip('Choose which azimuths need attention: intensities <= 0, empty, gaps in 2theta, outliers, or not edited yet')
+		triageButton.triggered.connect(self.triage_azimuths)
+		viewMenu.addAction(triageButton)
+		
+		nextProblemButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("go-next"), 'Next problem', self)
+		nextProblemButton.setShortcut('Ctrl+Shift+N')
+		nextProblemButton.setStatusTip('Move to the next azimuth that needs attention')
+		nextProblemButton.triggered.connect(self.next_problem)
+		viewMenu.addAction(nextProblemButton)
+		
+		previousProblemButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("go-previous"), 'Previous problem', self)
+		previousProblemButton.setShortcut('Ctrl+Shift+P')
+		previousProblemButton.setStatusTip('Move to the previous azimuth that needs attention')
+		previousProblemButton.triggered.connect(self.previous_problem)
+		viewMenu.addAction(previousProblemButton)
+		
 		aboutButton = PyQt5.QtWidgets.QAction(PyQt5.QtGui.QIcon.fromTheme("help-contents"), 'User manual...', self)
 		aboutButton.setShortcut('Ctrl+H')
 		aboutButton.setStatusTip('What is this thing?!')
@@ -796,18 +1329,28 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 		buttonN = PyQt5.QtWidgets.QPushButton('Next', self)
 		buttonN.setToolTip('Move to next spectrum')
 		buttonN.clicked.connect(self.handle_forward)
+		self.problemPButton = PyQt5.QtWidgets.QPushButton('Previous problem', self)
+		self.problemPButton.setToolTip('Move to the previous azimuth that needs attention, see View -> Triage azimuths')
+		self.problemPButton.clicked.connect(self.previous_problem)
+		self.problemNButton = PyQt5.QtWidgets.QPushButton('Next problem', self)
+		self.problemNButton.setToolTip('Move to the next azimuth that needs attention, see View -> Triage azimuths')
+		self.problemNButton.clicked.connect(self.next_problem)
 		# deleteLabel = PyQt5.QtWidgets.QLabel("Remove data points", self)
 		buttonD = PyQt5.QtWidgets.QPushButton("Remove data points", self)
+		self.editPushButtons = [buttonD] # Locked during edits in the background
 		buttonD.setToolTip('This will remove all data points within the plot below. Zoom into the region where you want the points removed.')
 		buttonD.clicked.connect(self.remove_points)
 		buttonBg = PyQt5.QtWidgets.QPushButton("Subtract background", self)
 		buttonBg.setToolTip('This will subtract the linear background in blue from the data. Right-click on the mouse to add background points.')
 		buttonBg.clicked.connect(self.subtract_background)
+		self.editPushButtons.append(buttonBg)
 		hlay = PyQt5.QtWidgets.QHBoxLayout()
 		hlay.addWidget(self.etaLabel)
 		hlay.addWidget(buttonP)
 		hlay.addWidget(self.etaNBox)
 		hlay.addWidget(buttonN)
+		hlay.addWidget(self.problemPButton)
+		hlay.addWidget(self.problemNButton)
 		hlay.addStretch(1)
 		#hlay.addItem(PyQt5.QtWidgets.QSpacerItem(300, 10, PyQt5.QtWidgets.QSizePolicy.Expanding))
 		#hlay.addWidget(deleteLabel)
@@ -846,7 +1389,9 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 		self.canvas = FigureCanvas(self.fig)
 		self.canvas.setParent(self.main_frame)
 		self.canvas.setFocusPolicy(PyQt5.QtCore.Qt.StrongFocus)
+		self.canvas.setMinimumHeight(400)	# Keeps room for the plot next to the dock panels
 		self.canvas.mpl_connect('button_press_event', self.on_press) 
+		self.canvas.mpl_connect('motion_notify_event', self.on_motion) 
 		self.canvas.setFocus()
 
 		# Adding a toolbar and trying to deal with the events
@@ -854,7 +1399,7 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 		#self.fig.canvas.mpl_connect('backward_event', self.handle_backward)
 		self.mpl_toolbar = NavigationToolbar(self.canvas, self.main_frame)
 		#self.mpl_toolbar.home_event = self.on_draw
-		self.canvas.mpl_connect('home_event', self.on_draw)
+		#self.canvas.mpl_connect('home_event', self.on_draw)	# Not a matplotlib event, recent versions refuse it
 		#self.mpl_toolbar.forward = new_forward
 		#self.mpl_toolbar.back = new_backward
 
@@ -870,6 +1415,28 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 		#windowLabel.setOpenExternalLinks(True)
 		windowLabel.setAlignment(PyQt5.QtCore.Qt.AlignRight | PyQt5.QtCore.Qt.AlignVCenter)
 		vbox.addWidget(windowLabel)
+		
+		# Progress bar and cancel button in the status bar, visible while saving in the background
+		self.saveProgress = PyQt5.QtWidgets.QProgressBar(self)
+		self.saveProgress.setMaximumWidth(200)
+		self.saveProgress.hide()
+		self.saveCancelButton = PyQt5.QtWidgets.QPushButton("Cancel save", self)
+		self.saveCancelButton.setToolTip('Stop saving. The file will not be created.')
+		self.saveCancelButton.clicked.connect(self.cancel_save_esg)
+		self.saveCancelButton.hide()
+		self.statusBar().addPermanentWidget(self.saveProgress)
+		self.statusBar().addPermanentWidget(self.saveCancelButton)
+		
+		# Progress bar and cancel button in the status bar, visible during edits in the background
+		self.editProgress = PyQt5.QtWidgets.QProgressBar(self)
+		self.editProgress.setMaximumWidth(200)
+		self.editProgress.hide()
+		self.editCancelButton = PyQt5.QtWidgets.QPushButton("Cancel edit", self)
+		self.editCancelButton.setToolTip('Stop the current edit. Data will not be changed.')
+		self.editCancelButton.clicked.connect(self.cancel_edit_job)
+		self.editCancelButton.hide()
+		self.statusBar().addPermanentWidget(self.editProgress)
+		self.statusBar().addPermanentWidget(self.editCancelButton)
 
 		# We are done...
 		self.main_frame.setLayout(vbox)
@@ -879,6 +1446,7 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 	Draws or redraws the plot
 	"""
 	def on_draw(self, event=None):
+		self.drawTimer.stop()	# Pending navigation redraws are done here
 		#print ("We are in there")
 		# If we want to keep track of the zoom, we save the current zoom
 		if (not self.dounzoom):
@@ -899,11 +1467,13 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 			title = ""
 			self.axes.set_title(title, loc='left')
 			self.delPointsButton.setDisabled(True)
+			self.drawnData = None
 			# Ready to draw
 			self.canvas.draw()
 			return
 		# Getting plot data
-		data = numpy.asarray(self.esgData["data"][self.etaToPlot])
+		data = self.esgData.data[self.etaToPlot]
+		self.drawnData = data
 		if (data.size > 0):
 			twotheta = data[:,0]
 			intensity = data[:,2]
@@ -948,6 +1518,11 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 			#self.ybg.append(intensity[len(intensity)-1])
 			
 		
+		# If we have an automatic baseline for these data, add it on
+		if ((self.baselinePreview != None) and (self.baselinePreview["data"][self.etaToPlot] is data) and (data.size > 0)):
+			order = numpy.argsort(twotheta, kind='stable')
+			self.axes.plot(twotheta[order], self.baselinePreview["baselines"][self.etaToPlot][order], color='green', linestyle='solid', linewidth=1.5)
+		
 		# If we have background data, add it on
 		if (len(self.xbg) > 0):
 			g1 = self.axes.plot(self.xbg, self.ybg, color='blue', marker='o', linestyle='solid', linewidth=2, markersize=8)
@@ -962,11 +1537,32 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 		# Title and labels
 		self.axes.set_xlabel("2theta")
 		self.axes.set_ylabel("intensity")
-		title = "Id %d, eta %s %s" % (self.etaToPlot, self.esgData["etas"][self.etaToPlot], extralabel)
+		title = "Id %d, eta %s %s" % (self.etaToPlot, self.esgData.etas[self.etaToPlot], extralabel)
 		self.axes.set_title(title, loc='left')
 		
 		# Ready to draw
 		self.canvas.draw()
+		
+		# Follow in the waterfall, if open
+		if ((self.waterfall != None) and self.waterfall.isVisible()):
+			self.waterfall.show_data(self.esgData, self.etaToPlot)
+		# Update statistics, only for azimuths that changed
+		if (self.statsDock != None):
+			self.statsDock.show_data(self.esgData, self.etaToPlot)
+
+	"""
+	Redraw soon, for navigation. Requests that come before the redraw are merged into it
+	"""
+	def request_draw(self):
+		if (not self.drawTimer.isActive()):
+			self.drawTimer.start()
+	
+	"""
+	Redraw now if a redraw was requested, so that the plot shows the azimuth that is about to be edited
+	"""
+	def flush_draw(self):
+		if (self.drawTimer.isActive()):
+			self.on_draw()
 
 	"""
 	Event processing: we need to change dataset based on text input
@@ -980,7 +1576,7 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 				self.xbg = []				# Used for creating background
 				self.ybg = []				# Used for creating background
 				self.subtractBgButton.setDisabled(True)
-				self.on_draw()
+				self.request_draw()
 			except ValueError:
 				PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Not an integer")
 
@@ -995,7 +1591,7 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 			self.xbg = []				# Used for creating background
 			self.ybg = []				# Used for creating background
 			self.subtractBgButton.setDisabled(True)
-			self.on_draw()
+			self.request_draw()
 
 	"""
 	Event processing when right arrow is click (move to next dataset)
@@ -1007,31 +1603,77 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 			self.xbg = []				# Used for creating background
 			self.ybg = []				# Used for creating background
 			self.subtractBgButton.setDisabled(True)
-			self.on_draw()
+			self.request_draw()
 		
+	"""
+	Choose the criteria for azimuths that need attention, and move to the first one
+	"""
+	def triage_azimuths(self,evt=None):
+		if (self.nEta <= 0):
+			PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Please load some data first")
+			return
+		if (self.triageCriteria != None):
+			dialog = triageDialog(self, *self.triageCriteria)
+		else:
+			dialog = triageDialog(self)
+		result = dialog.exec_()
+		if (not dialog.isOk()):
+			return
+		self.triageCriteria = dialog.getInputs()
+		self.goto_problem(0, True)
+	
+	"""
+	Move to the next or previous azimuth that needs attention
+	"""
+	def next_problem(self,evt=None):
+		self.goto_problem(1)
+	
+	def previous_problem(self,evt=None):
+		self.goto_problem(-1)
+	
+	"""
+	Move to the first azimuth in direction (1 or -1) that matches the triage criteria, wrapping around at the ends
+	The queue is built again each time from the cached statistics, azimuths that were fixed drop out of it
+	If include is True, the current azimuth counts as well
+	"""
+	def goto_problem(self, direction, include=False):
+		if (self.nEta <= 0):
+			return
+		if (self.triageCriteria == None):
+			self.triage_azimuths()
+			return
+		criteria, gapfactor, threshold = self.triageCriteria
+		triage = self.esgData.triage(criteria, gapfactor, threshold)
+		if (len(triage) == 0):
+			self.statusBar().showMessage("No azimuth needs attention", 5000)
+			return
+		queue = sorted(triage)
+		if (include and (self.etaToPlot in triage)):
+			i = self.etaToPlot
+		elif (direction >= 0):
+			i = next((k for k in queue if (k > self.etaToPlot)), queue[0])
+		else:
+			i = next((k for k in reversed(queue) if (k < self.etaToPlot)), queue[-1])
+		self.etaNBox.setText("%d" % (i))
+		self.new_eta()
+		self.statusBar().showMessage("Problem %d of %d, azimuth %d: %s" % (queue.index(i)+1, len(queue), i, ", ".join(triageLabels[name].lower() for name in triage[i])))
+	
 	"""
 	Event processing to remove data points from a dataset
 	"""
 	def remove_points(self,evt=None):
+		if (self.edits_locked()):
+			return
+		self.flush_draw()
 		if (self.nEta > 0):
 			# Getting the X and Y ranges to be remove
 			left, right = self.axes.get_xlim()
 			bottom, top = self.axes.get_ylim()
-			data = numpy.asarray(self.esgData["data"][self.etaToPlot])
 			# Saving old data for undos
-			self.olddata.append(data)
+			self.olddata.append(self.esgData.data[self.etaToPlot])
 			self.oldetaToPlot.append(self.etaToPlot)
-			# Saving range to remove to mask
-			self.mask.append({"set":True, "eta": self.etaToPlot, "clear2thetamin": left, "clear2thetamax": right})
-			# Remove points within our range
-			toremove = []
-			for i in range(data.shape[0]):
-				twotheta = data[i,0]
-				intensity = data[i,2]
-				if ((twotheta>left) and (twotheta<right) and (intensity>bottom) and (intensity<top)):
-					toremove.append(i)
-			data = numpy.delete(data,toremove,0)
-			self.esgData["data"][self.etaToPlot] = data.tolist()
+			# Remove points within our range, and save the edit in the recipe
+			self.record_edit(self.esgData.removePoints(self.etaToPlot, left, right, bottom, top))
 			# We change something. We should ask confirmation for saving before closing the app, we can also undo stuff from now on
 			self.needToSave = True
 			self.cancelButton.setDisabled(False)
@@ -1042,79 +1684,430 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 			self.on_draw()
 			
 	"""
-	Restrict 2 theta range based on user input
+	Restrict 2 theta range based on user input
+	"""
+	def edit_twothetarange(self,evt=None):
+		if (self.edits_locked()):
+			return
+		if (self.nEta > 0):
+			test = TThethaRangeDialog(self)
+			result = test.exec_()
+			if (test.isOk()):
+				min2theta,max2theta = test.getInputs()
+				# Remove points outside our 2theta range
+				self.start_edit_job({"edit": "crop", "min2theta": min2theta, "max2theta": max2theta}, "Restricting 2theta range")
+		return
+	
+	"""
+	Change the detector geometry and recalculate 2theta for all azimuths, without reloading the file
+	"""
+	def recalibrate(self,evt=None):
+		if (self.edits_locked()):
+			return
+		if (self.nEta <= 0):
+			return
+		if (self.esgData.esgtype == "inclinedReflection"):
+			dialog = inclinedDetectorDialog(self, self.esgData.detdistance, self.esgData.detTTheta, self.esgData.detTilt, self.esgData.detRotation, self.esgData.detEta)
+			result = dialog.exec_()
+			if (not dialog.isOk()):
+				return
+			params = dialog.getInputs()
+		else:
+			detdistance,ok = PyQt5.QtWidgets.QInputDialog.getDouble(self,"Detector geometry","Detector distance (mm)", self.esgData.detdistance, 0.001, 1.e6, 3)
+			if (not ok):
+				return
+			params = (detdistance,)
+		self.start_edit_job({"edit": "recalibrate", "detparams": [self.esgData.esgtype] + [float(p) for p in params]}, "Calculating 2theta")
+	
+	"""
+	Refine detector angles from the positions of diffraction peaks at all azimuths, and recalculate 2theta if the user agrees
+	"""
+	def refine_calibration(self,evt=None):
+		if (self.edits_locked()):
+			return
+		if ((self.nEta <= 0) or (self.esgData.esgtype != "inclinedReflection")):
+			return
+		left, right = self.axes.get_xlim()
+		dialog = detectorRefinementDialog(self, "%.3f %.3f" % (left, right))
+		result = dialog.exec_()
+		if (not dialog.isOk()):
+			return
+		peaks, free = dialog.getInputs()
+		PyQt5.QtWidgets.QApplication.setOverrideCursor(PyQt5.QtCore.Qt.WaitCursor)
+		try:
+			detparams, before, after = self.esgData.refineDetector(peaks, free)
+		except ValueError as e:
+			PyQt5.QtWidgets.QApplication.restoreOverrideCursor()
+			PyQt5.QtWidgets.QMessageBox.critical(self, "Error", str(e))
+			return
+		PyQt5.QtWidgets.QApplication.restoreOverrideCursor()
+		message = "Scatter of peak positions: %.4f degrees, was %.4f degrees\n\n" % (after, before)
+		message += "Distance %.3f mm, 2theta %.3f, tilt %.3f, rotation %.3f, eta %.3f degrees\n\n" % tuple(detparams[1:])
+		message += "Recalculate 2theta with this geometry?"
+		buttonReply = PyQt5.QtWidgets.QMessageBox.question(self, 'Refined detector geometry', message, PyQt5.QtWidgets.QMessageBox.Yes | PyQt5.QtWidgets.QMessageBox.No, PyQt5.QtWidgets.QMessageBox.Yes)
+		if (buttonReply == PyQt5.QtWidgets.QMessageBox.Yes):
+			self.start_edit_job({"edit": "recalibrate", "detparams": detparams}, "Calculating 2theta")
+	
+	"""
+	Regroup all data points in a new number of azimuthal sectors and save the result in a new ESG
 	"""
-	def edit_twothetarange(self,evt=None):
-		if (self.nEta > 0):
-			test = TThethaRangeDialog(self)
-			result = test.exec_()
-			if (test.isOk()):
-				min2theta,max2theta = test.getInputs()
-				# Saving old data for undos
-				data = copy.deepcopy(self.esgData["data"])
-				self.olddata.append(data)
-				self.oldetaToPlot.append("all")
-				# Remove points outside our 2theta range
-				for i in range(0,self.nEta):
-					thisetadata = numpy.asarray(self.esgData["data"][i])
-					toremove = []
-					for j in range(thisetadata.shape[0]):
-						twotheta = thisetadata[j,0]
-						intensity = thisetadata[j,2]
-						if ((twotheta>max2theta) or (twotheta<min2theta)):
-							toremove.append(j)
-					thisetadata = numpy.delete(thisetadata,toremove,0)
-					self.esgData["data"][i] = thisetadata.tolist()
-				self.needToSave = True
-				self.cancelButton.setDisabled(False)
-				self.on_draw()
-		return
+	def resector(self,evt=None):
+		if ((self.nEta <= 0) or (self.esgData.esgtype != "inclinedReflection")):
+			return
+		if (self.saveWorker != None):
+			PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Already saving data, please wait")
+			return
+		nsectors,ok = PyQt5.QtWidgets.QInputDialog.getInt(self,"Re-sector azimuths","Number of azimuthal sectors", self.nEta, 1, 3600)
+		if (not ok):
+			return
+		options = PyQt5.QtWidgets.QFileDialog.Options()
+		fileName, _ = PyQt5.QtWidgets.QFileDialog.getSaveFileName(self,"Save re-sectored data as...", "",esgFileFilter, options=options)
+		if fileName:
+			try:
+				newesg = self.esgData.resector(nsectors)
+			except ValueError as e:
+				PyQt5.QtWidgets.QMessageBox.critical(self, "Error", str(e))
+				return
+			self.start_save(newesg, fileName, False)
+	
+	"""
+	Merge groups of azimuths and save the result in a new ESG
+	"""
+	def merge(self,evt=None):
+		if (self.nEta <= 0):
+			return
+		if (self.saveWorker != None):
+			PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Already saving data, please wait")
+			return
+		text,ok = PyQt5.QtWidgets.QInputDialog.getText(self,"Merge azimuths","Number of adjacent azimuths to merge, or groups of azimuths (0-3, 4-7, ...)", text="2")
+		if (not ok):
+			return
+		try:
+			groups = parseAzimuthGroups(text, self.nEta)
+		except ValueError as e:
+			PyQt5.QtWidgets.QMessageBox.critical(self, "Error", str(e))
+			return
+		options = PyQt5.QtWidgets.QFileDialog.Options()
+		fileName, _ = PyQt5.QtWidgets.QFileDialog.getSaveFileName(self,"Save merged data as...", "",esgFileFilter, options=options)
+		if fileName:
+			try:
+				newesg = self.esgData.merge(groups)
+			except ValueError as e:
+				PyQt5.QtWidgets.QMessageBox.critical(self, "Error", str(e))
+				return
+			self.start_save(newesg, fileName, False)
 	
 	"""
 	Event processing when we want to cancel. Go back to the last version.
 	"""
 	def cancel_last(self,evt=None):
+		if (self.edits_locked()):
+			return
 		if ((len(self.olddata)>0) and (self.nEta > 0)):
 			# We pop the elements of the self.oldetaToPlot and self.olddata lists and set them as the new data
 			test = self.oldetaToPlot.pop()
 			if (test == "all"): # We changed the 2 theta range or something that affects all azimuths
-				self.esgData["data"] = self.olddata.pop()
+				self.esgData.data = self.olddata.pop()
+			elif (test == "calibration"): # We changed the detector geometry, we go back to old data and geometry
+				# Saved arrays already have the 2theta of the old geometry, and are still those of the original file when not edited
+				data, calibration = self.olddata.pop()
+				self.esgData.data = data
+				self.esgData.setDetparams(calibration)
 			else: # We changed something that affects a single azimuth
 				self.etaToPlot = test
 				self.etaNBox.setText("%d" % (self.etaToPlot))
-				self.esgData["data"][self.etaToPlot] = self.olddata.pop()
+				self.esgData.data[self.etaToPlot] = self.olddata.pop()
 				# Replot
 			if (len(self.olddata) == 0):
 				self.cancelButton.setDisabled(True)
-			self.mask.pop() # Remove last addition to mask
+			self.recipe.pop() # Remove last step of the recipe
+			if (self.journal != None):
+				self.write_journal(self.journal.undo)
+			self.on_draw()
+	
+	"""
+	Save an edit in the recipe and in the journal
+	"""
+	def record_edit(self, step):
+		self.recipe.append(step)
+		if (self.journal != None):
+			self.write_journal(self.journal.append, step)
+	
+	"""
+	Write in the journal. If it fails, we keep editing without journal
+	"""
+	def write_journal(self, action, *args):
+		try:
+			action(*args)
+		except (IOError, OSError, ValueError) as e:
+			self.journal = None
+			PyQt5.QtWidgets.QMessageBox.warning(self, "Warning", "Could not write the journal of edits, edits will not be recovered after a crash: %s" % e)
+	
+	"""
+	Start a journal for the edits on the current file, closing the previous one
+	"""
+	def start_journal(self):
+		self.end_journal()
+		try:
+			self.journal = EditJournal.start(self.esgData, self.journalDirectory)
+		except (IOError, OSError) as e:
+			self.statusBar().showMessage("Could not create the journal of edits: %s" % e, 5000)
+	
+	"""
+	Close and remove the journal, when the session ends normally
+	"""
+	def end_journal(self):
+		if (self.journal != None):
+			try:
+				self.journal.close()
+			except (IOError, OSError):
+				pass
+			self.journal = None
+	
+	"""
+	Offer to recover edits from the journal of a session that did not end normally
+	"""
+	def recover_journal(self):
+		for filename, header, steps in findJournals(self.journalDirectory):
+			if (len(steps) == 0):
+				os.remove(filename)
+				continue
+			if (not os.path.exists(header["source"])):
+				continue
+			message = "%d edits on %s, from a session started on %s, were not saved. Recover them?" % (len(steps), header["source"], header["date"])
+			if (not journalSourceIsUnchanged(header)):
+				message += "\n\nThe file has changed since, edits may not apply as they did."
+			buttonReply = PyQt5.QtWidgets.QMessageBox.question(self, 'Recover edits', message, PyQt5.QtWidgets.QMessageBox.Yes | PyQt5.QtWidgets.QMessageBox.No | PyQt5.QtWidgets.QMessageBox.Discard, PyQt5.QtWidgets.QMessageBox.Yes)
+			if (buttonReply == PyQt5.QtWidgets.QMessageBox.Discard):
+				os.remove(filename)
+			elif (buttonReply == PyQt5.QtWidgets.QMessageBox.Yes):
+				try:
+					esgData = EsgDataset.fromFile(header["source"], header["detparams"])
+				except (IOError, ValueError) as e:
+					PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Could not read %s: %s" % (header["source"], e))
+					return
+				self.set_data(esgData, header["source"])
+				# Recovered edits are applied as a single edit, the old journal is removed once they are
+				self.start_edit_job({"edit": "recipe", "steps": steps}, "Recovering edits")
+				if (self.editWorker != None):
+					self.editWorker.recoveredJournal = filename
+				return
+	
+	"""
+	Starts an edit on all azimuths in the background. Other edits are locked until it is finished
+	"""
+	def start_edit_job(self, step, description):
+		if (self.edits_locked()):
+			return
+		self.editWorker = editJobWorker(self.esgData.copy(), step, description, self)
+		self.editWorker.progress.connect(self.edit_job_progress)
+		self.editWorker.done.connect(self.edit_job_done)
+		self.lock_edits(True)
+		self.editProgress.setRange(0, self.nEta)
+		self.editProgress.setValue(0)
+		self.editProgress.show()
+		self.editCancelButton.show()
+		self.statusBar().showMessage(description + "...")
+		self.editWorker.start()
+	
+	"""
+	True, with a message, if an edit is running in the background
+	"""
+	def edits_locked(self):
+		if (self.editWorker != None):
+			self.statusBar().showMessage("Please wait, %s" % self.editWorker.description.lower(), 3000)
+			return True
+		return False
+	
+	"""
+	Lock or unlock menus and buttons that change the data
+	"""
+	def lock_edits(self, locked):
+		for widget in self.editMenus + self.editPushButtons:
+			widget.setDisabled(locked)
+		
+	"""
+	Progress report from the background edit
+	"""
+	def edit_job_progress(self, i, n):
+		self.editProgress.setValue(i)
+	
+	"""
+	User wants to stop the background edit
+	"""
+	def cancel_edit_job(self,evt=None):
+		if (self.editWorker != None):
+			self.editWorker.cancel()
+	
+	"""
+	Background edit is finished, cancelled, or failed. Data and undo information are set at once
+	"""
+	def edit_job_done(self, ok, error):
+		worker = self.editWorker
+		worker.wait()
+		self.editWorker = None
+		self.lock_edits(False)
+		self.editProgress.hide()
+		self.editCancelButton.hide()
+		if (not ok):
+			if (error != ""):
+				self.statusBar().clearMessage()
+				PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "%s failed: %s" % (worker.description, error))
+			else:
+				self.statusBar().showMessage("%s cancelled, data were not changed" % worker.description, 5000)
+			return
+		if (worker.step["edit"] == "estimateBaseline"):
+			# Baselines are only shown, for the data they were calculated on
+			self.baselinePreview = {"data": worker.esgData.data, "baselines": worker.result}
+			self.subtractBaselineButton.setDisabled(False)
+			self.statusBar().clearMessage()
+			self.dounzoom = False
 			self.on_draw()
+			return
+		# Saving old data for undos, with the detector geometry if the edit may change it
+		if (worker.step["edit"] in ["recalibrate", "recipe"]):
+			self.olddata.append((list(self.esgData.data), self.esgData.detparams()))
+			self.oldetaToPlot.append("calibration")
+		else:
+			self.olddata.append(list(self.esgData.data))
+			self.oldetaToPlot.append("all")
+		self.esgData.commitRecipe([worker.step], worker.result)
+		self.record_edit(worker.step)
+		if (worker.recoveredJournal != None):
+			# Recovered edits are in the journal of this session now
+			os.remove(worker.recoveredJournal)
+		# We change something. We should ask confirmation for saving before closing the app, we can also undo stuff from now on
+		# Detector geometry is not saved in ESG files
+		if (worker.step["edit"] != "recalibrate"):
+			self.needToSave = True
+		self.cancelButton.setDisabled(False)
+		if (worker.step["edit"] == "subtractBaseline"):
+			self.baselinePreview = None
+			self.subtractBaselineButton.setDisabled(True)
+		self.xbg = []				# Used for creating background
+		self.ybg = []				# Used for creating background
+		self.subtractBgButton.setDisabled(True)
+		self.statusBar().clearMessage()
+		# Redraw everything
+		self.on_draw()
 	
 	"""
 	Event to quit the app
 	"""
 	def closeEvent(self,evt=None):
-		if (self.needToSave):
+		if (self.saveWorker != None):
+			buttonReply = PyQt5.QtWidgets.QMessageBox.question(self, 'Saving data', "Data are still being saved. Quit anyway? The file will not be created.", PyQt5.QtWidgets.QMessageBox.Yes | PyQt5.QtWidgets.QMessageBox.No, PyQt5.QtWidgets.QMessageBox.No)
+			if (buttonReply == PyQt5.QtWidgets.QMessageBox.No):
+				if (isinstance(evt,PyQt5.QtGui.QCloseEvent)):
+					evt.ignore()
+				return
+		if (self.needToSave or (self.editWorker != None)):
 			buttonReply = PyQt5.QtWidgets.QMessageBox.question(self, 'Data not saved', "Data not saved. Quit anyway?", PyQt5.QtWidgets.QMessageBox.Yes | PyQt5.QtWidgets.QMessageBox.No, PyQt5.QtWidgets.QMessageBox.No)
 			if (buttonReply == PyQt5.QtWidgets.QMessageBox.No):
 				if (isinstance(evt,PyQt5.QtGui.QCloseEvent)):
 					evt.ignore()
 				return
+		# The user agreed to quit, background work can be stopped
+		if (self.editWorker != None):
+			self.editWorker.cancel()
+			self.editWorker.wait()
+		if (self.saveWorker != None):
+			self.saveWorker.cancel()
+			self.saveWorker.wait()
+		self.end_journal()
 		if (isinstance(evt,PyQt5.QtGui.QCloseEvent)):
 			evt.accept()
 		sys.exit(2)
 
+	"""
+	Export data to NPZ or HDF5, in the background
+	"""
+	def export_data(self,evt=None):
+		if (self.nEta <= 0):
+			PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Please load some data first")
+			return
+		if (self.saveWorker != None):
+			PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Already saving data, please wait")
+			return
+		options = PyQt5.QtWidgets.QFileDialog.Options()
+		fileName, _ = PyQt5.QtWidgets.QFileDialog.getSaveFileName(self,"Export data as...", "","NumPy Files (*.npz);;HDF5 Files (*.h5 *.hdf5);;All Files (*)", options=options)
+		if fileName:
+			self.start_save(self.esgData.copy(), fileName, False)
+	
 	"""
 	Save current dataset to ESG format
+	Data are written in a background thread, from a snapshot of the current data, so we can keep editing in the meantime
 	"""
 	def save_esg(self,evt=None):
+		if (self.nEta <= 0):
+			return
+		if (self.saveWorker != None):
+			PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Already saving data, please wait")
+			return
 		options = PyQt5.QtWidgets.QFileDialog.Options()
-		fileName, _ = PyQt5.QtWidgets.QFileDialog.getSaveFileName(self,"Save new data as...", "","Esg Files (*.esg);;All Files (*)", options=options)
+		fileName, _ = PyQt5.QtWidgets.QFileDialog.getSaveFileName(self,"Save new data as...", "",esgFileFilter, options=options)
 		if fileName:
-			saveEsgToFile(self.esgData,fileName)
-			self.needToSave = False
-			path, name = os.path.split(fileName)
+			# Edits never change data for an azimuth in place, they replace it. A shallow copy is a sufficient snapshot
+			self.start_save(self.esgData.copy(), fileName, True)
+
+	"""
+	Starts saving data in the background
+	current is True if we are saving the data currently edited, False for derived data (re-sectored data, for instance)
+	"""
+	def start_save(self, esgData, fileName, current):
+		self.saveWorker = saveEsgWorker(esgData, fileName, self)
+		self.saveWorker.current = current
+		self.saveWorker.progress.connect(self.save_esg_progress)
+		self.saveWorker.done.connect(self.save_esg_done)
+		self.saveButton.setDisabled(True)
+		self.saveProgress.setRange(0, esgData.nEta())
+		self.saveProgress.setValue(0)
+		self.saveProgress.show()
+		self.saveCancelButton.show()
+		self.statusBar().showMessage("Saving " + fileName)
+		self.saveWorker.start()
+
+	"""
+	Progress report from the background save
+	"""
+	def save_esg_progress(self, i, n):
+		self.saveProgress.setMaximum(n)
+		self.saveProgress.setValue(i)
+
+	"""
+	User wants to stop the background save
+	"""
+	def cancel_save_esg(self,evt=None):
+		if (self.saveWorker != None):
+			self.saveWorker.cancel()
+
+	"""
+	Background save is finished, cancelled, or failed
+	"""
+	def save_esg_done(self, ok, error):
+		worker = self.saveWorker
+		worker.wait()
+		self.saveWorker = None
+		self.saveButton.setDisabled(False)
+		self.saveProgress.hide()
+		self.saveCancelButton.hide()
+		if (ok and worker.current):
+			# Data may have been edited while we were saving. If so, we still need to save
+			current = self.esgData.data
+			saved = worker.esgData.data
+			if ((len(current) == len(saved)) and all(a is b for a, b in zip(current, saved))):
+				self.needToSave = False
+			path, name = os.path.split(worker.filename)
 			self.title = "MAUD ESG edit: " + name
 			self.setWindowTitle(self.title)
+			self.statusBar().showMessage("Saved %s, %d azimuths modified, others copied from the original file" % (worker.filename, len(worker.esgData.modifiedAzimuths())), 5000)
+		elif ok:
+			self.statusBar().showMessage("Saved " + worker.filename, 5000)
+		elif (error != ""):
+			self.statusBar().clearMessage()
+			PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Saving data failed: " + error)
+		else:
+			self.statusBar().showMessage("Saving cancelled, no file was written", 5000)
 
 	"""
 	Save current mask
@@ -1123,91 +2116,183 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 		options = PyQt5.QtWidgets.QFileDialog.Options()
 		fileName, _ = PyQt5.QtWidgets.QFileDialog.getSaveFileName(self,"Save mask as...", "","maudESGEdit Mask Files (*.msk);;All Files (*)", options=options)
 		if fileName:
-			saveMaskToFile(self.mask,fileName)
+			# Without data, the mask is saved without eta angles
+			etas = self.esgData.etas if (self.nEta>0) else None
+			saveMaskToFile(maskFromRecipe(self.recipe, etas),fileName)
 			
 	"""
 	Load and apply a mask
 	"""
 	def load_and_apply_mask(self,evt=None):
+		if (self.edits_locked()):
+			return
 		if (self.nEta<1):
 			PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Please load some data first")
 			return
-		if (self.needToSave):
-			buttonReply = PyQt5.QtWidgets.QMessageBox.question(self, 'Data not saved', "Data not saved. Load and apply a mask anyway? Previous mask will be lost. Things may crash if you try to undo.", PyQt5.QtWidgets.QMessageBox.Yes | PyQt5.QtWidgets.QMessageBox.No, PyQt5.QtWidgets.QMessageBox.No)
-			if (buttonReply == PyQt5.QtWidgets.QMessageBox.No):
-				return
 		options = PyQt5.QtWidgets.QFileDialog.Options()
 		filename, _ = PyQt5.QtWidgets.QFileDialog.getOpenFileName(self,"Select an mask file...", self.pathtomask,"maudESGEdit Mask Files (*.msk);;All Files (*)", options=options)
 		if filename:
 			self.pathtomask = os.path.dirname(filename)
-			self.mask = loadMaskFromFile(filename)
-			# Saving old data for undos
-			data = copy.deepcopy(self.esgData["data"])
-			self.olddata.append(data)
-			self.oldetaToPlot.append("all")
+			try:
+				mask = loadMaskFromFile(filename)
+				checkRecipe([{"edit": "mask", "mask": mask}], self.esgData.esgtype)
+			except (IOError, ValueError) as e:
+				PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Could not read mask: %s" % e)
+				return
+			# Masks saved with eta angles can be moved to the azimuths of this file
+			remap = "index"
+			if (any((item.get("etaangle") != None) for item in mask) and all((eta != None) for eta in self.esgData.etas)):
+				choices = ["Azimuths with the nearest eta", "Azimuths with overlapping eta sectors", "Same azimuth numbers"]
+				choice, ok = PyQt5.QtWidgets.QInputDialog.getItem(self, "Apply mask", "Apply 2theta ranges of the mask to", choices, 0, False)
+				if (not ok):
+					return
+				remap = ["nearest", "overlap", "index"][choices.index(choice)]
 			# Remove points in the mask
-			for item in self.mask:
-				if (item["set"]):
-					#self.mask.append({"set":True, "eta": self.etaToPlot, "clear2thetamin": left, "clear2thetamax": right})
-					eta = item["eta"]
-					min2theta = item["clear2thetamin"]
-					max2theta = item["clear2thetamax"]
-					thisetadata = numpy.asarray(self.esgData["data"][eta])
-					toremove = []
-					for j in range(thisetadata.shape[0]):
-						twotheta = thisetadata[j,0]
-						intensity = thisetadata[j,2]
-						if ((twotheta<max2theta) and (twotheta>min2theta)):
-							toremove.append(j)
-					thisetadata = numpy.delete(thisetadata,toremove,0)
-					self.esgData["data"][eta] = thisetadata.tolist()
-			self.needToSave = True
-			self.cancelButton.setDisabled(False)
-			self.on_draw()
+			self.start_edit_job({"edit": "mask", "mask": mask, "remap": remap}, "Applying mask")
+	
+	"""
+	Remove data points within a region in detector space, at all azimuths
+	"""
+	def mask_detector_region(self,evt=None):
+		if (self.edits_locked()):
+			return
+		if ((self.nEta<1) or (self.esgData.esgtype != "inclinedReflection")):
+			return
+		dialog = detectorRegionDialog(self)
+		result = dialog.exec_()
+		if (dialog.isOk()):
+			self.start_edit_job({"edit": "mask", "mask": [dialog.getInputs()]}, "Masking detector region")
+	
+	"""
+	Save all edits done since the file was opened as a recipe, to replay them on other files
+	"""
+	def save_recipe(self,evt=None):
+		options = PyQt5.QtWidgets.QFileDialog.Options()
+		fileName, _ = PyQt5.QtWidgets.QFileDialog.getSaveFileName(self,"Save recipe as...", self.pathtorecipe,"maudESGEdit Recipe Files (*.json);;All Files (*)", options=options)
+		if fileName:
+			self.pathtorecipe = os.path.dirname(fileName)
+			try:
+				saveRecipeToFile(self.recipe,fileName)
+			except IOError as e:
+				PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Could not save recipe: %s" % e)
+	
+	"""
+	Load a recipe and apply it to the current data, as a single edit
+	"""
+	def load_and_apply_recipe(self,evt=None):
+		if (self.edits_locked()):
+			return
+		if (self.nEta<1):
+			PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Please load some data first")
+			return
+		options = PyQt5.QtWidgets.QFileDialog.Options()
+		filename, _ = PyQt5.QtWidgets.QFileDialog.getOpenFileName(self,"Select a recipe file...", self.pathtorecipe,"maudESGEdit Recipe Files (*.json);;All Files (*)", options=options)
+		if filename:
+			self.pathtorecipe = os.path.dirname(filename)
+			try:
+				steps = loadRecipeFromFile(filename)
+				checkRecipe(steps, self.esgData.esgtype)
+			except (IOError, ValueError, KeyError) as e:
+				PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Could not read recipe: %s" % e)
+				return
+			self.start_edit_job({"edit": "recipe", "steps": steps}, "Applying recipe")
 			
 			
 	"""
 	Open a different esg
 	"""
 	def open_esg(self,evt=None):
+		if (self.edits_locked()):
+			return
 		if (self.needToSave):
 			buttonReply = PyQt5.QtWidgets.QMessageBox.question(self, 'Data not saved', "Data not saved. Load a new dataset anyway?", PyQt5.QtWidgets.QMessageBox.Yes | PyQt5.QtWidgets.QMessageBox.No, PyQt5.QtWidgets.QMessageBox.No)
 			if (buttonReply == PyQt5.QtWidgets.QMessageBox.No):
 				return
 		options = PyQt5.QtWidgets.QFileDialog.Options()
-		filename, _ = PyQt5.QtWidgets.QFileDialog.getOpenFileName(self,"Select an ESG file...", "","Esg Files (*.esg);;All Files (*)", options=options)
+		filename, _ = PyQt5.QtWidgets.QFileDialog.getOpenFileName(self,"Select an ESG file...", "",esgFileFilter, options=options)
 		if filename:
-			try:
-				self.esgData["esgtype"] # the esg was set if this does not fail
-				if (self.esgData["esgtype"] == "inclinedReflection"): # if we already have predefine detector info, we send them so they can be reused
-					params = ["inclinedReflection", self.esgData["detdistance"] , self.esgData["detTTheta"],  self.esgData["detTilt"],  self.esgData["detRotation"] , self.esgData["detEta"] ]
-					self.esgData = parseESG(self,filename, params)
-				else:
-					self.esgData = parseESG(self,filename)
-			except AttributeError:
-				# ESG was not set already. We simply load the file
-				self.esgData = parseESG(self,filename)
-			if (self.esgData != False):
-				path, name = os.path.split(filename)
-				self.title = "MAUD ESG edit: " + name
-				self.filename = filename
-				self.fileSaveHint = filename
-				self.nEta = len(self.esgData["etas"])
-				self.etaLabel.setText("Spectrum (0-%d) : " % (self.nEta-1))
-				self.etaToPlot = 0
-				self.etaNBox.setText("%d" % (self.etaToPlot))
-				self.olddata = [] # Deleting cached old data to avoid confusion
-				self.mask = []	# clear mask
-				self.setWindowTitle(self.title)
-				self.needToSave = False
-				self.tthetaButton.setDisabled(False)
-				self.subtractBgButton.setDisabled(True)
-				self.xbg = []				# Used for creating background
-				self.ybg = []				# Used for creating background
-				self.on_draw()
+			if (self.nEta > 0): # if we already have predefine detector info, we send them so they can be reused
+				esgData = parseESG(self,filename, self.esgData.detparams())
+			else:
+				esgData = parseESG(self,filename)
+			if (esgData != False):
+				self.set_data(esgData, filename)
 		#else:
 		#	PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "File opening failed")
 	
+	"""
+	Integrate a series of detector images into ESG files, in a folder chosen by the user, and open the first one
+	The integration map is calculated once, the other images only cost a histogram
+	"""
+	def integrate_images(self,evt=None):
+		if (self.edits_locked()):
+			return
+		if (self.needToSave):
+			buttonReply = PyQt5.QtWidgets.QMessageBox.question(self, 'Data not saved', "Data not saved. Load a new dataset anyway?", PyQt5.QtWidgets.QMessageBox.Yes | PyQt5.QtWidgets.QMessageBox.No, PyQt5.QtWidgets.QMessageBox.No)
+			if (buttonReply == PyQt5.QtWidgets.QMessageBox.No):
+				return
+		options = PyQt5.QtWidgets.QFileDialog.Options()
+		imageFilter = "Images (%s);;All Files (*)" % " ".join("*" + extension for extension in sorted(imageFileTypes))
+		filenames, _ = PyQt5.QtWidgets.QFileDialog.getOpenFileNames(self,"Select detector images...", "",imageFilter, options=options)
+		if (len(filenames) == 0):
+			return
+		dialog = imageIntegrationDialog(self, self.esgData.detparams() if (self.nEta > 0) else None)
+		result = dialog.exec_()
+		if (not dialog.isOk()):
+			return
+		detparams, pixelsize, center, nsectors, step = dialog.getInputs()
+		outdir = PyQt5.QtWidgets.QFileDialog.getExistingDirectory(self, "Save ESG files in...", os.path.dirname(filenames[0]))
+		if (not outdir):
+			return
+		outnames = []
+		PyQt5.QtWidgets.QApplication.setOverrideCursor(PyQt5.QtCore.Qt.WaitCursor)
+		try:
+			for outname, n in integrateImageFiles(filenames, outdir, detparams, pixelsize, center, nsectors, step):
+				outnames.append(outname)
+				self.statusBar().showMessage("Integrated %d of %d images" % (len(outnames), len(filenames)))
+				PyQt5.QtWidgets.QApplication.processEvents()
+			esgData = EsgDataset.fromFile(outnames[0], detparams)
+		except (IOError, ValueError) as e:
+			PyQt5.QtWidgets.QApplication.restoreOverrideCursor()
+			PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Integration failed after %d images: %s" % (len(outnames), e))
+			return
+		PyQt5.QtWidgets.QApplication.restoreOverrideCursor()
+		self.statusBar().showMessage("Integrated %d images in %s" % (len(outnames), outdir), 5000)
+		self.set_data(esgData, outnames[0])
+	
+	"""
+	Show a new dataset, read from filename, and reset edits
+	"""
+	def set_data(self, esgData, filename):
+		self.esgData = esgData
+		path, name = os.path.split(filename)
+		self.title = "MAUD ESG edit: " + name
+		self.filename = filename
+		self.fileSaveHint = filename
+		self.nEta = self.esgData.nEta()
+		self.etaLabel.setText("Spectrum (0-%d) : " % (self.nEta-1))
+		self.etaToPlot = 0
+		self.etaNBox.setText("%d" % (self.etaToPlot))
+		self.olddata = [] # Deleting cached old data to avoid confusion
+		self.oldetaToPlot = []
+		self.recipe = []	# clear recipe
+		self.baselinePreview = None
+		self.subtractBaselineButton.setDisabled(True)
+		self.setWindowTitle(self.title)
+		self.needToSave = False
+		self.tthetaButton.setDisabled(False)
+		self.rebinButton.setDisabled(False)
+		self.calibButton.setDisabled(False)
+		self.resectorButton.setDisabled(self.esgData.esgtype != "inclinedReflection")
+		self.mergeButton.setDisabled(False)
+		self.refineCalibButton.setDisabled(self.esgData.esgtype != "inclinedReflection")
+		self.detectorMaskButton.setDisabled(self.esgData.esgtype != "inclinedReflection")
+		self.subtractBgButton.setDisabled(True)
+		self.xbg = []				# Used for creating background
+		self.ybg = []				# Used for creating background
+		self.start_journal()
+		self.on_draw()
+	
 	"""
 	Opens the about window
 	"""
@@ -1216,6 +2301,18 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 		dialog.exec_()
 		return
 	
+	"""
+	Opens the waterfall of neighbouring azimuths, it then follows the current azimuth
+	"""
+	def show_waterfall(self,evt=None):
+		if (self.nEta <= 0):
+			PyQt5.QtWidgets.QMessageBox.critical(self, "Error", "Please load some data first")
+			return
+		if ((self.waterfall == None) or (not self.waterfall.isVisible())):
+			self.waterfall = waterfallWindow(self)
+		self.waterfall.raise_()
+		self.waterfall.show_data(self.esgData, self.etaToPlot)
+	
 	"""
 	Opens the help window
 	"""
@@ -1252,6 +2349,35 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 			self.dounzoom = False
 			self.on_draw()
 	
+	"""
+	Mouse moves over the plot: show the data point closest to the mouse in the status bar
+	"""
+	def on_motion(self, event):
+		point = None
+		if ((self.drawnData is not None) and (event.inaxes == self.axes) and (event.xdata != None)):
+			# Points shown on the plot, the azimuth to plot may not be drawn yet
+			data = self.drawnData
+			# Index is rebuilt only when the data change, edits always replace the array of an azimuth
+			if ((self.hoverIndex == None) or (self.hoverIndex.data is not data)):
+				self.hoverIndex = TwoThetaIndex(data)
+			# Pixels per unit, the closest point is searched in display space
+			left, right = self.axes.get_xlim()
+			bottom, top = self.axes.get_ylim()
+			xscale = self.axes.bbox.width / abs(right-left)
+			yscale = self.axes.bbox.height / abs(top-bottom)
+			i = self.hoverIndex.nearest(event.xdata, event.ydata, xscale, yscale, 10.)
+			if (i != None):
+				point = data[i]
+		if (point is not None):
+			text = "2theta %.4f, intensity %.2f, x %.4f" % (point[0], point[2], point[1])
+			if (len(point) > 3):
+				text += ", y %.4f" % (point[3])
+			self.statusBar().showMessage(text)
+			self.hoverShown = True
+		elif (self.hoverShown):
+			self.statusBar().clearMessage()
+			self.hoverShown = False
+	
 	"""
 	Delete all background points
 	"""
@@ -1265,25 +2391,14 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 	We need to subtract the background from the data
 	"""
 	def subtract_background(self, event):
+		if (self.edits_locked()):
+			return
 		if (len(self.xbg)>0):
-			bg = interpolate.interp1d(self.xbg, self.ybg)
-			data = numpy.asarray(self.esgData["data"][self.etaToPlot])
 			# Saving old data for undos
-			self.olddata.append(data.copy())
+			self.olddata.append(self.esgData.data[self.etaToPlot])
 			self.oldetaToPlot.append(self.etaToPlot)
-			self.mask.append({"set":False}); # Adding an empty value in saved mask. Necessary for proper handle of undos
 			# Remove background within our range
-			xmin = min(self.xbg)
-			xmax = max(self.xbg)
-			for i in range(data.shape[0]):
-				twotheta = data[i,0]
-				intensity = data[i,2]
-				if ((twotheta>xmin) and (twotheta<xmax)):
-					try:
-						data[i,2] = data[i,2] - bg(twotheta)
-					except TypeError:
-						print ("Small error in background subtraction, we keep going")
-			self.esgData["data"][self.etaToPlot] = data.tolist()
+			self.record_edit(self.esgData.subtractBackground(self.etaToPlot, self.xbg, self.ybg))
 			# We change something. We should ask confirmation for saving before closing the app, we can also undo stuff from now on
 			self.needToSave = True
 			self.cancelButton.setDisabled(False)
@@ -1293,23 +2408,61 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 			# Redraw everything
 			self.on_draw()
 			
+	"""
+	Calculate an automatic baseline at all azimuths and show it, without changing the data
+	"""
+	def estimate_baseline(self, event=None):
+		if (self.edits_locked()):
+			return
+		if (self.nEta <= 0):
+			return
+		dialog = baselineDialog(self, self.baselineWidth, self.baselineGap)
+		result = dialog.exec_()
+		if (not dialog.isOk()):
+			return
+		self.baselineWidth, self.baselineGap = dialog.getInputs()
+		self.start_edit_job({"edit": "estimateBaseline", "width": self.baselineWidth, "gap": self.baselineGap}, "Estimating baseline")
+	
+	"""
+	Subtract the automatic baseline at all azimuths, as a single edit
+	"""
+	def subtract_baseline(self, event=None):
+		if (self.edits_locked()):
+			return
+		if ((self.nEta <= 0) or (self.baselinePreview == None)):
+			return
+		self.start_edit_job({"edit": "subtractBaseline", "width": self.baselineWidth, "gap": self.baselineGap, "eta": None}, "Subtracting baseline")
+	
+	"""
+	Rebin 2theta at all azimuths
+	"""
+	def rebin_data(self, event=None):
+		if (self.edits_locked()):
+			return
+		if (self.nEta <= 0):
+			return
+		dialog = rebinDialog(self)
+		result = dialog.exec_()
+		if (not dialog.isOk()):
+			return
+		self.start_edit_job(dialog.getInputs(), "Rebinning 2theta")
+	
 	"""
 	Add a constant value for all intensities at a given azimuth
 	"""
 	def shift_data(self, event):
+		if (self.edits_locked()):
+			return
 		if (self.nEta <= 0):
 			return
 		shift,ok = PyQt5.QtWidgets.QInputDialog.getDouble(self,"Shift data by","How much shall we add to intensities (current azimuth only)")
 		if ok:
-			data = numpy.asarray(self.esgData["data"][self.etaToPlot])
-			if (data.size > 0):
+			if (self.esgData.data[self.etaToPlot].size > 0):
 				# Saving old data for undos
-				self.olddata.append(data.copy())
+				self.olddata.append(self.esgData.data[self.etaToPlot])
 				self.oldetaToPlot.append(self.etaToPlot)
-				self.mask.append({"set":False}); # Adding an empty value in saved mask. Necessary for proper handle of undos
 				# Adding to the intensity
-				data[:,2] += shift
-				self.esgData["data"][self.etaToPlot] = data.tolist()
+				self.record_edit(self.esgData.shift(shift, self.etaToPlot))
 				# We change something. We should ask confirmation for saving before closing the app, we can also undo stuff from now on
 				self.needToSave = True
 				self.cancelButton.setDisabled(False)
@@ -1322,58 +2475,25 @@ class plotEsg(PyQt5.QtWidgets.QMainWindow):
 	Add a constant value for all intensities at all azimuth
 	"""
 	def shift_data_all(self, event):
+		if (self.edits_locked()):
+			return
 		if (self.nEta <= 0):
 			return
 		shift,ok = PyQt5.QtWidgets.QInputDialog.getDouble(self,"Shift data by","How much shall we add to intensities (all azimuthal angles)")
 		if ok:
-			# Saving old data for undos
-			data = copy.deepcopy(self.esgData["data"])
-			self.olddata.append(data)
-			self.oldetaToPlot.append("all")
-			self.mask.append({"set":False}); # Adding an empty value in saved mask. Necessary for proper handle of undos
-			# Shifting intensities
-			for i in range(0,self.nEta):
-				thisetadata = numpy.asarray(self.esgData["data"][i])
-				if (thisetadata.size > 0):
-					# Adding to the intensity
-					thisetadata[:,2] += shift
-					self.esgData["data"][i] = thisetadata.tolist()
-			# We change something. We should ask confirmation for saving before closing the app, we can also undo stuff from now on
-			self.needToSave = True
-			self.cancelButton.setDisabled(False)
-			self.xbg=[]
-			self.ybg=[]
-			# Redraw everything
-			self.on_draw()
+			self.start_edit_job({"edit": "shift", "shift": shift, "eta": None}, "Shifting intensities")
 
 	"""
 	Set a fixed minimum intensity for all azimuth
 	"""
 	def setmin_data_all(self, event):
+		if (self.edits_locked()):
+			return
 		if (self.nEta <= 0):
 			return
 		minval,ok = PyQt5.QtWidgets.QInputDialog.getDouble(self,"Minimum","Minimum intensity to set at all azimuthal angles")
 		if ok:
-			# Saving old data for undos
-			data = copy.deepcopy(self.esgData["data"])
-			self.olddata.append(data)
-			self.oldetaToPlot.append("all")
-			self.mask.append({"set":False}); # Adding an empty value in saved mask. Necessary for proper handle of undos
-			# Shifting intensities
-			for i in range(0,self.nEta):
-				thisetadata = numpy.asarray(self.esgData["data"][i])
-				if (thisetadata.size > 0):
-					# Adding to the intensity
-					shift = minval-min(thisetadata[:,2])
-					thisetadata[:,2] += shift
-					self.esgData["data"][i] = thisetadata.tolist()
-			# We change something. We should ask confirmation for saving before closing the app, we can also undo stuff from now on
-			self.needToSave = True
-			self.cancelButton.setDisabled(False)
-			self.xbg=[]
-			self.ybg=[]
-			# Redraw everything
-			self.on_draw()
+			self.start_edit_job({"edit": "setMinimum", "minimum": minval}, "Setting minimum intensity")
 	
 	"""
 	Turn on or off the auto-background feature
@@ -1417,7 +2537,167 @@ iconXPMbase64 = "LyogWFBNICovCnN0YXRpYyBjaGFyICogbWF1ZEVTR0VkaXRfeHBtW10gPSB7CiI
 #
 #################################################################
 
-# Prepare to plot...
-app = PyQt5.QtWidgets.QApplication(sys.argv)	
-form = plotEsg()
-app.exec_()
+class orderedEditAction(argparse.Action):
+	"""
+	Edits given on the command line, kept in the order they were given
+	"""
+	def __call__(self, parser, namespace, values, option_string=None):
+		namespace.edits.append((self.dest, values))
+
+def recipeFromArguments(edits, maskremap="nearest"):
+	"""
+	Converts edits from the command line to recipe steps. 2theta ranges of masks are moved to azimuths according to maskremap
+	"""
+	steps = []
+	for name, params in edits:
+		if (name == "recipe"):
+			steps.append({"edit": "recipe", "steps": loadRecipeFromFile(params)})
+		elif (name == "mask"):
+			steps.append({"edit": "mask", "mask": loadMaskFromFile(params), "remap": maskremap})
+		elif (name == "crop"):
+			steps.append({"edit": "crop", "min2theta": params[0], "max2theta": params[1]})
+		elif (name == "shift"):
+			steps.append({"edit": "shift", "shift": params, "eta": None})
+		elif (name == "setmin"):
+			steps.append({"edit": "setMinimum", "minimum": params})
+		elif (name == "rebin"):
+			steps.append({"edit": "rebin", "step": float(params[0]), "maxpoints": None, "aggregate": params[1]})
+		elif (name == "rebin_points"):
+			steps.append({"edit": "rebin", "step": None, "maxpoints": int(params[0]), "aggregate": params[1]})
+	checkRecipe(steps)
+	return steps
+
+def logMessage(message):
+	print ("%s %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), message), flush=True)
+
+def watchEsgFolder(indir, outdir, steps, detparams=None, interval=1.):
+	"""
+	Polls indir for ESG files, applies the recipe steps to each new file, and saves the result in outdir with the same name.
+	
+	A file is processed once its size and modification time did not change between two polls, so that files still being
+	written are left alone. Files already in outdir, newer than the input, are not processed again. Files are processed 
+	again if they change. Runs until interrupted.
+	"""
+	seen = {}		# Size and modification time of each file at the previous poll
+	done = {}		# Size and modification time of each file when it was processed
+	logMessage("Watching %s, edited files go to %s" % (indir, outdir))
+	while True:
+		for name in sorted(os.listdir(indir)):
+			path = os.path.join(indir, name)
+			if (name.startswith(".") or (not isEsgFileName(name))):
+				continue
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue # File was removed
+			signature = (stat.st_size, stat.st_mtime)
+			if (done.get(path) == signature):
+				continue
+			if (seen.get(path) != signature):
+				seen[path] = signature # New or still growing, wait for the next poll
+				continue
+			outpath = os.path.join(outdir, name)
+			if ((path not in done) and os.path.exists(outpath) and (os.stat(outpath).st_mtime >= stat.st_mtime)):
+				done[path] = signature
+				logMessage("%s: already processed, skipped" % name)
+				continue
+			start = time.time()
+			try:
+				n = streamEsg(path, outpath, steps, detparams)
+				logMessage("%s: %d azimuths in %.2f s" % (name, n, time.time()-start))
+			except (IOError, ValueError, KeyError) as e:
+				logMessage("%s: error after %.2f s: %s" % (name, time.time()-start, e))
+			done[path] = signature
+		time.sleep(interval)
+
+def main():
+	parser = argparse.ArgumentParser(description="Utility to fix data in ESG files before Rietveld refinement in MAUD.\nWithout options, starts the graphical interface.", formatter_class=RawTextHelpFormatter)
+	parser.add_argument("--stream", nargs=2, metavar=("INPUT", "OUTPUT"), help="Edit INPUT one azimuth at a time and save the result in OUTPUT, without the graphical interface.\nMemory use is bounded by the largest azimuth, not the size of the file.\nEdits are applied in the order they are given.")
+	parser.add_argument("--export", nargs=2, metavar=("INPUT", "OUTPUT"), help="Edit INPUT and export the result to OUTPUT in binary format, one array per column,\nto NPZ (.npz) or HDF5 (.h5, .hdf5, requires h5py).\nEdits are applied in the order they are given.")
+	parser.add_argument("--watch", nargs=2, metavar=("INDIR", "OUTDIR"), help="Watch INDIR for new ESG files, edit each of them once it stops growing, and save the result in OUTDIR.\nProcessing time and errors are printed for each file. Stop with Ctrl+C.")
+	parser.add_argument("--interval", type=float, default=1., metavar="SECONDS", help="Time between two checks of the folder in --watch mode (default: 1)")
+	parser.add_argument("--integrate", nargs="+", metavar=("OUTDIR", "IMAGE"), help="Integrate 2D detector images (.npy, .tif, .edf) into ESG files in OUTDIR, with the same names.\nRequires --detector, --pixel-size, and --center. Edits are applied to the result.")
+	parser.add_argument("--pixel-size", nargs=2, type=float, metavar=("X", "Y"), help="Pixel size of the images along x (columns) and y (rows), in mm, for --integrate")
+	parser.add_argument("--center", nargs=2, type=float, metavar=("X", "Y"), help="Beam center on the images, in mm from the first pixel, for --integrate")
+	parser.add_argument("--sectors", type=int, default=72, metavar="N", help="Number of azimuthal sectors for --integrate (default: 72)")
+	parser.add_argument("--step", type=float, metavar="DEGREES", help="Width of 2theta bins for --integrate (default: the angle of one pixel)")
+	parser.add_argument("--image-mask", metavar="IMAGE", help="Image with non-zero values on pixels to ignore, for --integrate")
+	parser.add_argument("--recipe", action=orderedEditAction, metavar="RECIPEFILE", help="Replay edits saved in a recipe file")
+	parser.add_argument("--mask", action=orderedEditAction, metavar="MSKFILE", help="Remove 2theta ranges listed in a mask file")
+	parser.add_argument("--mask-remap", choices=maskRemapModes, default="nearest", help="How 2theta ranges of masks are applied to the azimuths of the file: to those\nwith the nearest eta (default), with overlapping eta sectors, or with the same number.\nRanges from masks saved without eta always stay on the same azimuth number")
+	parser.add_argument("--crop", action=orderedEditAction, nargs=2, type=float, metavar=("MIN", "MAX"), help="Restrict data to a 2theta range")
+	parser.add_argument("--shift", action=orderedEditAction, type=float, metavar="VALUE", help="Add a fixed value to all intensities")
+	parser.add_argument("--setmin", action=orderedEditAction, type=float, metavar="VALUE", help="Set the minimum intensity at all azimuths")
+	parser.add_argument("--rebin", action=orderedEditAction, nargs=2, metavar=("STEP", "mean|sum"), help="Group points in bins of STEP degrees 2theta, with the mean or sum of their intensities")
+	parser.add_argument("--rebin-points", action=orderedEditAction, nargs=2, metavar=("N", "mean|sum"), help="Group points in at most N bins of 2theta per azimuth, with the mean or sum of their intensities")
+	parser.add_argument("--detector", nargs=5, type=float, metavar=("DIST", "2THETA", "TILT", "ROTATION", "ETA"), help="Detector distance (mm) and angles (degrees), required for inclined detectors")
+	parser.set_defaults(edits=[])
+	args = parser.parse_args()
+	
+	detparams = None
+	if (args.detector != None):
+		detparams = ["inclinedReflection"] + list(args.detector)
+	if (args.stream != None):
+		start = time.time()
+		try:
+			steps = recipeFromArguments(args.edits, args.mask_remap)
+			n = streamEsg(args.stream[0], args.stream[1], steps, detparams)
+		except (IOError, ValueError) as e:
+			print ("Error: %s" % e)
+			sys.exit(1)
+		print ("Edited %d azimuths from %s to %s in %.1f s" % (n, args.stream[0], args.stream[1], time.time()-start))
+		sys.exit(0)
+	elif (args.export != None):
+		start = time.time()
+		try:
+			steps = recipeFromArguments(args.edits, args.mask_remap)
+			esg = EsgDataset.fromFile(args.export[0], detparams)
+			esg.applyRecipe(steps)
+			esg.export(args.export[1])
+		except (IOError, ValueError) as e:
+			print ("Error: %s" % e)
+			sys.exit(1)
+		print ("Exported %d azimuths from %s to %s in %.1f s" % (esg.nEta(), args.export[0], args.export[1], time.time()-start))
+		sys.exit(0)
+	elif (args.watch != None):
+		indir, outdir = args.watch
+		if ((not os.path.isdir(indir)) or (not os.path.isdir(outdir))):
+			parser.error("--watch requires two existing directories")
+		if (os.path.samefile(indir, outdir)):
+			parser.error("--watch requires different input and output directories")
+		try:
+			steps = recipeFromArguments(args.edits, args.mask_remap)
+		except (IOError, ValueError) as e:
+			print ("Error: %s" % e)
+			sys.exit(1)
+		try:
+			watchEsgFolder(indir, outdir, steps, detparams, args.interval)
+		except KeyboardInterrupt:
+			logMessage("Stopped watching %s" % indir)
+		sys.exit(0)
+	elif (args.integrate != None):
+		if ((len(args.integrate) < 2) or (not os.path.isdir(args.integrate[0]))):
+			parser.error("--integrate requires an existing output directory and at least one image")
+		if ((detparams == None) or (args.pixel_size == None) or (args.center == None)):
+			parser.error("--integrate requires --detector, --pixel-size, and --center")
+		try:
+			steps = recipeFromArguments(args.edits, args.mask_remap)
+			mask = None if (args.image_mask == None) else (readImage(args.image_mask) != 0.)
+			start = time.time()
+			for outname, n in integrateImageFiles(args.integrate[1:], args.integrate[0], detparams, args.pixel_size, args.center, args.sectors, args.step, mask, steps):
+				logMessage("%s: %d azimuths, %.2f s" % (outname, n, time.time()-start))
+				start = time.time()
+		except (IOError, ValueError) as e:
+			print ("Error: %s" % e)
+			sys.exit(1)
+		sys.exit(0)
+	elif (len(args.edits) > 0):
+		parser.error("edits from the command line require --stream, --export, --watch, or --integrate")
+	
+	# Prepare to plot...
+	app = PyQt5.QtWidgets.QApplication(sys.argv)	
+	form = plotEsg()
+	app.exec_()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests for maudESGCore, saving ESG files and recovering edits from journals
+
+Run from the top folder with
+python -m pytest tests
+or
+python -m unittest discover tests
+"""
+
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from maudESGCore import EsgDataset, EditJournal, readJournal, findJournals, streamEsg, esgFileType
+
+def writeFlatEsg(filename, neta=6, npoints=50):
+	"""
+	Small ESG file for a flat transmission detector, with positions written with 3 decimals so that formatting
+	them again (2 decimals) changes the file
+	"""
+	rng = numpy.random.default_rng(0)
+	string = ""
+	for i in range(0,neta):
+		string += "_pd_block_id noTitle|#%d\n\n" % i
+		string += "_diffrn_detector 2D\n_pd_instr_dist_spec/detc 200.000\n_pd_meas_angle_omega 0.0\n_pd_meas_angle_eta %.3f\n\n" % (i*360./neta)
+		string += "loop_\n_pd_meas_position_x\n_pd_meas_intensity_total\n"
+		for x, intensity in zip(numpy.linspace(10., 60., npoints), rng.uniform(100., 300., npoints)):
+			string += "%.3f %.4f\n" % (x, intensity)
+		string += "\n"
+	f = open(filename, 'w')
+	f.write(string)
+	f.close()
+
+def readFile(filename):
+	f = open(filename, 'r')
+	try:
+		return f.read()
+	finally:
+		f.close()
+
+def azimuths(string):
+	"""
+	Text of each azimuth of an ESG file
+	"""
+	return ["_pd_block_id" + block for block in string.split("_pd_block_id")[1:]]
+
+class saveTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.filename = os.path.join(self.directory, "data.esg")
+		writeFlatEsg(self.filename)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def checkStreamAsInMemory(self, filename, steps):
+		esg = EsgDataset.fromFile(filename)
+		esg.applyRecipe(steps)
+		inmemory = os.path.join(self.directory, "inmemory.esg")
+		streamed = os.path.join(self.directory, "streamed.esg")
+		esg.save(inmemory)
+		self.assertEqual(streamEsg(filename, streamed, steps), len(esg.data))
+		self.assertEqual(readFile(streamed), readFile(inmemory))
+		return readFile(inmemory)
+
+	def test_unchanged_file(self):
+		esg = EsgDataset.fromFile(self.filename)
+		self.assertEqual(esg.modifiedAzimuths(), [])
+		output = os.path.join(self.directory, "out.esg")
+		esg.save(output)
+		self.assertEqual(readFile(output), readFile(self.filename))
+
+	def test_unchanged_azimuths_are_copied(self):
+		esg = EsgDataset.fromFile(self.filename)
+		esg.shift(10., 2)
+		self.assertEqual(esg.modifiedAzimuths(), [2])
+		output = os.path.join(self.directory, "out.esg")
+		esg.save(output)
+		before = azimuths(readFile(self.filename))
+		after = azimuths(readFile(output))
+		self.assertEqual(len(after), len(before))
+		for i in range(0,len(before)):
+			if (i == 2):
+				self.assertNotEqual(after[i], before[i])
+			else:
+				self.assertEqual(after[i], before[i])
+		self.assertTrue(numpy.allclose(EsgDataset.fromFile(output).data[2][:,2], esg.data[2][:,2]))
+
+	def test_undo_keeps_azimuths_unchanged(self):
+		esg = EsgDataset.fromFile(self.filename)
+		data = list(esg.data)
+		esg.shift(10.)
+		self.assertEqual(len(esg.modifiedAzimuths()), len(data))
+		esg.data = data
+		self.assertEqual(esg.modifiedAzimuths(), [])
+
+	def test_stream_one_azimuth(self):
+		output = self.checkStreamAsInMemory(self.filename, [{"edit": "shift", "eta": 2, "shift": 5.}])
+		before = azimuths(readFile(self.filename))
+		after = azimuths(output)
+		self.assertEqual([i for i in range(0,len(before)) if (before[i] != after[i])], [2])
+
+	def test_stream_all_azimuths(self):
+		self.checkStreamAsInMemory(self.filename, [{"edit": "crop", "min2theta": 4., "max2theta": 12.}, {"edit": "shift", "shift": -50.}])
+
+	def test_stream_nothing_changed(self):
+		output = self.checkStreamAsInMemory(self.filename, [{"edit": "removePoints", "eta": 20, "min2theta": 0., "max2theta": 90.}])
+		self.assertEqual(output, readFile(self.filename))
+
+	def test_stream_compressed(self):
+		compressed = self.filename + ".gz"
+		f = open(self.filename, 'rb')
+		g = gzip.open(compressed, 'wb')
+		shutil.copyfileobj(f, g)
+		g.close()
+		f.close()
+		steps = [{"edit": "shift", "eta": 4, "shift": 5.}]
+		esg = EsgDataset.fromFile(compressed)
+		esg.applyRecipe(steps)
+		inmemory = os.path.join(self.directory, "inmemory.esg.gz")
+		streamed = os.path.join(self.directory, "streamed.esg.gz")
+		esg.save(inmemory)
+		streamEsg(compressed, streamed, steps)
+		self.assertEqual(gzip.open(streamed, 'rt').read(), gzip.open(inmemory, 'rt').read())
+		self.assertEqual(esgFileType(streamed), ("flatTransmission", 200.))
+
+class journalTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.filename = os.path.join(self.directory, "data.esg")
+		self.journals = os.path.join(self.directory, "journals")
+		writeFlatEsg(self.filename)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def crashedJournal(self, esg, steps, undos=0):
+		"""
+		Journal left by a session that stopped without saving, written by a process that is not running anymore
+		"""
+		journal = EditJournal.start(esg, self.journals)
+		for step in steps:
+			journal.append(step)
+		for i in range(0,undos):
+			journal.undo()
+		journal.close(remove=False)
+		process = subprocess.Popen([sys.executable, "-c", "pass"])
+		process.wait()
+		lines = readFile(journal.filename).split("\n")
+		header = json.loads(lines[0])
+		header["pid"] = process.pid
+		lines[0] = json.dumps(header)
+		f = open(journal.filename, 'w')
+		f.write("\n".join(lines))
+		f.close()
+		return journal.filename
+
+	def test_replay(self):
+		esg = EsgDataset.fromFile(self.filename)
+		steps = [esg.shift(10., 1), esg.removePoints(3, 5., 8.), esg.setMinimum(150.), esg.shift(-5.)]
+		filename = self.crashedJournal(esg, steps, undos=1)
+		# Last line cut short by the crash
+		f = open(filename, 'a')
+		f.write('{"step": {"edit": "sh')
+		f.close()
+		journals = findJournals(self.journals)
+		self.assertEqual(len(journals), 1)
+		name, header, recovered = journals[0]
+		self.assertEqual(name, filename)
+		self.assertEqual(recovered, steps[:-1])
+		replayed = EsgDataset.fromFile(header["source"], header["detparams"])
+		replayed.applyRecipe([{"edit": "recipe", "steps": recovered}])
+		expected = EsgDataset.fromFile(self.filename)
+		expected.applyRecipe(steps[:-1])
+		self.assertEqual(len(replayed.data), len(expected.data))
+		for i in range(0,len(expected.data)):
+			self.assertTrue(numpy.array_equal(replayed.data[i], expected.data[i]))
+
+	def test_running_session_is_skipped(self):
+		esg = EsgDataset.fromFile(self.filename)
+		journal = EditJournal.start(esg, self.journals)
+		journal.append(esg.shift(10., 1))
+		self.assertEqual(findJournals(self.journals), [])
+		self.assertEqual(len(readJournal(journal.filename)[1]), 1)
+		journal.close()
+		self.assertFalse(os.path.exists(journal.filename))
+
+if __name__ == '__main__':
+	unittest.main()